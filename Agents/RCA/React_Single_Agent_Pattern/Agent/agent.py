@@ -1,21 +1,31 @@
 from dotenv import load_dotenv
+import asyncio
 import os
 import requests
+import threading
 import time
 from langchain.agents import create_agent
-from langgraph.graph import StateGraph
-from langchain_google_genai import GoogleGenerativeAIEmbeddings,ChatGoogleGenerativeAI
-from langgraph.prebuilt import ToolNode
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langfuse import get_client as get_langfuse_client
 from langfuse.langchain import CallbackHandler as langfuse_callback_handler
-from langchain.agents.middleware import SummarizationMiddleware
-from langgraph._internal._runnable import RunnableCallable
-from typing import Literal, Annotated, Tuple
-from dataclasses import dataclass
-
+from langchain.agents.middleware import ModelRequest, SummarizationMiddleware, dynamic_prompt
+from dataclasses import asdict, dataclass
+from datetime import timezone
+
+import alert_rule_cache
+import budget
+import checkpoint_store
+import http_client
 import state
+import catalogue
 import loki
+import model_router
 import tempo
 import prometheus
+import query_window
+import replay
+import sinks
+import tool_cache
 
 load_dotenv('.env')
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "./service-account-key.json"
@@ -24,17 +34,96 @@ os.environ["LANGFUSE_PUBLIC_KEY"]
 os.environ["LANGFUSE_BASE_URL"]
 grafana_api_key = os.getenv("GRAFANA_API_KEY")
 
-# model = "gemini-2.0-flash-lite"
-model = "gemini-2.5-flash"
+# ツール選択のターンは軽量なモデル、最終回答・失敗が続いた時は高性能なモデルを使う(model_router.py)
+fast_model = model_router.RCA_FAST_MODEL
+model = model_router.RCA_STRONG_MODEL
 
-tools = [loki.run_loki_logql, loki.get_loki_label_values, loki.get_list_of_streams, prometheus.run_prometheus_promql, prometheus.get_prometheus_label_values, prometheus.get_all_prometheus_labels, prometheus.get_labels_and_values_for_metric, tempo.run_tempo_query_trace]
-tool_node = ToolNode(tools)
+tools = [loki.run_loki_logql, loki.get_loki_label_values, loki.get_list_of_streams, loki.search_loki_labels, prometheus.run_prometheus_promql, prometheus.get_prometheus_label_values, prometheus.get_all_prometheus_labels, prometheus.get_labels_and_values_for_metric, prometheus.search_prometheus_metrics, tempo.run_tempo_query_trace]
 llm = ChatGoogleGenerativeAI(
     model=model,
     temperature=0,
     max_tokens=4096, # default: 8192
 )
-llm_with_tools = llm.bind_tools(tools)
+fast_llm = ChatGoogleGenerativeAI(
+    model=fast_model,
+    temperature=0,
+    max_tokens=4096,
+)
+
+# エージェントは共有のイベントループ上で非同期(ainvoke)に実行する。
+# 1ターンで複数のツール呼び出しがあった場合、ToolNodeが非同期版のツールを並列に実行する
+event_loop = asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, name="rca-event-loop", daemon=True).start()
+
+def run_async(coro):
+    """ワーカースレッドからコルーチンを共有イベントループで実行し、結果を待つ"""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
+async def _resume_point(agent, config: dict):
+    """
+    チェックポイントに途中までの調査が残っていれば (再開するか, 完了済みの最終State) を返す。
+    チェックポインタなし(ベンチマーク)・スレッドIDなしの場合は常に最初から調査する
+    """
+    if agent.checkpointer is None or "thread_id" not in config.get("configurable", {}):
+        return False, None
+    snapshot = await agent.aget_state(config)
+    if not snapshot.values.get("messages"):
+        return False, None
+    if not snapshot.next:
+        # 最後まで進んだが、完了を記録する前に中断されていた
+        return False, snapshot.values
+    print(f"[checkpoint] Resuming investigation {config['configurable']['thread_id']} ({len(snapshot.values['messages'])} messages, next: {snapshot.next})")
+    return True, None
+
+async def run_investigation(agent, inputs: dict, config: dict, stream: sinks.InvestigationStream = None) -> dict:
+    """
+    エージェントを1回の調査として実行し、ツールキャッシュのヒット/ミス数・o11y-toolのエンドポイントごとのレイテンシ・予算の使用量をLangfuseのトレースのメタデータに記録する。
+    集計用のcontextvarはこのコルーチンの中で設定するため、並行する他の調査とは混ざらない。
+    config["configurable"]["thread_id"]のチェックポイントが残っていれば、そこから調査を再開する。
+    streamを渡すと、グラフの各ステップの結果(モデルの考察・ツール呼び出し・ツール結果)を完了を待たずにシンクへ流す
+    """
+    resume, finished = await _resume_point(agent, config)
+    if finished is not None:
+        return finished
+    if resume:
+        snapshot = await agent.aget_state(config)
+        # 中断していた間(プロセスの停止から再開まで)は時間の予算に含めない
+        clock = budget.resumed_clock(snapshot.values)
+        if clock:
+            await agent.aupdate_state(config, clock)
+        if stream is not None:
+            # チェックポイントまでのメッセージは前回の実行でシンクに流しているため、再開後に流し直さない
+            stream.mark_published(snapshot.values["messages"])
+    with get_langfuse_client().start_as_current_span(name="rca-investigation") as span:
+        cache_stats = tool_cache.start_investigation()
+        latency_stats = http_client.start_investigation()
+        # ツールのクエリ対象期間はアラートの発生時刻を基準にする
+        query_window.set_alert_started_at(query_window.parse_alert_time(inputs.get("alert_starts_at", "")))
+        if replay.recorder is not None and not resume:
+            replay.recorder.start_investigation(inputs)
+        result = None
+        try:
+            # 再開する場合は入力を渡さず、チェックポイントの続きから実行する(完了済みのツール呼び出しは再実行されない)
+            # "updates"で各ステップの差分をシンクに流し、"values"の最後の値を最終Stateとして返す(ainvokeの戻り値と同じ)
+            async for mode, chunk in agent.astream(
+                None if resume else inputs,
+                config={**config, "callbacks": [langfuse_callback_handler()]},
+                stream_mode=["updates", "values"],
+            ):
+                if mode == "values":
+                    result = chunk
+                elif stream is not None:
+                    stream.update(chunk)
+            return result
+        finally:
+            stats = cache_stats.as_dict()
+            print(f"[tool_cache] investigation stats: {stats}")
+            metadata = {"tool_cache": stats, "http": latency_stats.as_dict()}
+            print(f"[http_client] investigation latency: {metadata['http']}")
+            if result is not None:
+                metadata["budget"] = budget.usage_summary(result)
+                print(f"[budget] investigation usage: {metadata['budget']}")
+            span.update_trace(metadata=metadata)
 
 summarize_prompt = """
 You are a conversation summarizer for an AI agent performing alert investigation and root cause analysis.
@@ -89,6 +178,97 @@ Avoid:
 Write the summary in clear, concise prose or structured bullet points. Prioritize information density while maintaining readability. The summary should allow the investigation to continue seamlessly without re-checking already verified items.
 """
 
+# システムプロンプトのテンプレート。アラートごとの値はモデル呼び出しの直前にStateから埋め込む
+system_prompt_template = """
+## Role
+You are a Root Cause Analysis (RCA) agent specialized in analyzing alerts from Grafana and investigating their causes using tools below.
+You have access to the following tools:
+1. run_loki_logql: Use this to execute LogQL queries to retrieve logs from Grafana Loki.
+    - By default it covers the time around the alert (from 1 hour before it started until 15 minutes after). Use `start`/`end` (e.g. `alert-6h`, `now-30m` or RFC3339) to look at other periods, and `direction`/`limit` to control which log lines are returned.
+    - The query is validated locally before it is sent to Loki. If it is invalid, the tool returns the error and usually a suggested fix; apply it and retry.
+    - Common mistakes: there is no `| limit`, `| sort` or `| tail` stage in LogQL; a selector must not be empty (`{{{{}}}}`) or match everything (use `=~".+"`, not `=~".*"`); a range such as `[5m]` is only valid inside functions like `count_over_time(...)`.
+    - OK LogQL example:
+        - `{{{{service_name=~".+"}}}} |= "c58ff9edaead7b757a3ae3411005945f"`
+        - `{{{{job=~".*varlogs.*"}}}} |= "error"`
+        - `count_over_time({{{{namespace="monitoring", service_name=~"clickhouse.*"}}}}[5m])`
+2. get_loki_label_values: Use this to get the values that a specific label has from Grafana Loki.
+3. get_list_of_streams: Use this to get the list of log streams in Grafana Loki.
+4. run_prometheus_promql: Use this to execute PromQL queries to retrieve metrics from Prometheus.
+    - Like run_loki_logql, it covers the time around the alert by default. Use `start`/`end` to look at other periods.
+    - The query is validated locally and its metric and label names are checked against Prometheus before it is sent. If it is invalid, the tool returns the error with similar names or a suggested fix.
+5. get_prometheus_label_values: Use this to get the values that a specific label has from Prometheus.
+6. get_all_prometheus_labels: Use this to get all labels that exist in Prometheus.
+7. get_labels_and_values_for_metric: Use this to get the labels and their values for a specific metric from Prometheus.
+8. run_tempo_query_trace: Use this to execute a trace query against Grafana Tempo.
+    -  The format of the trace ID is a 32-character hexadecimal string (e.g., "4bf92f3577b34da6a3ce929d0e0e4736", "98100898d812021273ec14bd273e4dda"). If you find a trace ID in the logs, get detailed trace information using this tool with the trace ID.
+9. search_loki_labels: Use this to search Loki label names related to keywords. The Loki Labels List below may only contain the labels relevant to the alert.
+10. search_prometheus_metrics: Use this to search Prometheus metric names related to keywords. The Metric List below may only contain the metrics relevant to the alert.
+
+## Available Information
+#### Alert Message
+{alert_message}
+#### Alert Occurred Time
+{alert_occurred_time}
+#### Loki Labels List
+{loki_labels}
+#### Metric List
+{metrics}
+"""
+
+@dynamic_prompt
+def rca_system_prompt(request: ModelRequest) -> str:
+    """RCAAgentStateに入っているアラート情報からシステムプロンプトを組み立てる"""
+    state = request.state
+    return system_prompt_template.format(
+        alert_message=state.get("alert_message", ""),
+        alert_occurred_time=state.get("alert_occurred_time", ""),
+        loki_labels=state.get("loki_labels_list", ""),
+        metrics=state.get("metric_list", ""),
+    )
+
+def build_agent(chat_model, summary_model, extra_middleware: list = None, checkpointer=None):
+    """RCAエージェント(コンパイル済みのグラフ)を構築する。benchmark.pyからは再生用のモデルを渡して使う"""
+    return create_agent(
+        model=chat_model,
+        tools=tools,
+        state_schema=state.RCAAgentState,
+        middleware=[
+            rca_system_prompt,
+            budget.BudgetMiddleware(),
+            SummarizationMiddleware(
+                model=summary_model,
+                trigger=("tokens", 4000),
+                keep=("messages", 5),
+                summary_prompt=summarize_prompt,
+                trim_tokens_to_summarize=2000,
+            ),
+            *(extra_middleware or []),
+        ],
+        checkpointer=checkpointer,
+    )
+
+_rca_agent = None
+_rca_agent_lock = threading.Lock()
+
+def get_rca_agent():
+    """
+    エージェント(コンパイル済みのグラフ)は1回だけ構築し、全アラートで使い回す(alert_receiverの起動時に構築する)。
+    アラートごとの値はStateに閉じているため、並行して実行しても干渉しない。
+    import時に構築しないのは、認証情報のないbenchmark.pyからもこのモジュールを使うため
+    """
+    global _rca_agent
+    with _rca_agent_lock:
+        if _rca_agent is None:
+            # RCA_REPLAY_MODE=recordの場合はモデルの応答も記録する(benchmark.py用)
+            # 記録するのはモデルの振り分け後の最終的な応答のみ(振り分けでやり直した応答は記録しない)
+            extra_middleware = [replay.ModelRecorder()] if replay.recorder is not None else []
+            extra_middleware.append(model_router.ModelRouterMiddleware(fast_llm, llm))
+            # 調査の途中経過はSQLiteに保存し、Podが再起動しても続きから再開できるようにする
+            # (aiosqliteの接続はエージェントを実行する共有イベントループの上で作る)
+            checkpointer = run_async(checkpoint_store.open_async_saver())
+            _rca_agent = build_agent(fast_llm, model, extra_middleware, checkpointer)
+    return _rca_agent
+
 @dataclass
 class AlertData:
     status: str
@@ -96,6 +276,8 @@ class AlertData:
     annotations: dict
     query: str
     log_message: str = ""
+    # アラートの発生時刻(GrafanaのstartsAt, RFC3339)。ツールのクエリ対象期間の基準になる
+    starts_at: str = ""
 
 def get_query_in_alert_from_grafana(generator_url: str) -> str:
     # print(f"[DEBUG] Original generatorURL: {generator_url}")
@@ -107,36 +289,17 @@ def get_query_in_alert_from_grafana(generator_url: str) -> str:
     try:
         alert_uid = generator_url.split("/")[-2]
         # print(f"[DEBUG] Extracted alert_uid: {alert_uid}")
-        SPECIFIC_ALERT_RULE_ENDPOINT = "http://grafana:3000/api/v1/provisioning/alert-rules/" + alert_uid
-        # print(f"[DEBUG] Constructed API Endpoint: {SPECIFIC_ALERT_RULE_ENDPOINT}")
     except IndexError as e:
         print("Invalid generatorURL format")
         raise e
 
     try:
-        headers = {
-            "Authorization": f"Bearer {grafana_api_key}",
-        }
-
-        response = requests.get(SPECIFIC_ALERT_RULE_ENDPOINT, headers=headers, timeout=5)
-        # print(f"[DEBUG] Response Status Code: {response.status_code}")
-        # print(f"[DEBUG] Response Body (first 500 chars): {response.text[:500]}")
-
-        response.raise_for_status()
-
-        # レスポンスが空でないか確認
-        if not response.text:
-            print("[Warning] Empty response from Grafana API")
-            return ""
-
-        try:
-            response_json = response.json()
-            # print(f"[DEBUG] Parsed JSON Response: {json.dumps(response_json, indent=2)}")
-        except ValueError as e:
-            print(f"[Warning] Failed to parse JSON response: {e}")
+        # ルール定義はUIDごとにキャッシュし、TTL切れの場合のみGrafanaに再検証する
+        rule = alert_rule_cache.cache.get(alert_uid)
+        if rule is None:
             return ""
 
-        queries = ", ".join([d["model"]["expr"] for d in response_json["data"] if "expr" in d["model"]])
+        queries = alert_rule_cache.extract_queries(rule)
         # print(f"[DEBUG] Extracted Queries: {queries}")
         return queries
     except requests.RequestException as e:
@@ -157,80 +320,56 @@ def extract_alert_info(alert_data: dict) -> str:
         annotations=annotations,
         query=query,
         log_message=log_message,
+        starts_at=alert_data.get("startsAt", ""),
     )
     # print(f"Extracted Alert Info: {alert_info}")
-    result = start_alert_cause_analysis(alert_info)
+    result = start_alert_cause_analysis(alert_info, raw_alert=alert_data)
     return result
 
-def start_alert_cause_analysis(alert: AlertData) -> str:
-    # 動的にシステムプロンプトを生成
-    alert_message = f"AlertName: {alert.labels.get('alertname')}\nLabels: {alert.labels}\nAnnotations: {alert.annotations}\nQuery: {alert.query}\nLog Message: {alert.log_message}"
-    alert_occurred_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    loki_labels = loki.get_all_loki_labels()
-    metrics = prometheus.get_all_metrics()
-
-    system_prompt = f"""
-## Role
-You are a Root Cause Analysis (RCA) agent specialized in analyzing alerts from Grafana and investigating their causes using tools below.
-You have access to the following tools:
-1. run_loki_logql: Use this to execute LogQL queries to retrieve logs from Grafana Loki.
-    - NG LogQL example:
-        - `{{{{otelTraceID="c58ff9edaead7b757a3ae3411005945f"}}}}` # Missing curly braces around the selector
-        - `{{{{job="varlogs"}}}} |= "error" | limit 10` # there is no 'limit' clause in LogQL
-        - `{{{{namespace="monitoring", service_name="clickhouse"}}}} | tail` # there is no 'tail' clause in LogQL
-        - `{{{{app="nginx"}}}} | sort` # there is no 'sort' clause in LogQL
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} | sort @timestamp desc | limit 10` # there is no 'limit' or 'sort' clause in LogQL
-        - `{{{{}}}} |~ "be8af83da40279d7f9cfb2bb256009fb"` # labels(selector) are required in LogQL queries
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} | count_over_time([5m])` # wrong `count_over_time` usage
-        - `count_over_time({{{{namespace="monitoring"}}}}[1h]) by (pod)` # by clause is not supported in `count_over_time`
-        - `{{{{service_name=~".*"}}}} |~ "d49cfc23a353cd76f4c8244c373b2b01"` # When using the =~ operator, you cannot specify only ".*" without any other characters. If you want to specify everything without characters, please specify ".+" instead.
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} |~ "error|warn|fail" [1h]` # Wrong usage of range selector (e.g., [1h]); requires `count_over_time` or other functions
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} [30m]` # Wrong usage of range selector (e.g., [30m]); requires `count_over_time` or other functions
-    - OK LogQL example:
-        - `{{{{service_name=~".+"}}}} |= "c58ff9edaead7b757a3ae3411005945f"`
-        - `{{{{job=~".*varlogs.*"}}}} |= "error"`
-        - `count_over_time({{{{namespace="monitoring", service_name=~"clickhouse.*"}}}}[5m])`
-2. get_loki_label_values: Use this to get the values that a specific label has from Grafana Loki.
-3. get_list_of_streams: Use this to get the list of log streams in Grafana Loki.
-4. run_prometheus_promql: Use this to execute PromQL queries to retrieve metrics from Prometheus.
-5. get_prometheus_label_values: Use this to get the values that a specific label has from Prometheus.
-6. get_all_prometheus_labels: Use this to get all labels that exist in Prometheus.
-7. get_labels_and_values_for_metric: Use this to get the labels and their values for a specific metric from Prometheus.
-8. run_tempo_query_trace: Use this to execute a trace query against Grafana Tempo.
-    -  The format of the trace ID is a 32-character hexadecimal string (e.g., "4bf92f3577b34da6a3ce929d0e0e4736", "98100898d812021273ec14bd273e4dda"). If you find a trace ID in the logs, get detailed trace information using this tool with the trace ID.
-
-## Available Information
-#### Alert Message
-{alert_message}
-#### Alert Occurred Time
-{alert_occurred_time}
-#### Loki Labels List
-{loki_labels}
-#### Metric List
-{metrics}
-"""
+def start_alert_cause_analysis(alert: AlertData, raw_alert: dict = None) -> str:
+    # 同じアラートの同じ発火は同じスレッドIDになる。完了済みなら保存した結果を返し、中断されていれば続きから再開する
+    thread_id = checkpoint_store.thread_id_for(alert.labels, alert.starts_at)
+    record = checkpoint_store.store.get(thread_id)
+    if record is not None and record["status"] == checkpoint_store.COMPLETED:
+        print(f"[checkpoint] Investigation {thread_id} has already been completed. Returning the saved result.")
+        return record["result"]
+    checkpoint_store.store.start(thread_id, raw_alert or asdict(alert))
 
-    agent = create_agent(
-        model=llm,
-        tools=tools,
-        system_prompt=system_prompt,
-        state_schema=state.RCAAgentState,
-        middleware=[
-            SummarizationMiddleware(
-                model=model,
-                trigger=("tokens", 4000),
-                keep=("messages", 5),
-                summary_prompt=summarize_prompt,
-                trim_tokens_to_summarize=2000,
-            ),
-        ],
-    )
-    result = agent.invoke({
-        "messages": [{"role": "user", "content": "analyze what is alert cause."}],
-        "alert_message": alert_message,
-        "alert_occurred_time": alert_occurred_time,
-        "metric_list": metrics,
-        "loki_labels_list": loki_labels,
-    }, config={"recursion_limit": 120, "callbacks": [langfuse_callback_handler()]})
-
-    return result["messages"][-1].content
\ No newline at end of file
+    # アラートごとの情報はグラフの構築ではなく、Stateとしてエージェントに渡す
+    alert_message = f"AlertName: {alert.labels.get('alertname')}\nLabels: {alert.labels}\nAnnotations: {alert.annotations}\nQuery: {alert.query}\nLog Message: {alert.log_message}"
+    started_at = query_window.parse_alert_time(alert.starts_at)
+    if started_at is not None:
+        alert_occurred_time = f"{started_at.astimezone().strftime('%Y-%m-%d %H:%M:%S')} ({started_at.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')})"
+    else:
+        alert_occurred_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    # ラベル一覧・メトリクス一覧はキャッシュから取得する(毎回のHTTPリクエストを避ける)
+    # 全件ではなく、アラートに関連するラベル・メトリクスだけをプロンプトに載せる
+    loki_labels = catalogue.get_relevant_loki_labels_text(alert_message)
+    metrics = catalogue.get_relevant_metrics_text(alert_message)
+
+    rca_agent = get_rca_agent()
+    config = {"recursion_limit": 120, "configurable": {"thread_id": thread_id}}
+    stream = sinks.InvestigationStream(thread_id, alert.labels.get("alertname", ""))
+    stream.started(alert_message)
+    try:
+        result = run_async(run_investigation(rca_agent, {
+            "messages": [{"role": "user", "content": "analyze what is alert cause."}],
+            "alert_message": alert_message,
+            "alert_occurred_time": alert_occurred_time,
+            "alert_starts_at": alert.starts_at,
+            "metric_list": metrics,
+            "loki_labels_list": loki_labels,
+            # 調査の予算(トークン数・時間・ツール呼び出し数)はseverityごとに変える
+            "severity": alert.labels.get("severity", ""),
+        }, config=config, stream=stream))
+    except Exception as e:
+        checkpoint_store.store.fail(thread_id, repr(e))
+        stream.failed(repr(e))
+        raise
+
+    answer = result["messages"][-1].content
+    checkpoint_store.store.complete(thread_id, answer)
+    stream.finished(result["messages"][-1].text)
+    # 完了した調査のチェックポイントは不要なので削除する(結果はinvestigationsテーブルに残る)
+    run_async(rca_agent.checkpointer.adelete_thread(thread_id))
+    return answer
@@ -1,12 +1,37 @@
 ## GrafanaのWebhookアラートを受け取るサーバ
 import http.server
-import socketserver
 import json
+import os
 import urllib.parse
 from datetime import datetime
 
 ## ローカルモジュールのimport
 import agent
+import alert_rule_cache
+import catalogue
+import checkpoint_store
+import dedup
+import http_client
+import sinks
+import tool_cache
+import worker_pool
+
+# キューが満杯の時にGrafanaへ再送を促すまでの秒数
+RETRY_AFTER_SECONDS = int(os.getenv("RCA_RETRY_AFTER_SECONDS", "30"))
+
+def analyze_alert(alert: dict):
+    """ワーカースレッド上で1件のアラートを分析する"""
+    fingerprint = dedup.alert_fingerprint(alert)
+    try:
+        result = agent.extract_alert_info(alert)
+    except Exception as e:
+        deduplicator.fail(fingerprint, e)
+        raise
+    deduplicator.complete(fingerprint, result)
+    print(f"★Alert Analysis Result:\n {json.dumps(result, indent=2, ensure_ascii=False)}")
+
+deduplicator = dedup.AlertDeduplicator()
+pool = worker_pool.AlertWorkerPool(analyze_alert)
 
 class WebhookHandler(http.server.BaseHTTPRequestHandler):
 
@@ -27,7 +52,7 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            response = {"status": "healthy"}
+            response = {"status": "healthy", "queue": pool.stats(), "dedup": deduplicator.stats(), "tool_cache": tool_cache.cache.stats(), "http": http_client.latency_stats.as_dict(), "alert_rules": alert_rule_cache.cache.stats(), "investigations": checkpoint_store.store.stats(), "sinks": sinks.dispatcher.stats()}
             self.wfile.write(json.dumps(response).encode())
         else:
             self.send_error(404, "Not Found")
@@ -39,6 +64,9 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             content_length = int(self.headers.get('Content-Length', 0))
 
             print(f"\n=== Webhook受信 ({datetime.now()}) ===")
+            accepted = 0
+            rejected = 0
+            coalesced = 0
             # print(f"[DEBUG] Headers: {json.dumps(headers, indent=2, ensure_ascii=False)}")
 
             # POSTデータを読み取り
@@ -55,11 +83,22 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
                         # print(f"[DEBUG] JSON Data: {json.dumps(data, indent=2, ensure_ascii=False)}")
                         for alert in data.get("alerts", []):
                             print(f"status: {alert.get('status')}, labels: {alert.get('labels')}, annotations: {alert.get('annotations')}")
-                            try:
-                                result = agent.extract_alert_info(alert)
-                                print(f"★Alert Analysis Result:\n {json.dumps(result, indent=2, ensure_ascii=False)}")
-                            except Exception as e:
-                                print(f"Alert分析中にエラーが発生しました: {e}")
+                            decision, investigation = deduplicator.register(alert)
+                            if decision == dedup.RESOLVED:
+                                print("resolvedの通知のため分析をスキップします")
+                                continue
+                            if decision == dedup.DUPLICATE:
+                                coalesced += 1
+                                print(f"[dedup] {investigation.fingerprint}: 同じアラートの分析が既に存在するため集約します (再送 {investigation.duplicates} 件目)")
+                                continue
+
+                            # 分析はワーカープールに任せ、Webhookには即座に応答する
+                            if pool.submit(alert):
+                                accepted += 1
+                            else:
+                                deduplicator.discard(investigation.fingerprint)
+                                rejected += 1
+                                print(f"キューが満杯のためアラートを受け付けられませんでした: {alert.get('labels')}")
                     except json.JSONDecodeError:
                         print(f"JSON解析エラー - Raw Data: {post_data.decode('utf-8')}")
 
@@ -69,11 +108,21 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             else:
                 print("No POST data received")
 
+            # キューが溢れた場合は503を返し、Grafana側で再送してもらう(バックプレッシャー)
+            if rejected > 0:
+                self.send_response(503)
+                self.send_header('Content-type', 'application/json')
+                self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+                self.end_headers()
+                response = {"status": "busy", "accepted": accepted, "rejected": rejected, "coalesced": coalesced, "queue": pool.stats()}
+                self.wfile.write(json.dumps(response).encode())
+                return
+
             # 成功レスポンスを返す
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            response = {"status": "received"}
+            response = {"status": "received", "accepted": accepted, "coalesced": coalesced, "queue": pool.stats()}
             self.wfile.write(json.dumps(response).encode())
 
         except Exception as e:
@@ -84,9 +133,31 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
         """ログメッセージをカスタマイズ（不要なログを抑制）"""
         pass
 
+def resume_interrupted_investigations():
+    """前回の起動中に中断された調査を、チェックポイントの続きから再開するためにキューに積み直す"""
+    for record in checkpoint_store.store.interrupted():
+        alert = record["alert"]
+        decision, _ = deduplicator.register(alert)
+        if decision != dedup.NEW:
+            continue
+        if pool.submit(alert):
+            print(f"[checkpoint] Resuming interrupted investigation {record['thread_id']}: {alert.get('labels')}")
+        else:
+            deduplicator.discard(dedup.alert_fingerprint(alert))
+            print(f"[checkpoint] Queue is full. Investigation {record['thread_id']} will be resumed when the alert is sent again.")
+
 def run_server(port=8089):
     """サーバを起動"""
-    with socketserver.TCPServer(("", port), WebhookHandler) as httpd:
+    pool.start()
+    # ラベル一覧・メトリクス一覧を起動時に先読みし、以降は裏で定期更新する
+    catalogue.start_background_refresh()
+    # アラートルールの定義も起動時に先読みし、アラートごとのGrafana APIの呼び出しを省く
+    alert_rule_cache.start_background_prefetch()
+    # エージェントのグラフは最初のアラートを待たずに構築しておく
+    agent.get_rca_agent()
+    resume_interrupted_investigations()
+    # リクエストごとにスレッドを割り当て、分析中でも/healthや次のWebhookに応答できるようにする
+    with http.server.ThreadingHTTPServer(("", port), WebhookHandler) as httpd:
         print(f"Webhookサーバを起動中...")
         print(f"エンドポイント: http://localhost:{port}/webhook")
         print(f"ヘルスチェック: http://localhost:{port}/health")
@@ -96,6 +167,7 @@ def run_server(port=8089):
         except KeyboardInterrupt:
             print("\nサーバを停止中...")
             httpd.shutdown()
+            pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     run_server(8089)
\ No newline at end of file
@@ -0,0 +1,120 @@
+## Grafanaのアラートルール定義のキャッシュ
+## ルールの定義は発火のたびに変わることはほぼないため、アラートごとにGrafana APIを叩かずにルールUIDをキーにメモリに保持する。
+## - TTLが切れたエントリはETag(If-None-Match)で再検証し、変更がなければ(304)そのまま使い続ける
+## - 起動時に一覧API(/api/v1/provisioning/alert-rules)で全ルールを先読みできる
+## - 再検証に失敗した場合は古い定義を使い続ける
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+
+GRAFANA_URL = os.getenv("GRAFANA_URL", "http://grafana:3000")
+ALERT_RULES_ENDPOINT = f"{GRAFANA_URL}/api/v1/provisioning/alert-rules"
+ALERT_RULE_CACHE_TTL_SECONDS = int(os.getenv("ALERT_RULE_CACHE_TTL_SECONDS", "600"))
+# 起動時に全ルールを先読みするか
+ALERT_RULE_PREFETCH = os.getenv("ALERT_RULE_PREFETCH", "true").lower() == "true"
+GRAFANA_TIMEOUT_SECONDS = 5
+
+@dataclass
+class CachedRule:
+    rule: dict
+    etag: str | None
+    expires_at: float
+
+def _headers() -> dict:
+    # .envはimport後に読み込まれるため、APIキーはリクエストのたびに環境変数から取得する
+    return {"Authorization": f"Bearer {os.getenv('GRAFANA_API_KEY')}"}
+
+def extract_queries(rule: dict) -> str:
+    """アラートルールの定義から、クエリ(expr)をカンマ区切りで取り出す"""
+    return ", ".join([d["model"]["expr"] for d in rule.get("data", []) if "expr" in d.get("model", {})])
+
+class AlertRuleCache:
+
+    def __init__(self, ttl_seconds: int = ALERT_RULE_CACHE_TTL_SECONDS):
+        self._ttl = ttl_seconds
+        self._rules = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._counts = {"hit": 0, "revalidated": 0, "fetched": 0, "stale": 0}
+
+    def get(self, uid: str) -> dict | None:
+        """
+        UIDのルール定義を返す。レスポンスが空・JSONでない場合はNoneを返す(キャッシュしない)。
+        取得に失敗し、古い定義もない場合はrequests.RequestExceptionを投げる
+        """
+        with self._lock:
+            cached = self._rules.get(uid)
+            if cached is not None and cached.expires_at > time.time():
+                self._counts["hit"] += 1
+                return cached.rule
+
+        headers = _headers()
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        try:
+            response = self._session.get(f"{ALERT_RULES_ENDPOINT}/{uid}", headers=headers, timeout=GRAFANA_TIMEOUT_SECONDS)
+            if response.status_code == 304 and cached is not None:
+                self._store(uid, cached.rule, cached.etag, "revalidated")
+                return cached.rule
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+            print(f"[alert_rule_cache] Failed to revalidate rule {uid}, using the cached definition. Error: {repr(e)}")
+            self._store(uid, cached.rule, cached.etag, "stale")
+            return cached.rule
+
+        # レスポンスが空でないか確認
+        if not response.text:
+            print("[Warning] Empty response from Grafana API")
+            return None
+        try:
+            rule = response.json()
+        except ValueError as e:
+            print(f"[Warning] Failed to parse JSON response: {e}")
+            return None
+
+        self._store(uid, rule, response.headers.get("ETag"), "fetched")
+        return rule
+
+    def prefetch(self) -> int:
+        """一覧APIで全ルールを取得してキャッシュに入れる。取得したルール数を返す"""
+        response = self._session.get(ALERT_RULES_ENDPOINT, headers=_headers(), timeout=GRAFANA_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        rules = response.json()
+        for rule in rules:
+            if rule.get("uid"):
+                # 一覧APIではルールごとのETagが得られないため、TTL切れ後は通常の取得になる
+                self._store(rule["uid"], rule, None, None)
+        return len(rules)
+
+    def _store(self, uid: str, rule: dict, etag: str | None, outcome: str | None):
+        with self._lock:
+            self._rules[uid] = CachedRule(rule=rule, etag=etag, expires_at=time.time() + self._ttl)
+            if outcome is not None:
+                self._counts[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counts, "rules": len(self._rules)}
+
+cache = AlertRuleCache()
+
+def start_background_prefetch():
+    """起動時に全ルールを裏で先読みする(ALERT_RULE_PREFETCHがfalseの場合は何もしない)"""
+    if not ALERT_RULE_PREFETCH:
+        return
+
+    def run():
+        started = time.time()
+        try:
+            count = cache.prefetch()
+            print(f"[alert_rule_cache] Prefetched {count} alert rules ({time.time() - started:.2f}s)")
+        except (requests.RequestException, ValueError) as e:
+            print(f"[alert_rule_cache] Failed to prefetch alert rules. Error: {repr(e)}")
+
+    threading.Thread(target=run, name="alert-rule-prefetch", daemon=True).start()
@@ -0,0 +1,78 @@
+## 記録した調査(replay.py)をネットワークなしで再生するベンチマーク
+## 使い方:
+##   1. RCA_REPLAY_MODE=record RCA_REPLAY_FIXTURE=fixture.jsonl で alert_receiver.py を起動し、実際のアラートを分析させる
+##   2. python benchmark.py fixture.jsonl [--replay-latency] [--json result.json]
+## モデルは記録した応答(ツール呼び出し)を順番に返すスタンドインに、o11y-toolへのリクエストは記録したレスポンスに置き換え、
+## 調査ごとに実行時間・ターン数・ツール呼び出し数・入出力トークン数・要約の実行回数を出力する
+import argparse
+import json
+import os
+import time
+
+# ネットワークなしで実行するため、エージェントのimport時に必要な設定はダミーで埋め、トレースは送らない
+os.environ["LANGFUSE_TRACING_ENABLED"] = "false"
+for key in ("LANGFUSE_SECRET_KEY", "LANGFUSE_PUBLIC_KEY", "GOOGLE_API_KEY", "GOOGLE_CLOUD_PROJECT"):
+    os.environ.setdefault(key, "replay")
+os.environ.setdefault("LANGFUSE_BASE_URL", "http://localhost")
+
+import agent
+import replay
+import tool_cache
+
+def run_one(investigation: dict, replay_latency: bool) -> dict:
+    chat_model = replay.ReplayChatModel(responses=investigation["model"], replay_latency=replay_latency)
+    summary_model = replay.CountingSummaryModel()
+    rca_agent = agent.build_agent(chat_model, summary_model)
+    player = replay.Player(investigation["http"], replay_latency=replay_latency)
+
+    # 調査ごとに独立して計測するため、ツールキャッシュは空の状態から始める
+    tool_cache.cache.clear()
+    replay.player = player
+    started = time.perf_counter()
+    try:
+        agent.run_async(agent.run_investigation(rca_agent, investigation["inputs"], config={"recursion_limit": 120}))
+    finally:
+        replay.player = None
+    wall_time = time.perf_counter() - started
+
+    return {
+        "investigation": investigation["id"],
+        "wall_time_seconds": round(wall_time, 3),
+        "turns": chat_model.calls,
+        "tool_calls": chat_model.tool_calls,
+        "http_requests": player.requests,
+        "input_tokens": chat_model.input_tokens,
+        "output_tokens": chat_model.output_tokens,
+        "summarizations": summary_model.calls,
+        # 記録にないリクエスト・応答があった場合は、エージェントの変更で挙動が記録時から変わっている
+        "unrecorded_requests": player.misses,
+        "model_responses_exhausted": chat_model.exhausted,
+    }
+
+def print_report(results: list):
+    columns = ["investigation", "wall_time_seconds", "turns", "tool_calls", "http_requests", "input_tokens", "output_tokens", "summarizations", "unrecorded_requests"]
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[c])[:12] if c == "investigation" else str(result[c]) for c in columns))
+    if results:
+        totals = {c: sum(r[c] for r in results) for c in columns[1:]}
+        print(" | ".join(["TOTAL"] + [str(round(totals[c], 3)) for c in columns[1:]]))
+    diverged = [r["investigation"] for r in results if r["unrecorded_requests"] or r["model_responses_exhausted"]]
+    if diverged:
+        print(f"[Warning] {len(diverged)} investigations diverged from the recording: {', '.join(diverged)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded RCA investigations offline and report their cost.")
+    parser.add_argument("fixture", help="JSONL file recorded with RCA_REPLAY_MODE=record")
+    parser.add_argument("--replay-latency", action="store_true", help="sleep for the recorded model/HTTP latencies")
+    parser.add_argument("--json", help="write the results to this file as JSON")
+    args = parser.parse_args()
+
+    results = [run_one(investigation, args.replay_latency) for investigation in replay.load_fixture(args.fixture)]
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
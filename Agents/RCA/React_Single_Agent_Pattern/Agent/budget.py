@@ -0,0 +1,168 @@
+## 調査ごとの予算(トークン数・経過時間・ツール呼び出し数)の管理
+## 1件の分かりにくいアラートで何分も・何十万トークンも使い続けないよう、予算を超えた時点で
+## ツールを外したモデル呼び出しを行い、それまでの調査結果から途中経過のレポートを書かせて調査を終える。
+## 予算はアラートのseverityラベルごとに環境変数で設定できる
+##   RCA_BUDGET_MAX_TOKENS_CRITICAL=400000 のように RCA_BUDGET_<項目>_<SEVERITY> で指定し、
+##   なければ RCA_BUDGET_<項目>、それもなければDEFAULT_BUDGETSの値を使う
+import os
+import time
+from dataclasses import dataclass
+from typing import NotRequired
+
+from langchain.agents import AgentState
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import AIMessage, HumanMessage
+
+@dataclass(frozen=True)
+class Budget:
+    max_tokens: int
+    max_seconds: float
+    max_tool_calls: int
+
+DEFAULT_BUDGETS = {
+    "critical": Budget(max_tokens=400_000, max_seconds=900, max_tool_calls=60),
+    "warning": Budget(max_tokens=200_000, max_seconds=480, max_tool_calls=40),
+    "info": Budget(max_tokens=100_000, max_seconds=240, max_tool_calls=20),
+}
+DEFAULT_BUDGET = Budget(max_tokens=200_000, max_seconds=480, max_tool_calls=40)
+
+FINAL_ANSWER_INSTRUCTION = """The investigation budget has been exhausted ({reason}). You can no longer use any tools.
+Write the final RCA report now, based only on the evidence gathered so far. Start the report with "[Partial report: investigation budget exhausted]" and include:
+- The most likely root cause(s), with your confidence and the supporting evidence
+- What was ruled out
+- What remains unverified, and the next queries an engineer should run to confirm the cause"""
+
+def _env_limit(name: str, severity: str, default, cast):
+    for key in (f"RCA_BUDGET_{name}_{severity.upper()}", f"RCA_BUDGET_{name}"):
+        value = os.getenv(key)
+        if value:
+            return cast(value)
+    return default
+
+def budget_for(severity: str) -> Budget:
+    severity = (severity or "").lower()
+    default = DEFAULT_BUDGETS.get(severity, DEFAULT_BUDGET)
+    return Budget(
+        max_tokens=_env_limit("MAX_TOKENS", severity or "default", default.max_tokens, int),
+        max_seconds=_env_limit("MAX_SECONDS", severity or "default", default.max_seconds, float),
+        max_tool_calls=_env_limit("MAX_TOOL_CALLS", severity or "default", default.max_tool_calls, int),
+    )
+
+class BudgetState(AgentState):
+    severity: NotRequired[str]
+    budget_started_at: NotRequired[float]
+    # 最後にモデルが応答した時刻(中断からの再開時に、中断していた時間を経過時間から除くため)
+    budget_last_active_at: NotRequired[float]
+    budget_input_tokens: NotRequired[int]
+    budget_output_tokens: NotRequired[int]
+    budget_tool_calls: NotRequired[int]
+    # 予算を超えた理由(超えていなければ空)
+    budget_exhausted: NotRequired[str]
+
+def exceeded_reason(state: dict) -> str:
+    """予算を超えていればその理由を、超えていなければ空文字列を返す"""
+    budget = budget_for(state.get("severity", ""))
+    tokens = state.get("budget_input_tokens", 0) + state.get("budget_output_tokens", 0)
+    elapsed = time.time() - state.get("budget_started_at", time.time())
+    tool_calls = state.get("budget_tool_calls", 0)
+
+    if tokens >= budget.max_tokens:
+        return f"token budget {tokens}/{budget.max_tokens}"
+    if elapsed >= budget.max_seconds:
+        return f"time budget {elapsed:.0f}s/{budget.max_seconds:.0f}s"
+    if tool_calls >= budget.max_tool_calls:
+        return f"tool call budget {tool_calls}/{budget.max_tool_calls}"
+    return ""
+
+def usage_summary(state: dict) -> dict:
+    return {
+        "severity": state.get("severity", ""),
+        "input_tokens": state.get("budget_input_tokens", 0),
+        "output_tokens": state.get("budget_output_tokens", 0),
+        "tool_calls": state.get("budget_tool_calls", 0),
+        "elapsed_seconds": round(time.time() - state.get("budget_started_at", time.time()), 1),
+        "exhausted": state.get("budget_exhausted", ""),
+    }
+
+def resumed_clock(state: dict) -> dict:
+    """
+    チェックポイントから再開する調査の経過時間の起点を、中断していた時間(最後のモデルの応答から再開まで)だけ後ろにずらすStateの更新。
+    プロセスが止まっていた間を時間の予算に含めないため
+    """
+    started_at = state.get("budget_started_at")
+    if started_at is None:
+        return {}
+    now = time.time()
+    active_seconds = state.get("budget_last_active_at", started_at) - started_at
+    return {"budget_started_at": now - active_seconds, "budget_last_active_at": now}
+
+class BudgetMiddleware(AgentMiddleware):
+    """
+    モデルの応答ごとにトークン数・ツール呼び出し数をStateに積算し、
+    予算を超えていればツールなしで最終回答を書かせる
+    """
+
+    state_schema = BudgetState
+
+    def before_agent(self, state, runtime):
+        if "budget_started_at" in state:
+            # チェックポイントから再開した場合は、それまでの使用量を引き継ぐ(経過時間はresumed_clockで中断した分をずらす)
+            return None
+        now = time.time()
+        return {
+            "budget_started_at": now,
+            "budget_last_active_at": now,
+            "budget_input_tokens": 0,
+            "budget_output_tokens": 0,
+            "budget_tool_calls": 0,
+            "budget_exhausted": "",
+        }
+
+    async def abefore_agent(self, state, runtime):
+        return self.before_agent(state, runtime)
+
+    def after_model(self, state, runtime):
+        message = state["messages"][-1]
+        if not isinstance(message, AIMessage):
+            return None
+        usage = message.usage_metadata or {}
+        # model_routerがやり直しのために捨てた応答の分も計上する
+        discarded = message.response_metadata.get("discarded_usage", {})
+        return {
+            "budget_input_tokens": state.get("budget_input_tokens", 0) + usage.get("input_tokens", 0) + discarded.get("input_tokens", 0),
+            "budget_output_tokens": state.get("budget_output_tokens", 0) + usage.get("output_tokens", 0) + discarded.get("output_tokens", 0),
+            "budget_tool_calls": state.get("budget_tool_calls", 0) + len(message.tool_calls),
+            "budget_last_active_at": time.time(),
+            "budget_exhausted": message.response_metadata.get("budget_exhausted", state.get("budget_exhausted", "")),
+        }
+
+    async def aafter_model(self, state, runtime):
+        return self.after_model(state, runtime)
+
+    def _final_answer_request(self, request):
+        reason = exceeded_reason(request.state)
+        if not reason:
+            return request, ""
+        print(f"[budget] Budget exhausted ({reason}). Forcing the final answer.")
+        instruction = HumanMessage(content=FINAL_ANSWER_INSTRUCTION.format(reason=reason))
+        return request.override(tools=[], messages=[*request.messages, instruction]), reason
+
+    def wrap_model_call(self, request, handler):
+        request, reason = self._final_answer_request(request)
+        response = handler(request)
+        return self._mark_exhausted(response, reason)
+
+    async def awrap_model_call(self, request, handler):
+        request, reason = self._final_answer_request(request)
+        response = await handler(request)
+        return self._mark_exhausted(response, reason)
+
+    def _mark_exhausted(self, response, reason: str):
+        if reason:
+            # 最終回答のメタデータに理由を残し、呼び出し側・トレースから途中経過のレポートであることが分かるようにする
+            for message in response.result:
+                if isinstance(message, AIMessage):
+                    message.response_metadata["budget_exhausted"] = reason
+                    # ツールを外しても呼び出しを返してきた場合は捨て、必ずこのターンで調査を終わらせる
+                    message.tool_calls = []
+        return response
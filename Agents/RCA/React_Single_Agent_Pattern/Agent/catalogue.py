@@ -0,0 +1,136 @@
+## Lokiのラベル一覧とPrometheusのメトリクス一覧のキャッシュ
+## システムプロンプトを作るたびに取得し直さないよう、TTL付きでメモリに保持する。
+## TTLが切れた後も古い値をすぐに返し、裏で更新する(stale-while-revalidate)
+import os
+import threading
+import time
+
+import catalogue_index
+import loki
+import prometheus
+
+CATALOGUE_TTL_SECONDS = int(os.getenv("CATALOGUE_TTL_SECONDS", "300"))
+# システムプロンプトに載せる名前の最大数(これを超える場合はアラートに関連するものだけを載せる)
+CATALOGUE_TOP_N = int(os.getenv("CATALOGUE_TOP_N", "50"))
+
+class CatalogueCache:
+
+    def __init__(self, name: str, loader, ttl_seconds: int = CATALOGUE_TTL_SECONDS):
+        self.name = name
+        self._loader = loader
+        self._ttl = ttl_seconds
+        self._value = None
+        self._index = None
+        self._fetched_at = 0.0
+        self._last_error = None
+        self._load_lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self) -> list:
+        """キャッシュ済みの一覧を返す。未取得の場合のみ同期的に取得する"""
+        if self._value is None:
+            self.refresh(force=False)
+        elif time.time() - self._fetched_at > self._ttl:
+            self._refresh_in_background()
+        return self._value or []
+
+    def search(self, text: str, top_n: int = CATALOGUE_TOP_N) -> list:
+        """textに関連する名前を関連度の高い順に返す"""
+        self.get()
+        index = self._index
+        if index is None:
+            return []
+        return index.search(text, top_n)
+
+    def peek_index(self) -> "catalogue_index.NameIndex | None":
+        """
+        取得済みの一覧の検索インデックスを返す。未取得の場合は取得を待たずにNoneを返し、裏で取得を始める。
+        イベントループ上で呼ばれる処理(PromQLの検証など)が同期的な取得でブロックしないようにするため
+        """
+        if self._index is None or time.time() - self._fetched_at > self._ttl:
+            self._refresh_in_background()
+        return self._index
+
+    @property
+    def last_error(self):
+        return self._last_error
+
+    def refresh(self, force: bool = True):
+        with self._load_lock:
+            # 初回取得を複数スレッドが待っていた場合、先に取得し終えていれば何もしない
+            if not force and self._value is not None:
+                return
+            started = time.time()
+            try:
+                value = self._loader()
+            except Exception as e:
+                # 取得に失敗しても古い値は捨てずに使い続ける
+                self._last_error = e
+                print(f"[catalogue] Failed to refresh {self.name}. Error: {repr(e)}")
+                return
+            # 検索インデックスも取得時に作っておき、プロンプト作成時には検索だけで済むようにする
+            self._index = catalogue_index.NameIndex(value)
+            self._value = value
+            self._fetched_at = time.time()
+            self._last_error = None
+            print(f"[catalogue] Refreshed {self.name}: {len(value)} items ({time.time() - started:.2f}s)")
+
+    def _refresh_in_background(self):
+        with self._flag_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name=f"catalogue-{self.name}", daemon=True).start()
+
+loki_labels = CatalogueCache("loki_labels", lambda: loki.fetch_all_loki_labels())
+metrics = CatalogueCache("metrics", lambda: prometheus.fetch_all_metrics())
+# PromQLの検証(promql_validator.py)でラベル名の存在確認に使う
+prometheus_labels = CatalogueCache("prometheus_labels", lambda: prometheus.fetch_all_labels())
+
+def get_loki_labels_text() -> str:
+    labels = loki_labels.get()
+    if not labels and loki_labels.last_error is not None:
+        return f"Failed to get labels from Loki. Error: {repr(loki_labels.last_error)}"
+    return ", ".join(labels)
+
+def get_metrics_text() -> str:
+    names = metrics.get()
+    if not names and metrics.last_error is not None:
+        return f"Failed to get metrics from Prometheus. Error: {repr(metrics.last_error)}"
+    return ", ".join(names)
+
+def _relevant_text(cache: CatalogueCache, alert_text: str, top_n: int, kind: str, search_tool: str) -> str:
+    names = cache.get()
+    if len(names) <= top_n:
+        return ", ".join(names)
+    relevant = cache.search(alert_text, top_n)
+    return f"{', '.join(relevant)}\n(Showing {len(relevant)} of {len(names)} {kind} relevant to this alert. Use `{search_tool}` to find other {kind}.)"
+
+def get_relevant_loki_labels_text(alert_text: str, top_n: int = CATALOGUE_TOP_N) -> str:
+    if not loki_labels.get() and loki_labels.last_error is not None:
+        return get_loki_labels_text()
+    return _relevant_text(loki_labels, alert_text, top_n, "labels", "search_loki_labels")
+
+def get_relevant_metrics_text(alert_text: str, top_n: int = CATALOGUE_TOP_N) -> str:
+    if not metrics.get() and metrics.last_error is not None:
+        return get_metrics_text()
+    return _relevant_text(metrics, alert_text, top_n, "metrics", "search_prometheus_metrics")
+
+def start_background_refresh():
+    """起動時に一覧を先読みし、以降はTTLごとに裏で更新し続ける"""
+
+    def run():
+        while True:
+            for cache in (loki_labels, metrics, prometheus_labels):
+                cache.refresh()
+            time.sleep(CATALOGUE_TTL_SECONDS)
+
+    threading.Thread(target=run, name="catalogue-refresher", daemon=True).start()
@@ -0,0 +1,112 @@
+## 同一アラートの重複排除
+## Grafanaはfiringのアラートをgroup intervalごとに再送してくるため、
+## 同じfingerprintのアラートは1回だけ分析し、再送分は実行中(または直近に完了した)の分析に紐付ける
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+# 分析完了後、同じアラートの再送を重複とみなす期間(秒)
+RCA_DEDUP_TTL_SECONDS = int(os.getenv("RCA_DEDUP_TTL_SECONDS", "3600"))
+
+NEW = "new"
+DUPLICATE = "duplicate"
+RESOLVED = "resolved"
+
+def alert_fingerprint(alert: dict) -> str:
+    """alertnameとソート済みのlabelsからfingerprintを生成する"""
+    labels = alert.get("labels") or {}
+    key = labels.get("alertname", "") + "|" + ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+@dataclass
+class Investigation:
+    fingerprint: str
+    started_at: float
+    future: Future = field(default_factory=Future)
+    duplicates: int = 0
+    expires_at: float = 0.0 # 0の間は分析中
+
+    @property
+    def in_flight(self) -> bool:
+        return not self.future.done()
+
+class AlertDeduplicator:
+
+    def __init__(self, ttl_seconds: int = RCA_DEDUP_TTL_SECONDS):
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._investigations: dict[str, Investigation] = {}
+        self._skipped_resolved = 0
+        self._coalesced = 0
+
+    def register(self, alert: dict) -> tuple[str, Investigation | None]:
+        """
+        アラートを登録し、(判定, Investigation)を返す。
+        - NEW: 新しく分析を開始すべきアラート
+        - DUPLICATE: 実行中または直近に完了した分析に紐付けた再送アラート
+        - RESOLVED: resolvedの通知のため分析不要
+        """
+        fingerprint = alert_fingerprint(alert)
+        now = time.time()
+
+        with self._lock:
+            self._purge_expired(now)
+            investigation = self._investigations.get(fingerprint)
+
+            if alert.get("status") == "resolved":
+                self._skipped_resolved += 1
+                # 解決済みになったら、次に発火した時は改めて分析する
+                if investigation is not None and not investigation.in_flight:
+                    del self._investigations[fingerprint]
+                return RESOLVED, investigation
+
+            if investigation is not None:
+                investigation.duplicates += 1
+                self._coalesced += 1
+                return DUPLICATE, investigation
+
+            investigation = Investigation(fingerprint=fingerprint, started_at=now)
+            self._investigations[fingerprint] = investigation
+            return NEW, investigation
+
+    def complete(self, fingerprint: str, result):
+        with self._lock:
+            investigation = self._investigations.get(fingerprint)
+            if investigation is None:
+                return
+            investigation.expires_at = time.time() + self._ttl
+        investigation.future.set_result(result)
+        if investigation.duplicates > 0:
+            print(f"[dedup] {fingerprint}: 分析完了 (重複した再送 {investigation.duplicates} 件を同じ分析結果に集約)")
+
+    def fail(self, fingerprint: str, error: Exception):
+        # 失敗した分析は保持せず、次の再送で再度分析できるようにする
+        with self._lock:
+            investigation = self._investigations.pop(fingerprint, None)
+        if investigation is not None:
+            investigation.future.set_exception(error)
+
+    def discard(self, fingerprint: str):
+        """キュー投入に失敗した場合など、分析を開始しなかったアラートの登録を取り消す"""
+        with self._lock:
+            investigation = self._investigations.get(fingerprint)
+            if investigation is not None and investigation.in_flight:
+                del self._investigations[fingerprint]
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = sum(1 for i in self._investigations.values() if i.in_flight)
+            return {
+                "in_flight": in_flight,
+                "cached": len(self._investigations) - in_flight,
+                "coalesced": self._coalesced,
+                "skipped_resolved": self._skipped_resolved,
+            }
+
+    def _purge_expired(self, now: float):
+        expired = [fp for fp, i in self._investigations.items() if i.expires_at and i.expires_at <= now]
+        for fp in expired:
+            del self._investigations[fp]
@@ -0,0 +1,206 @@
+## o11y-tool(Loki/Prometheus/Tempoのラッパー)へのHTTPクライアント
+## ツール呼び出しのたびにTCP接続を張り直さないよう、Sessionで接続をプールして使い回す(keep-alive)。
+## 5xxと接続エラーはジッター付きの指数バックオフでリトライする
+## エンドポイントごとのレイテンシは起動してからの合計(/health)と調査ごと(start_investigation)に集計する
+## 非同期版(apost)はhttpx.AsyncClientをイベントループごとに1つ作って共有する
+## ベンチマーク用に、レスポンスの記録と記録からの再生(replay.py)もここで行う
+import asyncio
+import contextvars
+import io
+import os
+import random
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import replay
+
+O11Y_POOL_SIZE = int(os.getenv("O11Y_POOL_SIZE", "20"))
+O11Y_MAX_RETRIES = int(os.getenv("O11Y_MAX_RETRIES", "2"))
+O11Y_RETRY_BACKOFF_SECONDS = float(os.getenv("O11Y_RETRY_BACKOFF_SECONDS", "0.5"))
+
+# エンドポイントごとのタイムアウト (connect, read) 秒
+# クエリ系はバックエンドの処理に時間がかかるため長めにする
+DEFAULT_TIMEOUT = (3, 10)
+ENDPOINT_TIMEOUTS = {
+    "loki/api/v1/query_range": (3, 15),
+    "prometheus/api/v1/query_range": (3, 15),
+    "prometheus/api/v1/all_metrics": (3, 20),
+    "tempo/api/query_trace": (3, 15),
+}
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=O11Y_POOL_SIZE)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+# ツールが取得の失敗として扱う例外。同期版(requests)・非同期版(httpx)で同じものを捕捉する
+# ValueErrorはJSONでないレスポンス(requestsのJSONDecodeErrorもValueErrorのサブクラス)
+REQUEST_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError, ValueError)
+
+# httpx.AsyncClientの接続はイベントループに紐づくため、ループごとにクライアントを持つ
+_async_clients = weakref.WeakKeyDictionary()
+
+_latency_hooks = []
+_hooks_lock = threading.Lock()
+
+def add_latency_hook(hook):
+    """
+    リクエストごとのレイテンシを受け取るフックを登録する。
+    hook(endpoint: str, status: int | None, elapsed_seconds: float, attempts: int) の形で呼ばれる
+    """
+    with _hooks_lock:
+        _latency_hooks.append(hook)
+
+def endpoint_name(url: str) -> str:
+    # "http://o11y-tool:8070/o11y/loki/api/v1/labels" -> "loki/api/v1/labels"
+    return url.split("/o11y/", 1)[-1]
+
+class LatencyStats:
+    """エンドポイントごとのリクエスト数・失敗数・リトライ数とレイテンシ(合計・最大)の集計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(lambda: {"requests": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+
+    def record(self, endpoint: str, status, elapsed: float, attempts: int):
+        with self._lock:
+            counts = self._endpoints[endpoint]
+            counts["requests"] += 1
+            counts["retries"] += attempts - 1
+            if status is None or status >= 400:
+                counts["errors"] += 1
+            counts["total_seconds"] += elapsed
+            counts["max_seconds"] = max(counts["max_seconds"], elapsed)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    "requests": counts["requests"],
+                    "errors": counts["errors"],
+                    "retries": counts["retries"],
+                    "avg_seconds": round(counts["total_seconds"] / counts["requests"], 3),
+                    "max_seconds": round(counts["max_seconds"], 3),
+                }
+                for endpoint, counts in self._endpoints.items()
+            }
+
+# 起動してからの全リクエストの集計(/healthで返す)
+latency_stats = LatencyStats()
+_investigation_latency = contextvars.ContextVar("http_client_investigation_latency", default=None)
+
+def start_investigation() -> LatencyStats:
+    """
+    現在のコンテキストで調査ごとのレイテンシの集計を開始する。
+    contextvarはコルーチン(タスク)・ツールを実行するスレッドにコピーされるため、エージェントを実行する処理の中で呼ぶこと
+    """
+    stats = LatencyStats()
+    _investigation_latency.set(stats)
+    return stats
+
+def _record_latency(endpoint: str, status, elapsed: float, attempts: int):
+    latency_stats.record(endpoint, status, elapsed, attempts)
+    stats = _investigation_latency.get()
+    if stats is not None:
+        stats.record(endpoint, status, elapsed, attempts)
+
+add_latency_hook(_record_latency)
+
+def retry_delay(attempt: int) -> float:
+    # full jitter: 0 ~ base * 2^(attempt-1) の間でランダムに待つ
+    return random.uniform(0, O11Y_RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)))
+
+def notify_latency(endpoint: str, status, elapsed: float, attempts: int):
+    with _hooks_lock:
+        hooks = list(_latency_hooks)
+    for hook in hooks:
+        try:
+            hook(endpoint, status, elapsed, attempts)
+        except Exception as e:
+            print(f"[http_client] latency hook failed: {repr(e)}")
+
+def post(url: str, params: dict = None, timeout=None, stream: bool = False) -> requests.Response:
+    endpoint = endpoint_name(url)
+    if replay.player is not None:
+        return replay.player.response(endpoint, url, params)
+    timeout = timeout or ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    started = time.perf_counter()
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            response = _session.post(url, params=params, timeout=timeout, stream=stream)
+            if response.status_code < 500 or attempt > O11Y_MAX_RETRIES:
+                elapsed = time.perf_counter() - started
+                notify_latency(endpoint, response.status_code, elapsed, attempt)
+                if replay.recorder is not None:
+                    replay.recorder.record_http(endpoint, params, response.status_code, response.content, elapsed)
+                    # ボディを読み切ったので、stream=Trueの呼び出し側のためにrawを差し替える
+                    response.raw = io.BytesIO(response.content)
+                return response
+            print(f"[http_client] {endpoint} returned {response.status_code}. Retrying ({attempt}/{O11Y_MAX_RETRIES})")
+            response.close()
+        except requests.exceptions.ConnectionError as e:
+            # 接続エラー(ConnectTimeoutを含む)のみリトライする。ReadTimeoutは重いクエリを繰り返すだけなのでリトライしない
+            if attempt > O11Y_MAX_RETRIES:
+                notify_latency(endpoint, None, time.perf_counter() - started, attempt)
+                raise
+            print(f"[http_client] {endpoint} connection error: {repr(e)}. Retrying ({attempt}/{O11Y_MAX_RETRIES})")
+        except requests.exceptions.RequestException:
+            notify_latency(endpoint, None, time.perf_counter() - started, attempt)
+            raise
+        time.sleep(retry_delay(attempt))
+
+def get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=O11Y_POOL_SIZE, max_keepalive_connections=O11Y_POOL_SIZE)
+        client = httpx.AsyncClient(limits=limits)
+        _async_clients[loop] = client
+    return client
+
+async def apost(url: str, params: dict = None, timeout=None, stream: bool = False) -> httpx.Response:
+    """
+    postの非同期版。stream=Trueの場合はボディを読み込まずに返すので、
+    呼び出し側でaiter_bytes()で読み取った後にaclose()すること
+    """
+    endpoint = endpoint_name(url)
+    if replay.player is not None:
+        return await replay.player.aresponse(endpoint, url, params)
+    connect_timeout, read_timeout = timeout or ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    httpx_timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    started = time.perf_counter()
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            client = get_async_client()
+            request = client.build_request("POST", url, params=params, timeout=httpx_timeout)
+            response = await client.send(request, stream=stream)
+            if response.status_code < 500 or attempt > O11Y_MAX_RETRIES:
+                elapsed = time.perf_counter() - started
+                notify_latency(endpoint, response.status_code, elapsed, attempt)
+                if replay.recorder is not None:
+                    # 読み込み後もaiter_bytes()は読み込んだ内容を返すため、stream=Trueの呼び出し側はそのまま使える
+                    replay.recorder.record_http(endpoint, params, response.status_code, await response.aread(), elapsed)
+                return response
+            print(f"[http_client] {endpoint} returned {response.status_code}. Retrying ({attempt}/{O11Y_MAX_RETRIES})")
+            await response.aclose()
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            if attempt > O11Y_MAX_RETRIES:
+                notify_latency(endpoint, None, time.perf_counter() - started, attempt)
+                raise
+            print(f"[http_client] {endpoint} connection error: {repr(e)}. Retrying ({attempt}/{O11Y_MAX_RETRIES})")
+        except httpx.HTTPError:
+            notify_latency(endpoint, None, time.perf_counter() - started, attempt)
+            raise
+        await asyncio.sleep(retry_delay(attempt))
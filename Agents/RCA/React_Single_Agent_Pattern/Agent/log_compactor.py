@@ -0,0 +1,181 @@
+## run_loki_logqlの結果をLLMに渡す前に圧縮する
+## - 同じログ行は1行にまとめて件数を付ける
+## - ストリーム(ラベルの組)ごとにまとめ、ラベルは1回だけ出力する
+## - トークン予算を超える場合は、先頭・末尾・エラー系キーワードを含む行を優先して残す
+## - 省略した行数を明記する
+import os
+import re
+from datetime import datetime, timezone
+
+import metric_summarizer
+
+LOKI_RESULT_TOKEN_BUDGET = int(os.getenv("LOKI_RESULT_TOKEN_BUDGET", "3000"))
+# トークン数の概算に使う1トークンあたりの文字数
+CHARS_PER_TOKEN = 4
+# 1行あたりの最大文字数(これを超える部分は切り詰める)
+MAX_LINE_CHARS = 500
+# 予算内で優先して残す、ストリームごとの先頭・末尾の行数
+HEAD_LINES = 10
+TAIL_LINES = 10
+
+# 単語の一部("room"のoom、"criteria"のcrit、"failover"のfail)に一致しないよう、前後が英字でないものだけを対象にする
+# (error_count、level=errorのように記号・数字で区切られたものは対象)。NullPointerExceptionのような型名は大文字で始まる語尾で判定する
+ERROR_KEYWORDS = re.compile(
+    r"(?<![a-z])(errors?|exceptions?|fail(s|ed|ure|ures)?|fatal|panic(ked)?|time(d )?out|timeouts|refused|denied|unavailable|oom(killed)?|killed|crit(ical)?)(?![a-z])"
+    r"|(?-i:[a-z0-9](Exception|Error)(?![a-z]))",
+    re.IGNORECASE,
+)
+
+def format_timestamp(value) -> str:
+    # Lokiのタイムスタンプはナノ秒のUNIX時間(文字列)
+    try:
+        seconds = int(value) / 1_000_000_000
+    except (TypeError, ValueError):
+        return str(value)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def format_labels(labels: dict) -> str:
+    return "{" + ", ".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+def _as_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+class _Line:
+    __slots__ = ("text", "count", "first_ts", "min_ts", "max_ts", "is_error")
+
+    def __init__(self, text: str, timestamp):
+        self.text = text
+        self.count = 0
+        self.first_ts = timestamp
+        self.min_ts = _as_int(timestamp)
+        self.max_ts = self.min_ts
+        self.is_error = bool(ERROR_KEYWORDS.search(text))
+
+    def add(self, timestamp):
+        self.count += 1
+        ts = _as_int(timestamp)
+        self.min_ts = min(self.min_ts, ts)
+        self.max_ts = max(self.max_ts, ts)
+
+    def render(self) -> str:
+        if self.count > 1:
+            return f"{format_timestamp(self.first_ts)} {self.text} [x{self.count} between {format_timestamp(self.min_ts)} and {format_timestamp(self.max_ts)}]"
+        return f"{format_timestamp(self.first_ts)} {self.text}"
+
+class StreamCompactor:
+    """1ストリーム分のログ行を逐次受け取り、同じ行をまとめる"""
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.total = 0
+        self._lines = {}
+
+    def add(self, timestamp, value):
+        self.total += 1
+        text = " ".join(str(value).split())
+        if len(text) > MAX_LINE_CHARS:
+            text = text[:MAX_LINE_CHARS] + "...(truncated)"
+        line = self._lines.get(text)
+        if line is None:
+            line = _Line(text, timestamp)
+            self._lines[text] = line
+        line.add(timestamp)
+
+    @property
+    def unique(self) -> int:
+        return len(self._lines)
+
+    def render(self, char_budget: int) -> tuple[list[str], int, int]:
+        """予算内に収まる行を選んで出力する。(出力行, 省略した行数, 省略したユニーク行数)を返す"""
+        lines = list(self._lines.values())
+
+        # エラー系の行、先頭、末尾の順に優先し、残りの予算で間の行を埋める
+        ordered = [i for i, line in enumerate(lines) if line.is_error]
+        ordered += range(min(HEAD_LINES, len(lines)))
+        ordered += range(max(len(lines) - TAIL_LINES, 0), len(lines))
+        ordered += range(len(lines))
+
+        selected = set()
+        used = 0
+        for i in ordered:
+            if i in selected:
+                continue
+            cost = len(lines[i].render()) + 1
+            if used + cost > char_budget and selected:
+                continue
+            selected.add(i)
+            used += cost
+
+        rendered = []
+        elided_lines = 0
+        elided_unique = 0
+        gap = 0
+        for i, line in enumerate(lines):
+            if i in selected:
+                if gap:
+                    rendered.append(f"... {gap} unique lines elided ...")
+                    gap = 0
+                rendered.append(line.render())
+            else:
+                gap += 1
+                elided_unique += 1
+                elided_lines += line.count
+        if gap:
+            rendered.append(f"... {gap} unique lines elided ...")
+        return rendered, elided_lines, elided_unique
+
+def compact_loki_result(result_json, token_budget: int = LOKI_RESULT_TOKEN_BUDGET) -> str:
+    """o11y-toolのLokiラッパーが返すJSON(list)を、LLM向けのコンパクトなテキストに変換する"""
+    if not isinstance(result_json, list) or not result_json or "data_type" not in result_json[0]:
+        # データなし・エラーの場合はそのまま返す
+        return str(result_json)
+
+    char_budget = token_budget * CHARS_PER_TOKEN
+    data_type = result_json[0]["data_type"]
+    series_list = result_json[1:]
+
+    if data_type != "log":
+        # count_over_time等のメトリクスクエリはPrometheusと同じく数値の要約にする
+        return f"data_type: {data_type}, series: {len(series_list)}\n{metric_summarizer.summarize_matrix(series_list)}"
+
+    streams = []
+    for item in series_list:
+        stream = StreamCompactor(item.get("labels", {}))
+        for entry in item.get("entries", []):
+            stream.add(entry.get("timestamp"), entry.get("value", ""))
+        streams.append(stream)
+
+    total_lines = sum(s.total for s in streams)
+    total_unique = sum(s.unique for s in streams)
+    output = [f"data_type: log, streams: {len(streams)}, lines: {total_lines} (unique: {total_unique})"]
+    used = len(output[0])
+
+    elided_lines = 0
+    elided_unique = 0
+    elided_streams = 0
+    for i, stream in enumerate(streams):
+        # 残りの予算を残りのストリームで均等に分ける
+        share = max((char_budget - used) // (len(streams) - i), 0)
+        header = f"### Stream {i + 1} {format_labels(stream.labels)}: {stream.total} lines ({stream.unique} unique)"
+        if share <= len(header):
+            elided_streams += 1
+            elided_lines += stream.total
+            elided_unique += stream.unique
+            continue
+        lines, stream_elided_lines, stream_elided_unique = stream.render(share - len(header))
+        elided_lines += stream_elided_lines
+        elided_unique += stream_elided_unique
+        block = "\n".join([header] + lines)
+        output.append(block)
+        used += len(block) + 1
+
+    if elided_lines:
+        output.append(
+            f"#### Elided\n{elided_lines} lines ({elided_unique} unique) were omitted to fit the token budget"
+            + (f", including {elided_streams} whole streams" if elided_streams else "")
+            + ". Narrow the query with label matchers or line filters to see them."
+        )
+    return "\n".join(output)
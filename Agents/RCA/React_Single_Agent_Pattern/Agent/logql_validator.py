@@ -0,0 +1,420 @@
+## LogQLのローカル検証
+## モデルが書いたLogQLをLokiに送る前に字句解析し、よくある誤り(limit/sortステージ、空のセレクタ、=~".*"だけのセレクタ、
+## 関数の外の範囲指定[5m]など)をその場で指摘する。直せるものは修正後のクエリも提案する。
+## o11y-toolへの往復とモデルの1ターンを無駄にしないためのもので、LogQLの完全なパーサではない
+## (ここで検出できなかった誤りはLoki側でエラーになる)。検証で扱えない構文は誤りと決めつけず、そのままLokiに送る
+import re
+from dataclasses import dataclass
+
+# 範囲ベクトルを取る関数(ログの範囲集計)
+RANGE_FUNCTIONS = {
+    "count_over_time", "rate", "bytes_over_time", "bytes_rate", "absent_over_time", "rate_counter",
+    "sum_over_time", "avg_over_time", "max_over_time", "min_over_time", "first_over_time", "last_over_time",
+    "stdvar_over_time", "stddev_over_time", "quantile_over_time",
+}
+# by/withoutを付けられない範囲集計(unwrapしたものだけがグルーピングできる)
+UNGROUPABLE_RANGE_FUNCTIONS = {"count_over_time", "rate", "bytes_over_time", "bytes_rate", "absent_over_time"}
+VECTOR_AGGREGATIONS = {"sum", "avg", "min", "max", "count", "stddev", "stdvar", "topk", "bottomk", "sort", "sort_desc"}
+# パイプラインのステージとして書けるキーワード
+PIPELINE_KEYWORDS = {
+    "json", "logfmt", "regexp", "pattern", "unpack", "line_format", "label_format",
+    "drop", "keep", "decolorize", "unwrap", "distinct",
+}
+# 他のクエリ言語・シェルの感覚で書かれがちだが、LogQLには存在しないステージ
+UNSUPPORTED_STAGES = {
+    "limit": "LogQL has no `limit` stage. The tool already returns a bounded number of log lines, so remove it.",
+    "head": "LogQL has no `head` stage. The tool already returns a bounded number of log lines, so remove it.",
+    "tail": "LogQL has no `tail` stage. The tool already returns a bounded number of log lines, so remove it.",
+    "sort": "LogQL has no `sort` stage. Log lines are returned in time order, so remove it.",
+    "order": "LogQL has no `order` stage. Log lines are returned in time order, so remove it.",
+    "uniq": "LogQL has no `uniq` stage. Identical lines are already merged in the tool result, so remove it.",
+    "where": "LogQL has no `where` stage. Use a label filter such as `| level=\"error\"` or a line filter such as `|= \"error\"`.",
+    "grep": "LogQL has no `grep` stage. Use a line filter such as `|= \"text\"` or `|~ \"regex\"`.",
+}
+MATCHER_OPERATORS = {"=", "!=", "=~", "!~"}
+# |> と !> はパターンでの行フィルタ(例: |> "<_> error <_>")
+LINE_FILTER_OPERATORS = {"|=", "|~", "|>", "!=", "!~", "!>"}
+COMPARISON_OPERATORS = {"=", "==", "!=", "=~", "!~", ">", ">=", "<", "<="}
+DEFAULT_RANGE = "5m"
+
+_DURATION_PATTERN = re.compile(r"^(\d+(\.\d+)?(ns|us|µs|ms|s|m|h|d|w|y))+$")
+_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<string>"(?:[^"\\]|\\.)*"|`[^`]*`)
+    | (?P<op>\|=|\|~|\|>|!=|!~|!>|=~|==|>=|<=|\||=|>|<|[-+*/%^])
+    | (?P<punct>[{}()\[\],])
+    | (?P<ident>[A-Za-z_@][A-Za-z0-9_.@:]*)
+    | (?P<number>\d+(\.\d+)?[A-Za-zµ]*)
+    """,
+    re.VERBOSE,
+)
+
+@dataclass
+class Token:
+    kind: str
+    text: str
+    start: int
+    end: int
+
+@dataclass
+class Issue:
+    message: str
+    # 修正後のクエリ(自動で直せない場合はNone)
+    fix: str | None = None
+
+class _LexError(Exception):
+    pass
+
+class _UnknownSyntax(Exception):
+    """検証で扱えない構文。誤りとは限らないため、検証せずにLokiに送る"""
+
+def tokenize(query: str) -> list[Token]:
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = _TOKEN_PATTERN.match(query, position)
+        if match is None:
+            if query[position] in "\"`":
+                raise _LexError(f"Unterminated string literal starting at position {position}: {query[position:position + 20]}")
+            raise _UnknownSyntax(f"Unexpected character {query[position]!r} at position {position}.")
+        if match.lastgroup != "space":
+            tokens.append(Token(match.lastgroup, match.group(), match.start(), match.end()))
+        position = match.end()
+    return tokens
+
+def _unquote(text: str) -> str:
+    if text.startswith("`"):
+        return text[1:-1]
+    return re.sub(r"\\(.)", r"\1", text[1:-1])
+
+def _matches_empty(operator: str, value: str) -> bool:
+    if operator == "=":
+        return value == ""
+    if operator == "!=":
+        return value != ""
+    try:
+        matched = re.fullmatch(value, "") is not None
+    except re.error:
+        return False
+    return matched if operator == "=~" else not matched
+
+def _splice(query: str, start: int, end: int, replacement: str) -> str:
+    return (query[:start] + replacement + query[end:]).strip()
+
+class _Checker:
+
+    def __init__(self, query: str, tokens: list[Token]):
+        self.query = query
+        self.tokens = tokens
+        self.issues = []
+        # 各トークンが含まれる括弧の開きトークンのインデックス
+        self.enclosing = [None] * len(tokens)
+        # 開き括弧のインデックス -> 対応する閉じ括弧のインデックス
+        self.closing = {}
+
+    def run(self) -> list[Issue]:
+        if not self._check_brackets():
+            return self.issues
+        selectors = [i for i, t in enumerate(self.tokens) if t.text == "{"]
+        if not selectors and self._has_vector():
+            # vector(0) はストリームセレクタなしで書ける(例: sum(...) or vector(0))
+            return self.issues
+        if not selectors:
+            self._missing_selector()
+            return self.issues
+        for i in selectors:
+            self._check_selector(i)
+            self._check_pipeline(self.closing[i] + 1)
+        self._check_ranges()
+        self._check_range_functions()
+        return self.issues
+
+    def _check_brackets(self) -> bool:
+        pairs = {")": "(", "]": "[", "}": "{"}
+        stack = []
+        for i, token in enumerate(self.tokens):
+            self.enclosing[i] = stack[-1] if stack else None
+            if token.text in "([{" and token.kind == "punct":
+                stack.append(i)
+            elif token.text in pairs and token.kind == "punct":
+                if not stack or self.tokens[stack[-1]].text != pairs[token.text]:
+                    self.issues.append(Issue(f"Unbalanced `{token.text}` at position {token.start}."))
+                    return False
+                self.closing[stack.pop()] = i
+        if stack:
+            token = self.tokens[stack[-1]]
+            self.issues.append(Issue(f"`{token.text}` at position {token.start} is never closed."))
+            return False
+        return True
+
+    def _has_vector(self) -> bool:
+        tokens = self.tokens
+        return any(
+            token.text == "vector" and i + 3 < len(tokens) and tokens[i + 1].text == "("
+            and tokens[i + 2].kind == "number" and tokens[i + 3].text == ")"
+            for i, token in enumerate(tokens)
+        )
+
+    def _missing_selector(self):
+        tokens = self.tokens
+        fix = None
+        # {}を付け忘れたラベルマッチャー(例: otelTraceID="...")はそのまま囲めばよい
+        end = 0
+        while (
+            end + 3 <= len(tokens)
+            and tokens[end].kind == "ident"
+            and tokens[end + 1].text in MATCHER_OPERATORS
+            and tokens[end + 2].kind == "string"
+        ):
+            end += 3
+            if end < len(tokens) and tokens[end].text == ",":
+                end += 1
+            else:
+                break
+        if end:
+            matchers_text = self.query[tokens[0].start:tokens[end - 1].end].rstrip(",")
+            fix = _splice(self.query, tokens[0].start, tokens[end - 1].end, "{" + matchers_text + "}")
+        self.issues.append(Issue(
+            "A LogQL query needs a stream selector in curly braces, e.g. `{service_name=\"api\"} |= \"error\"`.",
+            fix,
+        ))
+
+    def _check_selector(self, open_index: int):
+        close_index = self.closing[open_index]
+        inner = self.tokens[open_index + 1:close_index]
+        selector_text = self.query[self.tokens[open_index].start:self.tokens[close_index].end]
+        if not inner:
+            self.issues.append(Issue(
+                "The stream selector `{}` is empty. At least one label matcher is required, e.g. `{service_name=~\".+\"}`.",
+                _splice(self.query, self.tokens[open_index].start, self.tokens[close_index].end, '{service_name=~".+"}'),
+            ))
+            return
+
+        matchers = []
+        position = 0
+        while position < len(inner):
+            group = inner[position:position + 3]
+            if len(group) < 3 or group[0].kind != "ident":
+                self.issues.append(Issue(f"Invalid label matcher in `{selector_text}`. Use `label=\"value\"`, separated by commas."))
+                return
+            label, operator, value = group
+            if operator.text not in MATCHER_OPERATORS:
+                self.issues.append(Issue(f"Invalid matcher operator `{operator.text}` in `{selector_text}`. Use one of =, !=, =~, !~."))
+                return
+            if value.kind != "string":
+                self.issues.append(Issue(
+                    f"The value of label `{label.text}` must be quoted.",
+                    _splice(self.query, value.start, value.end, f'"{value.text}"'),
+                ))
+                return
+            matchers.append((label, operator, value))
+            position += 3
+            if position < len(inner):
+                if inner[position].text != ",":
+                    self.issues.append(Issue(f"Label matchers in `{selector_text}` must be separated by commas."))
+                    return
+                position += 1
+
+        if all(_matches_empty(op.text, _unquote(value.text)) for _, op, value in matchers):
+            fix = None
+            for _, op, value in matchers:
+                if op.text == "=~" and _unquote(value.text) == ".*":
+                    fix = _splice(self.query, value.start, value.end, '".+"')
+                    break
+            self.issues.append(Issue(
+                f"`{selector_text}` would match every stream: at least one matcher must not match the empty string. "
+                "Use `=~\".+\"` instead of `=~\".*\"`, or add a more specific label matcher.",
+                fix,
+            ))
+
+    def _stage_end(self, start: int) -> int:
+        """startから始まるステージの終わり(次のステージの開始、または囲んでいる括弧の終わり)のインデックス"""
+        depth = self.enclosing[start] if start < len(self.tokens) else None
+        i = start + 1
+        while i < len(self.tokens):
+            token = self.tokens[i]
+            if self.enclosing[i] == depth:
+                if token.text in ("|", "|=", "|~", "|>", "!>", "[") or token.text in ")]}":
+                    break
+                # != / !~ は直前が文字列なら行フィルタ、そうでなければラベルフィルタの比較演算子
+                if token.text in ("!=", "!~") and self.tokens[i - 1].kind == "string":
+                    break
+            i += 1
+        return i
+
+    def _line_filter_value_end(self, index: int) -> int | None:
+        """indexから始まる行フィルタの値(文字列、またはIPアドレスの一致 ip("10.0.0.0/8"))の次のインデックス。値でなければNone"""
+        tokens = self.tokens
+        if index < len(tokens) and tokens[index].kind == "string":
+            return index + 1
+        if (
+            index + 3 < len(tokens) and tokens[index].text == "ip" and tokens[index + 1].text == "("
+            and tokens[index + 2].kind == "string" and tokens[index + 3].text == ")"
+        ):
+            return index + 4
+        return None
+
+    def _check_pipeline(self, index: int):
+        tokens = self.tokens
+        while index < len(tokens):
+            token = tokens[index]
+            if token.text in LINE_FILTER_OPERATORS:
+                value_end = self._line_filter_value_end(index + 1)
+                if value_end is None and index + 2 < len(tokens) and tokens[index + 2].text == "(":
+                    # ip(...)以外の関数のような値は検証できないため、ここで検証をやめる
+                    return
+                if value_end is None:
+                    self.issues.append(Issue(
+                        f"The line filter `{token.text}` must be followed by a quoted string or `ip(...)`, e.g. `{token.text} \"error\"`."
+                    ))
+                    return
+                index = value_end
+                # |= "a" or "b"
+                while index < len(tokens) and tokens[index].text == "or":
+                    value_end = self._line_filter_value_end(index + 1)
+                    if value_end is None:
+                        break
+                    index = value_end
+                continue
+            if token.text != "|":
+                # パイプラインの終わり(範囲指定・括弧の終わりなど)
+                return
+
+            end = self._stage_end(index)
+            stage = tokens[index + 1] if index + 1 < len(tokens) else None
+            if stage is None:
+                self.issues.append(Issue(f"`|` at position {token.start} must be followed by a pipeline stage such as `json`, `logfmt` or a label filter."))
+                return
+            if stage.kind != "ident":
+                # 括弧で囲んだラベルフィルタなど、検証で扱えないステージ以降は検証しない
+                return
+            name = stage.text.lower()
+            stage_text = self.query[token.start:tokens[end - 1].end]
+            without_stage = _splice(self.query, token.start, tokens[end - 1].end, "")
+            without_stage = re.sub(r"\s{2,}", " ", without_stage)
+
+            next_token = tokens[index + 2] if index + 2 < len(tokens) else None
+            if name in PIPELINE_KEYWORDS or (next_token is not None and next_token.text in COMPARISON_OPERATORS):
+                # 既知のステージと、ラベルフィルタ(`| sort="asc"` のようにステージ名と同じラベルを含む)
+                pass
+            elif name in UNSUPPORTED_STAGES:
+                self.issues.append(Issue(f"`{stage_text}`: {UNSUPPORTED_STAGES[name]}", without_stage))
+            elif name in RANGE_FUNCTIONS or name in VECTOR_AGGREGATIONS:
+                self.issues.append(Issue(
+                    f"`{stage_text}`: `{stage.text}` is a function that wraps the whole log query, not a pipeline stage, "
+                    f"e.g. `count_over_time({{app=\"x\"}} |= \"error\" [5m])`.",
+                    self._wrap_in_range_function(index, end, name),
+                ))
+            index = end
+
+    def _wrap_in_range_function(self, pipe_index: int, end: int, name: str) -> str | None:
+        # `{..} |= "x" | count_over_time(1m)` -> `count_over_time({..} |= "x" [1m])`
+        if self.enclosing[pipe_index] is not None:
+            return None
+        arguments = [t.text for t in self.tokens[pipe_index + 2:end] if _DURATION_PATTERN.match(t.text)]
+        duration = arguments[0] if arguments else DEFAULT_RANGE
+        log_query = self.query[:self.tokens[pipe_index].start].strip()
+        rest = self.query[self.tokens[end - 1].end:].strip()
+        if name in RANGE_FUNCTIONS:
+            fixed = f"{name}({log_query} [{duration}])"
+        else:
+            fixed = f"{name}(count_over_time({log_query} [{duration}]))"
+        return f"{fixed} {rest}".strip()
+
+    def _function_of(self, open_index) -> str | None:
+        """開き括弧のインデックスから、その括弧で呼び出している関数名を返す"""
+        if open_index is None or self.tokens[open_index].text != "(" or open_index == 0:
+            return None
+        previous = self.tokens[open_index - 1]
+        return previous.text if previous.kind == "ident" else None
+
+    def _check_ranges(self):
+        for i, token in enumerate(self.tokens):
+            if token.text != "[":
+                continue
+            close = self.closing[i]
+            duration = self.query[token.end:self.tokens[close].start].strip()
+            if not _DURATION_PATTERN.match(duration):
+                self.issues.append(Issue(f"`[{duration}]` is not a valid range. Use a duration such as `[5m]` or `[1h]`."))
+                continue
+            function = self._function_of(self.enclosing[i])
+            if function in RANGE_FUNCTIONS:
+                continue
+            fix = None
+            if self.enclosing[i] is None:
+                # ログ行を読むクエリでは範囲指定は不要なので、取り除くのを修正案とする
+                fix = re.sub(r"\s{2,}", " ", _splice(self.query, token.start, self.tokens[close].end, ""))
+            self.issues.append(Issue(
+                f"The range `[{duration}]` can only be used inside a range aggregation such as "
+                f"`count_over_time({{...}} [{duration}])` or `rate({{...}} [{duration}])`. To read log lines, remove it.",
+                fix,
+            ))
+
+    def _check_range_functions(self):
+        for i, token in enumerate(self.tokens):
+            if token.kind != "ident" or token.text not in RANGE_FUNCTIONS:
+                continue
+            if i + 1 >= len(self.tokens) or self.tokens[i + 1].text != "(":
+                continue
+            open_index = i + 1
+            close = self.closing[open_index]
+            inner = self.tokens[open_index + 1:close]
+            call_text = self.query[token.start:self.tokens[close].end]
+            has_selector = any(t.text == "{" for t in inner)
+            has_range = any(t.text == "[" and self.enclosing[j] == open_index for j, t in enumerate(self.tokens[open_index + 1:close], start=open_index + 1))
+            if not has_selector:
+                self.issues.append(Issue(f"`{call_text}` needs a log query with a stream selector inside, e.g. `{token.text}({{app=\"x\"}} [5m])`."))
+            elif not has_range:
+                self.issues.append(Issue(
+                    f"`{call_text}` needs a range at the end of its log query, e.g. `[5m]`.",
+                    _splice(self.query, self.tokens[close].start, self.tokens[close].start, f" [{DEFAULT_RANGE}]"),
+                ))
+
+            following = self.tokens[close + 1] if close + 1 < len(self.tokens) else None
+            if following is not None and following.text in ("by", "without") and token.text in UNGROUPABLE_RANGE_FUNCTIONS:
+                fix = None
+                if close + 2 < len(self.tokens) and self.tokens[close + 2].text == "(":
+                    grouping_end = self.closing[close + 2]
+                    grouping = self.query[following.start:self.tokens[grouping_end].end]
+                    fix = _splice(self.query, token.start, self.tokens[grouping_end].end, f"sum {grouping} ({call_text})")
+                self.issues.append(Issue(
+                    f"`{token.text}` does not support `{following.text}`. Group with a vector aggregation instead, "
+                    f"e.g. `sum by (pod) ({token.text}({{...}} [5m]))`.",
+                    fix,
+                ))
+
+def validate(query: str) -> list[Issue]:
+    """LogQLを検証し、見つかった問題のリストを返す(問題がなければ空)"""
+    query = query.strip()
+    if not query:
+        return [Issue("The query is empty.")]
+    try:
+        tokens = tokenize(query)
+    except _LexError as e:
+        return [Issue(str(e))]
+    except _UnknownSyntax:
+        # 検証で扱えない構文は誤りと決めつけず、Lokiの判断に任せる
+        return []
+    return _Checker(query, tokens).run()
+
+def suggest_fix(query: str, max_rounds: int = 5) -> str | None:
+    """自動修正を繰り返し適用し、検証を通るクエリになればそれを返す"""
+    current = query.strip()
+    for _ in range(max_rounds):
+        issues = validate(current)
+        if not issues:
+            return current if current != query.strip() else None
+        fixes = [issue.fix for issue in issues if issue.fix]
+        if not fixes:
+            return None
+        current = fixes[0]
+    return None
+
+def format_issues(query: str, issues: list[Issue]) -> str:
+    lines = [f"Invalid LogQL (not sent to Loki): `{query}`"]
+    lines += [f"- {issue.message}" for issue in issues]
+    fixed = suggest_fix(query)
+    if fixed:
+        lines.append(f"Suggested fix: `{fixed}`")
+    return "\n".join(lines)
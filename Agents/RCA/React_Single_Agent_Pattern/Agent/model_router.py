@@ -0,0 +1,119 @@
+## ターンごとのモデルの振り分け
+## ほとんどのターンは次に投げるLogQL/PromQLを選ぶだけなので軽量なモデルで十分だが、
+## 最終的なRCAレポートの作成や、クエリの失敗が続いている場面では高性能なモデルを使いたい。
+## - 通常のツール選択のターンはfastモデル(RCA_FAST_MODEL)
+## - 直近のツール結果に失敗が続いている場合、ツールなしの呼び出し(予算超過による最終回答)はstrongモデル(RCA_STRONG_MODEL)
+## - fastモデルがツールを呼ばずに回答した場合(=最終回答)は、同じリクエストをstrongモデルでやり直す
+## 振り分けの方針はRoutingPolicyを差し替えて変更できる。使ったモデルはAIMessageのresponse_metadataに残す
+import os
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import AIMessage, ToolMessage
+
+RCA_FAST_MODEL = os.getenv("RCA_FAST_MODEL", "gemini-2.0-flash-lite")
+RCA_STRONG_MODEL = os.getenv("RCA_STRONG_MODEL", "gemini-2.5-flash")
+# 直近RCA_ROUTER_FAILURE_WINDOW件のツール結果のうち、失敗がこの数以上あればstrongモデルに切り替える
+RCA_ROUTER_ESCALATE_AFTER_FAILURES = int(os.getenv("RCA_ROUTER_ESCALATE_AFTER_FAILURES", "2"))
+RCA_ROUTER_FAILURE_WINDOW = int(os.getenv("RCA_ROUTER_FAILURE_WINDOW", "4"))
+
+FAST = "fast"
+STRONG = "strong"
+
+# ツールが失敗時に返すメッセージ(loki.py / prometheus.py / tempo.py / logql_validator.py / promql_validator.py)とo11y-toolのエラー
+_FAILURE_MARKERS = ("Failed to", "Invalid LogQL", "Invalid PromQL", "parse error", "bad_data", "invalid parameter")
+
+def is_failed_tool_result(message: ToolMessage) -> bool:
+    if getattr(message, "status", None) == "error":
+        return True
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return any(marker in content for marker in _FAILURE_MARKERS)
+
+def recent_failures(messages: list, window: int = RCA_ROUTER_FAILURE_WINDOW) -> int:
+    tool_results = [m for m in messages if isinstance(m, ToolMessage)][-window:]
+    return sum(is_failed_tool_result(m) for m in tool_results)
+
+class RoutingPolicy:
+    """
+    モデルの振り分け方針。choose()でリクエストごとのtierを、
+    escalate_final_answer()でfastモデルの応答をstrongモデルでやり直すかを決める
+    """
+
+    def choose(self, request) -> str:
+        return FAST
+
+    def escalate_final_answer(self, request, message: AIMessage) -> bool:
+        return False
+
+class EscalationPolicy(RoutingPolicy):
+    """通常はfast、失敗が続いた時・最終回答の時はstrongを使う"""
+
+    def __init__(self, escalate_after_failures: int = RCA_ROUTER_ESCALATE_AFTER_FAILURES):
+        self.escalate_after_failures = escalate_after_failures
+
+    def choose(self, request) -> str:
+        if not request.tools:
+            # ツールなしの呼び出しは最終回答(予算超過時など)
+            return STRONG
+        if recent_failures(request.messages) >= self.escalate_after_failures:
+            return STRONG
+        return FAST
+
+    def escalate_final_answer(self, request, message: AIMessage) -> bool:
+        return not message.tool_calls
+
+class ModelRouterMiddleware(AgentMiddleware):
+
+    def __init__(self, fast_model, strong_model, policy: RoutingPolicy = None):
+        super().__init__()
+        self.models = {FAST: fast_model, STRONG: strong_model}
+        self.policy = policy or EscalationPolicy()
+
+    def _route(self, request, tier: str):
+        return request.override(model=self.models[tier])
+
+    def _annotate(self, response, tier: str):
+        model = self.models[tier]
+        for message in response.result:
+            if isinstance(message, AIMessage):
+                message.response_metadata["model_tier"] = tier
+                message.response_metadata["routed_model"] = getattr(model, "model", None) or getattr(model, "model_name", "")
+        return response
+
+    def _carry_usage(self, discarded, response):
+        # やり直しで捨てたfastモデルの応答のトークン数も、予算(budget.py)に計上されるように残す
+        usage = {"input_tokens": 0, "output_tokens": 0}
+        for message in discarded.result:
+            if isinstance(message, AIMessage) and message.usage_metadata:
+                usage["input_tokens"] += message.usage_metadata.get("input_tokens", 0)
+                usage["output_tokens"] += message.usage_metadata.get("output_tokens", 0)
+        for message in response.result:
+            if isinstance(message, AIMessage):
+                message.response_metadata["discarded_usage"] = usage
+
+    def _escalate(self, request, response, tier: str) -> bool:
+        if tier != FAST:
+            return False
+        messages = [m for m in response.result if isinstance(m, AIMessage)]
+        return bool(messages) and self.policy.escalate_final_answer(request, messages[-1])
+
+    def wrap_model_call(self, request, handler):
+        tier = self.policy.choose(request)
+        response = handler(self._route(request, tier))
+        if self._escalate(request, response, tier):
+            print("[model_router] Final answer turn. Re-running it on the strong model.")
+            discarded = response
+            tier = STRONG
+            response = handler(self._route(request, tier))
+            self._carry_usage(discarded, response)
+        return self._annotate(response, tier)
+
+    async def awrap_model_call(self, request, handler):
+        tier = self.policy.choose(request)
+        response = await handler(self._route(request, tier))
+        if self._escalate(request, response, tier):
+            print("[model_router] Final answer turn. Re-running it on the strong model.")
+            discarded = response
+            tier = STRONG
+            response = await handler(self._route(request, tier))
+            self._carry_usage(discarded, response)
+        return self._annotate(response, tier)
@@ -1,41 +1,126 @@
-import requests
 from typing import Annotated
 from langchain_core.tools import tool
 
+import catalogue
+import http_client
+import promql_validator
+import query_window
+import metric_summarizer
+from tool_utils import ToolRequest, arun_request, async_variant, run_request
+
 PROMETHEUS_WRAPPER_ENDPOINT = "http://o11y-tool:8070/o11y/prometheus/api/v1"
+SEARCH_RESULT_LIMIT = 30
+
+def fetch_all_metrics() -> list:
+  # 取得に失敗した場合は例外をそのまま投げる(catalogue側で古い値を使い続けるため)
+  result = http_client.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/all_metrics")
+  result.raise_for_status()
+  return result.json()
+
+def fetch_all_labels() -> list:
+  result = http_client.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/labels")
+  result.raise_for_status()
+  return result.json()
+
+def _load_json(path: str, params: dict = None):
+  # tool_cacheのloader。エラーステータスの結果はキャッシュしない
+  result = http_client.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/{path}", params=params)
+  return result.json(), result.ok
+
+async def _aload_json(path: str, params: dict = None):
+  result = await http_client.apost(f"{PROMETHEUS_WRAPPER_ENDPOINT}/{path}", params=params)
+  return result.json(), result.is_success
+
+def _query_range_params(query: str, start: str, end: str, step: str):
+  # アラートの発生時刻を基準に期間を決め、stepは1系列あたりの点数が上限に収まるように決める
+  window = query_window.resolve(start, end, step)
+  params = {
+    'query': query,
+    **window.prometheus_params(),
+  }
+  return window, params
+
+def _format_promql_result(query: str, window: query_window.Window, result_json) -> str:
+  # 生の[timestamp, value]の羅列ではなく、系列ごとの数値の要約をLLMに渡す
+  summary = metric_summarizer.summarize_metric_result(result_json)
+  return f"""#### PromQL\n`{query}`\n\n#### Time range\n{window.describe()}\n\n#### Result\n{summary}"""
+
+def _promql_request(query: str, start: str, end: str, step: str) -> ToolRequest | str:
+  # 構文の誤りや存在しないメトリクス・ラベルのクエリはPrometheusに送らず、その場でエラーと候補を返す
+  issues = promql_validator.validate(query)
+  if issues:
+    return promql_validator.format_issues(query, issues)
 
-def get_all_metrics() -> str:
   try:
-    result = requests.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/all_metrics", timeout=10)
-    result_json = result.json()
-    all_metrics_exist = ", ".join(result_json) # Listで返ってくるので、文字列に変換
-  except requests.exceptions.RequestException as e:
-    all_metrics_exist = f"Failed to get metrics from Prometheus. Error: {repr(e)}"
-  return all_metrics_exist
+    window, params = _query_range_params(query, start, end, step)
+  except ValueError as e:
+    return f"Invalid time range for PromQL: {query}. Error: {e}"
+
+  return ToolRequest(
+    tool="run_prometheus_promql",
+    cache_key=query_window.cache_key(query, start, end, step),
+    path="query_range",
+    params=params,
+    format_result=lambda result_json: _format_promql_result(query, window, result_json),
+    failure=f"Failed to execute PromQL: {query}",
+  )
+
+def _label_values_request(label: str) -> ToolRequest:
+  return ToolRequest(
+    tool="get_prometheus_label_values",
+    cache_key=label,
+    path="label_values",
+    params={'label': label},
+    format_result=lambda result_json: f"""#### Prometheus Label\n`{label}`\n\n#### Values of label\n{", ".join(result_json)}""",
+    failure=f"Failed to get the values of label[{label}] from Prometheus",
+  )
+
+def _all_labels_request() -> ToolRequest:
+  return ToolRequest(
+    tool="get_all_prometheus_labels",
+    cache_key="",
+    path="labels",
+    params=None,
+    format_result=lambda result_json: f"""#### All Labels in Prometheus\n{", ".join(result_json)}""",
+    failure="Failed to get labels from Prometheus",
+  )
+
+def _labels_for_metric_request(metric: str) -> ToolRequest:
+  return ToolRequest(
+    tool="get_labels_and_values_for_metric",
+    cache_key=metric,
+    path="labels_values_metric_has",
+    params={'metric': metric},
+    format_result=lambda result_json: f"""#### Labels and their values for metric[`{metric}`]\n{result_json}""",
+    failure=f"Failed to get the labels and their values of metric[{metric}] from Prometheus",
+  )
 
 @tool
 def run_prometheus_promql(
-  query: Annotated[str, "The PromQL query to execute against Prometheus."]
+  query: Annotated[str, "The PromQL query to execute against Prometheus."],
+  start: Annotated[str, "Start of the time range: RFC3339, Unix seconds, or relative to the alert start or now (e.g. 'alert-1h', 'now-30m'). Defaults to 1 hour before the alert started."] = "",
+  end: Annotated[str, "End of the time range, in the same formats as start. Defaults to 15 minutes after the alert started (or now)."] = "",
+  step: Annotated[str, "Resolution of the result (e.g. '1m'). Chosen automatically if omitted."] = "",
 ) -> str:
   """
   Use this to excute PromQL query against Prometheus.
+  By default the query covers the time around the alert (from 1 hour before it started until 15 minutes after).
+  Use start/end to look at other periods, e.g. start='alert-24h' to compare with the usual values.
 
   Args:
     query: PromQL query to excute against Prometheus.
+    start: Start of the time range.
+    end: End of the time range.
+    step: Resolution of the result.
   Returns:
     The result of the PromQL queries.
   """
 
-  params = {
-    'query': query
-  }
+  return run_request(_promql_request(query, start, end, step), _load_json)
 
-  try:
-    result = requests.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/query_range", params=params, timeout=10)
-    result_str = f"""#### PromQL\n`{query}`\n\n#### Result\n{result.json()}"""
-    return result_str
-  except requests.exceptions.RequestException as e:
-    return f"Failed to execute PromQL: {query}. Error: {repr(e)}"
+@async_variant(run_prometheus_promql)
+async def arun_prometheus_promql(query: str, start: str = "", end: str = "", step: str = "") -> str:
+  return await arun_request(_promql_request(query, start, end, step), _aload_json)
 
 @tool
 def get_prometheus_label_values(
@@ -50,17 +135,11 @@ def get_prometheus_label_values(
     The values of label.
   """
 
-  params = {
-    'label': label
-  }
+  return run_request(_label_values_request(label), _load_json)
 
-  try:
-    result = requests.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/label_values", params=params, timeout=10)
-    result_json = result.json()
-    values_label_has = f"""#### Prometheus Label\n`{label}`\n\n#### Values of label\n{", ".join(result_json)}"""
-    return values_label_has
-  except requests.exceptions.RequestException as e:
-    return f"Failed to get the values of label[{label}] from Prometheus. Error: {repr(e)}"
+@async_variant(get_prometheus_label_values)
+async def aget_prometheus_label_values(label: str) -> str:
+  return await arun_request(_label_values_request(label), _aload_json)
 
 @tool
 def get_all_prometheus_labels() -> str:
@@ -71,13 +150,11 @@ def get_all_prometheus_labels() -> str:
     The list of all labels that exist in Prometheus.
   """
 
-  try:
-    result = requests.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/labels", timeout=10)
-    result_json = result.json()
-    all_labels_exist = f"""#### All Labels in Prometheus\n{", ".join(result_json)}"""
-    return all_labels_exist
-  except requests.exceptions.RequestException as e:
-    return f"Failed to get labels from Prometheus. Error: {repr(e)}"
+  return run_request(_all_labels_request(), _load_json)
+
+@async_variant(get_all_prometheus_labels)
+async def aget_all_prometheus_labels() -> str:
+  return await arun_request(_all_labels_request(), _aload_json)
 
 @tool
 def get_labels_and_values_for_metric(
@@ -92,13 +169,30 @@ def get_labels_and_values_for_metric(
     The labels and their values of the metric.
   """
 
-  params = {
-    'metric': metric
-  }
+  return run_request(_labels_for_metric_request(metric), _load_json)
 
-  try:
-    result = requests.post(f"{PROMETHEUS_WRAPPER_ENDPOINT}/labels_values_metric_has", params=params, timeout=10)
-    result_json = f"""#### Labels and their values for metric[`{metric}`]\n{result.json()}"""
-    return result_json
-  except requests.exceptions.RequestException as e:
-    return f"Failed to get the labels and their values of metric[{metric}] from Prometheus. Error: {repr(e)}"
\ No newline at end of file
+@async_variant(get_labels_and_values_for_metric)
+async def aget_labels_and_values_for_metric(metric: str) -> str:
+  return await arun_request(_labels_for_metric_request(metric), _aload_json)
+
+@tool
+def search_prometheus_metrics(
+  keyword: Annotated[str, "Keywords to search for in metric names (e.g., 'cpu', 'memory usage', 'request latency')."]
+) -> str:
+  """
+  Use this to search metric names in Prometheus that are related to the keywords.
+  The system prompt lists only the metrics relevant to the alert, so use this to find other metrics.
+
+  Args:
+    keyword: Keywords to search for in metric names.
+  Returns:
+    The metric names related to the keywords.
+  """
+
+  names = catalogue.metrics.search(keyword, top_n=SEARCH_RESULT_LIMIT)
+  if not names:
+    # トークンで一致しない場合は部分一致で探す
+    names = [name for name in catalogue.metrics.get() if keyword.lower() in name.lower()][:SEARCH_RESULT_LIMIT]
+  if not names:
+    return f"No metrics matched the keywords: {keyword}"
+  return f"""#### Metrics related to `{keyword}`\n{", ".join(names)}"""
@@ -0,0 +1,165 @@
+## ツールのクエリ対象期間(start/end/step)の決定
+## これまでrun_loki_logql・run_prometheus_promqlは「現在から1時間前まで」(o11y-tool側のデフォルト)しか見られず、
+## 古いアラートの調査では関係のない期間を取得し、短い期間でも細かすぎるstepで大量の点を取得していた。
+## - デフォルトの期間はアラートの発生時刻(startsAt)を基準に [発生の RCA_WINDOW_BEFORE_MINUTES 分前, 発生の RCA_WINDOW_AFTER_MINUTES 分後(現在を超えない)]
+## - モデルは start/end を RFC3339・UNIX秒・"alert-30m"/"now-1h" のような相対指定で上書きできる
+## - stepは1系列あたりの点数が RCA_MAX_POINTS_PER_SERIES 以下になるよう自動で決める(指定されたstepが細かすぎる場合も切り上げる)
+## 発生時刻は調査ごとにcontextvarで保持する(run_investigationの中で設定する)
+import contextvars
+import math
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+RCA_WINDOW_BEFORE_MINUTES = int(os.getenv("RCA_WINDOW_BEFORE_MINUTES", "60"))
+RCA_WINDOW_AFTER_MINUTES = int(os.getenv("RCA_WINDOW_AFTER_MINUTES", "15"))
+# 1回のクエリで指定できる期間の上限
+RCA_MAX_WINDOW_HOURS = int(os.getenv("RCA_MAX_WINDOW_HOURS", "168"))
+RCA_MAX_POINTS_PER_SERIES = int(os.getenv("RCA_MAX_POINTS_PER_SERIES", "120"))
+# Prometheusのスクレイプ間隔より細かいstepは意味がない
+RCA_MIN_STEP_SECONDS = int(os.getenv("RCA_MIN_STEP_SECONDS", "15"))
+LOKI_DEFAULT_LIMIT = int(os.getenv("LOKI_DEFAULT_LIMIT", "100"))
+LOKI_MAX_LIMIT = int(os.getenv("LOKI_MAX_LIMIT", "1000"))
+LOKI_DIRECTIONS = ("backward", "forward")
+
+# 自動で選ぶstep(秒)。グラフで見慣れた切りの良い値に揃える
+_NICE_STEPS = (15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400)
+_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w)")
+_RELATIVE_PATTERN = re.compile(r"^(now|alert)\s*(?:([+-])\s*((?:\d+(?:\.\d+)?(?:ms|s|m|h|d|w))+))?$")
+
+_alert_started_at = contextvars.ContextVar("query_window_alert_started_at", default=None)
+
+def parse_alert_time(value: str) -> datetime | None:
+    """GrafanaのstartsAt(RFC3339)をdatetimeにする。未設定・ゼロ値・不正な値の場合はNone"""
+    if not value or value.startswith("0001-01-01"):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def set_alert_started_at(started_at: datetime | None):
+    """
+    現在の調査のアラート発生時刻を設定する。
+    contextvarはコルーチン(タスク)ごとにコピーされるため、エージェントを実行するコルーチンの中で呼ぶこと
+    """
+    _alert_started_at.set(started_at)
+
+def alert_started_at() -> datetime | None:
+    return _alert_started_at.get()
+
+def parse_duration(text: str) -> float:
+    """"5m", "1h30m", "90s", "60"(秒) のような期間を秒数にする"""
+    text = text.strip()
+    if re.fullmatch(r"\d+(\.\d+)?", text):
+        return float(text)
+    if not text or _DURATION_PATTERN.sub("", text):
+        raise ValueError(f"Invalid duration `{text}`. Use a duration such as `30s`, `5m` or `1h`.")
+    return sum(float(number) * _UNIT_SECONDS[unit] for number, unit in _DURATION_PATTERN.findall(text))
+
+def parse_time(text: str, now: datetime, anchor: datetime) -> datetime:
+    """RFC3339・UNIX秒(ミリ秒)・"now-1h"/"alert+15m"のような相対指定を解釈する"""
+    text = text.strip()
+    relative = _RELATIVE_PATTERN.match(text)
+    if relative:
+        base = now if relative.group(1) == "now" else anchor
+        if not relative.group(2):
+            return base
+        offset = timedelta(seconds=parse_duration(relative.group(3)))
+        return base + offset if relative.group(2) == "+" else base - offset
+    if re.fullmatch(r"\d+(\.\d+)?", text):
+        timestamp = float(text)
+        if timestamp >= 1e12:
+            timestamp /= 1000
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    parsed = parse_alert_time(text)
+    if parsed is None:
+        raise ValueError(
+            f"Invalid time `{text}`. Use RFC3339 (e.g. `2025-06-01T12:00:00Z`), Unix seconds, "
+            f"or a time relative to the alert or now (e.g. `alert-30m`, `alert+10m`, `now-1h`)."
+        )
+    return parsed
+
+def auto_step(span_seconds: float, max_points: int = RCA_MAX_POINTS_PER_SERIES) -> int:
+    """1系列あたりの点数がmax_points以下になる、最小の切りの良いstep(秒)"""
+    minimum = max(RCA_MIN_STEP_SECONDS, math.ceil(span_seconds / max_points))
+    for step in _NICE_STEPS:
+        if step >= minimum:
+            return step
+    return minimum
+
+@dataclass(frozen=True)
+class Window:
+    start: datetime
+    end: datetime
+    step_seconds: int
+
+    def describe(self) -> str:
+        return f"{_rfc3339(self.start)} - {_rfc3339(self.end)} (step {self.step_seconds}s)"
+
+    def loki_params(self, direction: str, limit: int) -> dict:
+        # Lokiはnanosecond epochかRFC3339を受け付ける
+        return {
+            "start": _rfc3339(self.start),
+            "end": _rfc3339(self.end),
+            "step": f"{self.step_seconds}s",
+            "direction": direction,
+            "limit": limit,
+        }
+
+    def prometheus_params(self) -> dict:
+        # o11y-toolのPrometheus APIはUNIX秒とstep(整数秒)を受け付ける
+        return {
+            "start": str(int(self.start.timestamp())),
+            "end": str(math.ceil(self.end.timestamp())),
+            "step": str(self.step_seconds),
+        }
+
+def _rfc3339(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def resolve(start: str = "", end: str = "", step: str = "", now: datetime = None) -> Window:
+    """
+    ツールの引数からクエリ対象期間を決める。引数が不正な場合はモデル向けのメッセージでValueErrorを投げる
+    """
+    now = now or datetime.now(timezone.utc)
+    anchor = alert_started_at() or now
+
+    start_at = parse_time(start, now, anchor) if start else anchor - timedelta(minutes=RCA_WINDOW_BEFORE_MINUTES)
+    if end:
+        end_at = parse_time(end, now, anchor)
+    else:
+        end_at = min(now, max(anchor + timedelta(minutes=RCA_WINDOW_AFTER_MINUTES), start_at + timedelta(minutes=RCA_WINDOW_AFTER_MINUTES)))
+    end_at = min(end_at, now)
+
+    if end_at <= start_at:
+        raise ValueError(f"The time range is empty: start `{_rfc3339(start_at)}` must be before end `{_rfc3339(end_at)}` (end is capped at now).")
+    span = (end_at - start_at).total_seconds()
+    if span > RCA_MAX_WINDOW_HOURS * 3600:
+        raise ValueError(f"The time range is too long ({span / 3600:.0f}h). Query at most {RCA_MAX_WINDOW_HOURS}h at once.")
+
+    step_seconds = auto_step(span)
+    if step:
+        # 指定されたstepが細かすぎる場合は、点数の上限に収まるよう切り上げる
+        step_seconds = max(step_seconds, math.ceil(parse_duration(step)))
+    return Window(start=start_at, end=end_at, step_seconds=step_seconds)
+
+def cache_key(query: str, *args) -> str:
+    """
+    ツールキャッシュのキー。"now"基準の指定は解決後の時刻が毎回変わるため、解決前の引数と発生時刻をキーにする
+    (現在時刻の変化はツールキャッシュの時間バケットで区別される)
+    """
+    anchor = alert_started_at()
+    return " ".join([query, *(str(arg) for arg in args), _rfc3339(anchor) if anchor else "-"])
+
+def loki_direction(direction: str) -> str:
+    direction = (direction or "backward").lower()
+    if direction not in LOKI_DIRECTIONS:
+        raise ValueError(f"Invalid direction `{direction}`. Use `backward` (newest first) or `forward` (oldest first).")
+    return direction
+
+def loki_limit(limit: int) -> int:
+    return max(1, min(int(limit or LOKI_DEFAULT_LIMIT), LOKI_MAX_LIMIT))
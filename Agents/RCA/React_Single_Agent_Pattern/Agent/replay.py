@@ -0,0 +1,230 @@
+## 調査の記録と再生(ベンチマーク用)
+## RCA_REPLAY_MODE=record で起動すると、調査ごとに以下をRCA_REPLAY_FIXTUREのJSONLファイルに追記する
+## - 調査の入力(Stateの初期値)
+## - o11y-toolへのリクエストとレスポンス(http_clientで記録するため、loki/prometheus/tempoの全ツールが対象)
+## - モデルの応答(ツール呼び出し・トークン使用量を含むAIMessage)
+## benchmark.pyは記録したファイルを使い、ネットワークなしで調査を再生する
+import asyncio
+import contextvars
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+import httpx
+import requests
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+RCA_REPLAY_MODE = os.getenv("RCA_REPLAY_MODE", "")
+RCA_REPLAY_FIXTURE = os.getenv("RCA_REPLAY_FIXTURE", "replay_fixture.jsonl")
+
+_current_investigation = contextvars.ContextVar("replay_investigation_id", default=None)
+
+# クエリ対象期間(query_window.py)は現在時刻によって変わるため、記録と再生の突き合わせには使わない
+_TIME_PARAMS = {"start", "end", "step"}
+
+def request_key(endpoint: str, params: dict | None) -> str:
+    params = {key: value for key, value in (params or {}).items() if key not in _TIME_PARAMS}
+    return json.dumps([endpoint, params], sort_keys=True, ensure_ascii=False)
+
+class Recorder:
+    """調査の入力・HTTPのレスポンス・モデルの応答をJSONLに追記する"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, record: dict):
+        record["investigation"] = record.get("investigation", _current_investigation.get())
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def start_investigation(self, inputs: dict) -> str:
+        """
+        調査の記録を開始する。contextvarに調査IDを設定するため、エージェントを実行するコルーチンの中で呼ぶこと
+        """
+        investigation_id = uuid.uuid4().hex
+        _current_investigation.set(investigation_id)
+        self._write({"kind": "investigation", "investigation": investigation_id, "inputs": inputs})
+        return investigation_id
+
+    def record_http(self, endpoint: str, params: dict | None, status: int, body: bytes, elapsed: float):
+        self._write({
+            "kind": "http",
+            "endpoint": endpoint,
+            "params": params or {},
+            "status": status,
+            "body": body.decode("utf-8", errors="replace"),
+            "elapsed": elapsed,
+        })
+
+    def record_model(self, message: AIMessage, elapsed: float):
+        self._write({"kind": "model", "message": message_to_dict(message), "elapsed": elapsed})
+
+class Player:
+    """記録したHTTPレスポンスを返す。同じリクエストが記録より多く来た場合は最後のレスポンスを返し続ける"""
+
+    def __init__(self, http_records: list, replay_latency: bool = False):
+        self.replay_latency = replay_latency
+        self.requests = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._responses = defaultdict(deque)
+        self._last = {}
+        for record in http_records:
+            self._responses[request_key(record["endpoint"], record["params"])].append(record)
+
+    def _next(self, endpoint: str, params: dict | None) -> dict:
+        key = request_key(endpoint, params)
+        with self._lock:
+            self.requests += 1
+            queue = self._responses.get(key)
+            if queue:
+                self._last[key] = queue.popleft()
+            record = self._last.get(key)
+            if record is None:
+                self.misses += 1
+                return {"status": 404, "body": json.dumps({"error": f"no recorded response for {endpoint} {params}"}), "elapsed": 0.0}
+            return record
+
+    def response(self, endpoint: str, url: str, params: dict | None) -> requests.Response:
+        record = self._next(endpoint, params)
+        if self.replay_latency:
+            time.sleep(record["elapsed"])
+        body = record["body"].encode("utf-8")
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.url = url
+        response._content = body
+        # stream=Trueで読む呼び出し側(tempo)のために、rawからも読めるようにする
+        response.raw = io.BytesIO(body)
+        return response
+
+    async def aresponse(self, endpoint: str, url: str, params: dict | None) -> httpx.Response:
+        record = self._next(endpoint, params)
+        if self.replay_latency:
+            await asyncio.sleep(record["elapsed"])
+        return httpx.Response(record["status"], content=record["body"].encode("utf-8"), request=httpx.Request("POST", url, params=params))
+
+recorder = Recorder(RCA_REPLAY_FIXTURE) if RCA_REPLAY_MODE == "record" else None
+# benchmark.pyが調査ごとに設定する
+player = None
+
+class ModelRecorder(AgentMiddleware):
+    """モデルの応答(AIMessage)を記録するミドルウェア"""
+
+    def wrap_model_call(self, request, handler):
+        started = time.perf_counter()
+        response = handler(request)
+        self._record(response, time.perf_counter() - started)
+        return response
+
+    async def awrap_model_call(self, request, handler):
+        started = time.perf_counter()
+        response = await handler(request)
+        self._record(response, time.perf_counter() - started)
+        return response
+
+    def _record(self, response, elapsed: float):
+        messages = response.result if hasattr(response, "result") else [response]
+        for message in messages:
+            if isinstance(message, AIMessage):
+                recorder.record_model(message, elapsed)
+
+class ReplayChatModel(BaseChatModel):
+    """
+    記録したモデルの応答を順番に返すチャットモデル。
+    記録を使い切った場合(エージェントの変更で記録時よりターンが増えた場合)は、ツール呼び出しなしの応答で調査を終わらせる
+    """
+
+    responses: list = []
+    replay_latency: bool = False
+    _queue: deque = PrivateAttr(default_factory=deque)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    calls: int = 0
+    exhausted: bool = False
+    input_tokens: int = 0
+    output_tokens: int = 0
+    tool_calls: int = 0
+
+    def model_post_init(self, __context):
+        self._queue.extend(self.responses)
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _next(self) -> tuple[AIMessage, float]:
+        with self._lock:
+            self.calls += 1
+            if not self._queue:
+                self.exhausted = True
+                return AIMessage(content="(replay exhausted: no more recorded model responses)"), 0.0
+            record = self._queue.popleft()
+        message = messages_from_dict([record["message"]])[0]
+        usage = message.usage_metadata or {}
+        with self._lock:
+            self.input_tokens += usage.get("input_tokens", 0)
+            self.output_tokens += usage.get("output_tokens", 0)
+            self.tool_calls += len(message.tool_calls)
+        return message, record.get("elapsed", 0.0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message, elapsed = self._next()
+        if self.replay_latency:
+            time.sleep(elapsed)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message, elapsed = self._next()
+        if self.replay_latency:
+            await asyncio.sleep(elapsed)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+class CountingSummaryModel(BaseChatModel):
+    """SummarizationMiddleware用のスタンドイン。要約の実行回数を数え、固定の要約を返す"""
+
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay-summary"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="(summary of the previous investigation steps)"))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop, run_manager, **kwargs)
+
+def load_fixture(path: str) -> list[dict]:
+    """記録ファイルを調査ごとにまとめて返す: [{"id", "inputs", "http": [...], "model": [...]}]"""
+    investigations = {}
+    shared_http = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            investigation_id = record.get("investigation")
+            if record["kind"] == "investigation":
+                investigations[investigation_id] = {"id": investigation_id, "inputs": record["inputs"], "http": [], "model": []}
+            elif investigation_id in investigations:
+                investigations[investigation_id][record["kind"]].append(record)
+            elif record["kind"] == "http":
+                # 調査の外(カタログの更新など)で記録されたレスポンスは全調査で共有する
+                shared_http.append(record)
+    for investigation in investigations.values():
+        investigation["http"].extend(shared_http)
+    return list(investigations.values())
@@ -0,0 +1,254 @@
+## 調査の途中経過の出力先(シンク)
+## これまで調査結果は全体が終わってから最終メッセージを出力するだけだったため、
+## LangGraphのstream(stream_mode="updates")でグラフの各ステップの結果を受け取り、その場でシンクに流す。
+## オンコール担当者は調査の完了を待たずに、モデルの最初の仮説や実行中のクエリを確認できる。
+## 出力先はRCA_SINKSにカンマ区切りで指定する
+## - stdout: 標準出力
+## - jsonl: RCA_SINK_JSONL_PATHのファイルに1イベント1行で追記
+## - http: RCA_SINK_HTTP_URLにイベントのJSONをPOST
+## - slack: RCA_SLACK_CHANNELに調査ごとのメッセージを投稿し、途中経過・最終レポートをそのスレッドに返信(SLACK_BOT_TOKENが必要)
+## シンクへの送信は専用のスレッドで行い、送信の遅延や失敗で調査を止めない
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+import requests
+from langchain_core.messages import AIMessage, RemoveMessage, ToolMessage
+
+RCA_SINKS = os.getenv("RCA_SINKS", "stdout")
+RCA_SINK_JSONL_PATH = os.getenv("RCA_SINK_JSONL_PATH", "rca_events.jsonl")
+RCA_SINK_HTTP_URL = os.getenv("RCA_SINK_HTTP_URL", "")
+RCA_SINK_TIMEOUT_SECONDS = float(os.getenv("RCA_SINK_TIMEOUT_SECONDS", "5"))
+RCA_SINK_QUEUE_SIZE = int(os.getenv("RCA_SINK_QUEUE_SIZE", "1000"))
+RCA_SLACK_CHANNEL = os.getenv("RCA_SLACK_CHANNEL", "")
+SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN", "")
+SLACK_POST_MESSAGE_URL = "https://slack.com/api/chat.postMessage"
+
+# イベントの種類
+STARTED = "started"
+FINDING = "finding"         # ツールを呼ぶ前にモデルが書いた考察・仮説
+TOOL_CALL = "tool_call"
+TOOL_RESULT = "tool_result"
+FINAL = "final"
+ERROR = "error"
+
+# ツール結果のプレビューの最大文字数(全文は調査のトレースで確認する)
+TOOL_RESULT_PREVIEW_CHARS = 500
+
+@dataclass
+class InvestigationEvent:
+    investigation: str
+    alert_name: str
+    kind: str
+    content: str
+    timestamp: float = field(default_factory=time.time)
+    data: dict = field(default_factory=dict)
+
+class Sink:
+    """シンクの基底クラス。kindsに含まれる種類のイベントだけを受け取る(Noneなら全て)"""
+
+    kinds = None
+
+    def emit(self, event: InvestigationEvent):
+        raise NotImplementedError
+
+class StdoutSink(Sink):
+
+    def emit(self, event: InvestigationEvent):
+        print(f"[rca:{event.investigation[:8]}] {event.kind}: {event.content}")
+
+class JsonlSink(Sink):
+
+    def __init__(self, path: str = RCA_SINK_JSONL_PATH):
+        self.path = path
+
+    def emit(self, event: InvestigationEvent):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(asdict(event), ensure_ascii=False, default=str) + "\n")
+
+class HttpCallbackSink(Sink):
+
+    def __init__(self, url: str = RCA_SINK_HTTP_URL):
+        self.url = url
+
+    def emit(self, event: InvestigationEvent):
+        response = requests.post(self.url, json=asdict(event), timeout=RCA_SINK_TIMEOUT_SECONDS)
+        response.raise_for_status()
+
+class SlackThreadSink(Sink):
+    """調査の開始時にチャンネルへ投稿し、以降のイベントはそのメッセージのスレッドに返信する"""
+
+    # ツールの呼び出し・結果はスレッドが埋もれるため投稿しない
+    kinds = {STARTED, FINDING, FINAL, ERROR}
+    # Slackのメッセージの長さの上限より少し小さく切り詰める
+    max_chars = 3900
+
+    def __init__(self, channel: str = RCA_SLACK_CHANNEL, token: str = SLACK_BOT_TOKEN):
+        self.channel = channel
+        self.token = token
+        # 調査ID -> スレッドの親メッセージのts
+        self._threads = {}
+
+    def _post(self, text: str, thread_ts: str = None) -> str:
+        payload = {"channel": self.channel, "text": text[:self.max_chars]}
+        if thread_ts:
+            payload["thread_ts"] = thread_ts
+        response = requests.post(
+            SLACK_POST_MESSAGE_URL,
+            headers={"Authorization": f"Bearer {self.token}"},
+            json=payload,
+            timeout=RCA_SINK_TIMEOUT_SECONDS,
+        )
+        body = response.json()
+        if not body.get("ok"):
+            raise RuntimeError(f"Slack API error: {body.get('error')}")
+        return body["ts"]
+
+    def emit(self, event: InvestigationEvent):
+        if event.kind == STARTED:
+            self._threads[event.investigation] = self._post(f":mag: RCA started: *{event.alert_name}*\n{event.content}")
+            return
+        thread_ts = self._threads.get(event.investigation)
+        if event.kind == FINAL:
+            self._post(f":white_check_mark: RCA report\n{event.content}", thread_ts)
+        elif event.kind == ERROR:
+            self._post(f":x: RCA failed: {event.content}", thread_ts)
+        else:
+            self._post(f":thought_balloon: {event.content}", thread_ts)
+        if event.kind in (FINAL, ERROR):
+            self._threads.pop(event.investigation, None)
+
+def build_sinks(names: str = RCA_SINKS) -> list[Sink]:
+    sinks = []
+    for name in (n.strip() for n in names.split(",")):
+        if not name:
+            continue
+        if name == "stdout":
+            sinks.append(StdoutSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink())
+        elif name == "http" and RCA_SINK_HTTP_URL:
+            sinks.append(HttpCallbackSink())
+        elif name == "slack" and RCA_SLACK_CHANNEL and SLACK_BOT_TOKEN:
+            sinks.append(SlackThreadSink())
+        else:
+            print(f"[sinks] Sink `{name}` is unknown or not configured. Skipped.")
+    return sinks
+
+class SinkDispatcher:
+    """イベントをキューに積み、専用のスレッドで各シンクに送る。キューが溢れた場合はイベントを捨てる"""
+
+    def __init__(self, sinks: list[Sink], queue_size: int = RCA_SINK_QUEUE_SIZE):
+        self.sinks = sinks
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def publish(self, event: InvestigationEvent):
+        if not self.sinks:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._dropped += 1
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rca-sinks", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            for sink in self.sinks:
+                if sink.kinds is not None and event.kind not in sink.kinds:
+                    continue
+                try:
+                    sink.emit(event)
+                except Exception as e:
+                    print(f"[sinks] Failed to send {event.kind} event to {type(sink).__name__}. Error: {repr(e)}")
+
+    def stats(self) -> dict:
+        return {"sinks": [type(sink).__name__ for sink in self.sinks], "queued": self._queue.qsize(), "dropped": self._dropped}
+
+dispatcher = SinkDispatcher(build_sinks())
+
+def _message_key(message) -> str | None:
+    """流したメッセージを識別するキー。ツール結果はツール呼び出しのIDで識別する(更新の時点ではメッセージのIDが付いていない場合があるため)"""
+    if isinstance(message, ToolMessage):
+        return f"tool:{message.tool_call_id}"
+    if message.id:
+        return message.id
+    if isinstance(message, AIMessage) and message.tool_calls:
+        return "calls:" + ",".join(str(tool_call.get("id")) for tool_call in message.tool_calls)
+    return None
+
+def _describe_tool_call(tool_call: dict) -> str:
+    args = ", ".join(f"{key}={value!r}" for key, value in tool_call.get("args", {}).items())
+    return f"{tool_call['name']}({args})"
+
+class InvestigationStream:
+    """1回の調査のイベント(開始・途中経過・最終レポート・失敗)をシンクに流す"""
+
+    def __init__(self, investigation: str, alert_name: str, dispatcher: SinkDispatcher = dispatcher):
+        self.investigation = investigation
+        self.alert_name = alert_name
+        self._dispatcher = dispatcher
+        # 既にシンクに流したメッセージのキー
+        self._published = set()
+
+    def _publish(self, kind: str, content: str, **data):
+        self._dispatcher.publish(InvestigationEvent(self.investigation, self.alert_name, kind, content, data=data))
+
+    def started(self, description: str = ""):
+        self._publish(STARTED, description)
+
+    def mark_published(self, messages: list):
+        """チェックポイントから再開する場合に、前回の実行で流したメッセージを登録して流し直さないようにする"""
+        for message in messages:
+            key = _message_key(message)
+            if key is not None:
+                self._published.add(key)
+
+    def update(self, chunk: dict):
+        """LangGraphのstream(stream_mode="updates")の1ステップ分の出力({ノード名: Stateの更新})を受け取る"""
+        for node, update in (chunk or {}).items():
+            if not isinstance(update, dict):
+                continue
+            messages = update.get("messages", [])
+            # ミドルウェアはメッセージ一覧を置き換える場合にOverwriteで包んで返す
+            messages = getattr(messages, "value", messages)
+            if not isinstance(messages, list):
+                continue
+            for message in messages:
+                # 要約(SummarizationMiddleware)はRemoveMessageで履歴を消してから要約と残すメッセージを返し、
+                # ミドルウェアのOverwriteは履歴全体を返すため、既に流したメッセージは流し直さない
+                if isinstance(message, RemoveMessage):
+                    continue
+                key = _message_key(message)
+                if key is not None:
+                    if key in self._published:
+                        continue
+                    self._published.add(key)
+                if isinstance(message, AIMessage) and message.tool_calls:
+                    # ツールを呼ばない応答は最終レポートで、finished()で送る
+                    if message.text.strip():
+                        self._publish(FINDING, message.text.strip(), node=node)
+                    for tool_call in message.tool_calls:
+                        self._publish(TOOL_CALL, _describe_tool_call(tool_call), node=node, tool=tool_call["name"])
+                elif isinstance(message, ToolMessage):
+                    content = message.text
+                    preview = content if len(content) <= TOOL_RESULT_PREVIEW_CHARS else content[:TOOL_RESULT_PREVIEW_CHARS] + "..."
+                    self._publish(TOOL_RESULT, preview, node=node, tool=message.name, chars=len(content))
+
+    def finished(self, answer: str, **data):
+        self._publish(FINAL, answer, **data)
+
+    def failed(self, error: str):
+        self._publish(ERROR, error)
@@ -6,5 +6,7 @@ from langchain.agents import AgentState
 class RCAAgentState(AgentState):
   alert_message: str = ""
   alert_occurred_time: str = ""
-  metric_list: list = []
+  # GrafanaのstartsAt(RFC3339)
+  alert_starts_at: str = ""
+  metric_list: str = ""
   loki_labels_list: str = ""
\ No newline at end of file
@@ -1,8 +1,31 @@
-import requests
+import ijson
 from typing import Annotated
 from langchain_core.tools import tool
 
+import http_client
+import trace_condenser
+from tool_utils import async_variant
+
 TEMPO_WRAPPER_ENDPOINT = "http://o11y-tool:8070/o11y/tempo/api"
+# エラー応答のボディをLLMに返す際の最大文字数
+ERROR_BODY_MAX_CHARS = 500
+# 同期版・非同期版で共通に捕捉する例外(トレースのJSONの解析エラーを含む)
+TRACE_ERRORS = (*http_client.REQUEST_ERRORS, ijson.JSONError)
+
+def _failed_status_message(status_code: int, body: str) -> str:
+  # エラー応答のボディはトレースのJSONではないため、要約せずにステータスと共に返す
+  return f"Failed to execute trace query. Status: {status_code}, Body: {body[:ERROR_BODY_MAX_CHARS]}"
+
+def _trace_params(trace_id: str) -> dict:
+  return {
+    'trace_id': trace_id
+  }
+
+def _format_trace_result(trace_id: str, condensed: str) -> str:
+  return f"""#### TraceID\n`{trace_id}`\n\n#### Result\n{condensed}"""
+
+def _failed_message(error: Exception) -> str:
+  return f"Failed to execute trace query. Error: {repr(error)}"
 
 @tool
 def run_tempo_query_trace(
@@ -14,16 +37,36 @@ def run_tempo_query_trace(
   Args:
     trace_id: The trace ID to execute against Grafana Tempo.
   Returns:
-    The result of the trace query.
+    A condensed view of the trace: the critical path, the slowest spans,
+    error spans with their status messages, and latency by service.
   """
 
-  params = {
-    'trace_id': trace_id
-  }
+  try:
+    # 大きなトレースでもレスポンス全体をメモリに展開しないよう、ストリームのまま要約する
+    result = http_client.post(f"{TEMPO_WRAPPER_ENDPOINT}/query_trace", params=_trace_params(trace_id), stream=True)
+    try:
+      if not result.ok:
+        return _failed_status_message(result.status_code, result.text)
+      result.raw.decode_content = True
+      condensed = trace_condenser.condense_trace(trace_id, result.raw)
+    finally:
+      result.close()
+    return _format_trace_result(trace_id, condensed)
+  except TRACE_ERRORS as e:
+    return _failed_message(e)
 
+@async_variant(run_tempo_query_trace)
+async def arun_tempo_query_trace(trace_id: str) -> str:
   try:
-    result = requests.post(f"{TEMPO_WRAPPER_ENDPOINT}/query_trace", params=params, timeout=10)
-    result_str = f"""#### TraceID\n`{trace_id}`\n\n#### Result\n{result.json()}"""
-    return result_str
-  except requests.exceptions.RequestException as e:
-    return f"Failed to execute trace query. Error: {repr(e)}"
\ No newline at end of file
+    result = await http_client.apost(f"{TEMPO_WRAPPER_ENDPOINT}/query_trace", params=_trace_params(trace_id), stream=True)
+    try:
+      if not result.is_success:
+        await result.aread()
+        return _failed_status_message(result.status_code, result.text)
+      reader = trace_condenser.AsyncByteReader(result.aiter_bytes())
+      condensed = await trace_condenser.acondense_trace(trace_id, reader)
+    finally:
+      await result.aclose()
+    return _format_trace_result(trace_id, condensed)
+  except TRACE_ERRORS as e:
+    return _failed_message(e)
@@ -0,0 +1,169 @@
+## ツール結果(o11y-toolのレスポンスJSON)のメモ化
+## 1回の調査の中で同じラベル値取得や同じクエリが繰り返されること、関連するアラートの調査が並行して同じクエリを投げることが多いため、
+## - ツール名 + 正規化したクエリ(+ クエリ系は時間バケット)をキーにキャッシュする
+## - ツールごとのTTLとLRUで古いエントリを捨てる
+## - 同じキーの実行中リクエストがあれば、新たにリクエストせずその結果を待つ(同期・非同期どちらからでも)
+## - 調査ごとのヒット/ミス数をcontextvarで集計する
+## 失敗した結果(例外・エラーステータス)はキャッシュしない
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "512"))
+# クエリ系ツールの時間バケット(秒)。クエリの期間は"now-1h"のように現在時刻を基準にすることがあるため、バケットが変われば別のキーになる
+TOOL_CACHE_TIME_BUCKET_SECONDS = int(os.getenv("TOOL_CACHE_TIME_BUCKET_SECONDS", "60"))
+
+# ツールごとの (TTL秒, 時間バケットをキーに含めるか)
+TOOL_CACHE_POLICIES = {
+    "run_loki_logql": (60, True),
+    "run_prometheus_promql": (60, True),
+    "get_list_of_streams": (120, True),
+    "get_loki_label_values": (300, False),
+    "get_prometheus_label_values": (300, False),
+    "get_all_prometheus_labels": (600, False),
+    "get_labels_and_values_for_metric": (300, False),
+}
+DEFAULT_POLICY = (60, True)
+
+# クオートされた文字列と、それ以外の部分に分ける
+_QUOTED_PATTERN = re.compile(r'("(?:[^"\\]|\\.)*"|`[^`]*`)')
+_AROUND_PUNCTUATION = re.compile(r"\s*([{}()\[\],=!~|<>])\s*")
+
+def normalize_query(query: str) -> str:
+    """クオートの外側の空白の揺れを取り除く(文字列リテラルの中身は変更しない)"""
+    parts = _QUOTED_PATTERN.split(query.strip())
+    for i in range(0, len(parts), 2):
+        parts[i] = _AROUND_PUNCTUATION.sub(r"\1", " ".join(parts[i].split()))
+    return "".join(parts)
+
+class InvestigationStats:
+    """1回の調査の中でのツール別のキャッシュヒット/ミス数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: {"hit": 0, "miss": 0, "coalesced": 0})
+
+    def record(self, tool: str, outcome: str):
+        with self._lock:
+            self._counts[tool][outcome] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            per_tool = {tool: dict(counts) for tool, counts in self._counts.items()}
+        totals = {outcome: sum(counts[outcome] for counts in per_tool.values()) for outcome in ("hit", "miss", "coalesced")}
+        return {**totals, "per_tool": per_tool}
+
+_investigation_stats = contextvars.ContextVar("tool_cache_investigation_stats", default=None)
+
+def start_investigation() -> InvestigationStats:
+    """
+    現在のコンテキストで調査ごとの集計を開始する。
+    contextvarはコルーチン(タスク)ごとにコピーされるため、エージェントを実行するコルーチンの中で呼ぶこと
+    """
+    stats = InvestigationStats()
+    _investigation_stats.set(stats)
+    return stats
+
+class ToolCache:
+
+    def __init__(self, max_entries: int = TOOL_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, value)
+        self._entries = OrderedDict()
+        # key -> concurrent.futures.Future(実行中のリクエスト)
+        self._inflight = {}
+        self._counts = {"hit": 0, "miss": 0, "coalesced": 0}
+
+    def make_key(self, tool: str, query: str = "") -> tuple:
+        _, bucketed = TOOL_CACHE_POLICIES.get(tool, DEFAULT_POLICY)
+        bucket = int(time.time() // TOOL_CACHE_TIME_BUCKET_SECONDS) if bucketed else None
+        return (tool, normalize_query(query), bucket)
+
+    def fetch(self, tool: str, query: str, loader):
+        """
+        キャッシュがあればそれを返し、なければloader()を実行する。
+        loaderは (値, キャッシュしてよいか) を返す関数
+        """
+        key = self.make_key(tool, query)
+        future, is_leader = self._lookup(tool, key)
+        if not is_leader:
+            return future.result()
+        try:
+            value, cacheable = loader()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value=value, cacheable=cacheable)
+        return value
+
+    async def afetch(self, tool: str, query: str, loader):
+        """fetchの非同期版。loaderは (値, キャッシュしてよいか) を返すコルーチン関数"""
+        key = self.make_key(tool, query)
+        future, is_leader = self._lookup(tool, key)
+        if not is_leader:
+            return await asyncio.wrap_future(future)
+        try:
+            value, cacheable = await loader()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value=value, cacheable=cacheable)
+        return value
+
+    def _lookup(self, tool: str, key: tuple) -> tuple[concurrent.futures.Future, bool]:
+        """(Future, 自分がリクエストを実行する側か) を返す"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                outcome = "hit"
+                future = concurrent.futures.Future()
+                future.set_result(entry[1])
+                is_leader = False
+            elif key in self._inflight:
+                outcome = "coalesced"
+                future = self._inflight[key]
+                is_leader = False
+            else:
+                self._entries.pop(key, None)
+                outcome = "miss"
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+                is_leader = True
+            self._counts[outcome] += 1
+
+        stats = _investigation_stats.get()
+        if stats is not None:
+            stats.record(tool, outcome)
+        return future, is_leader
+
+    def _settle(self, key: tuple, future: concurrent.futures.Future, value=None, cacheable: bool = False, error: BaseException = None):
+        ttl, _ = TOOL_CACHE_POLICIES.get(key[0], DEFAULT_POLICY)
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is None and cacheable:
+                self._entries[key] = (time.time() + ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counts, "entries": len(self._entries), "inflight": len(self._inflight)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+cache = ToolCache()
@@ -0,0 +1,62 @@
+## LangChainツール定義の補助
+## ツールの同期版と非同期版(ainvoke時に使われる)は、o11y-toolへの送信だけが異なる。
+## パラメータ・キャッシュキー・結果の整形・失敗時のメッセージはToolRequestにまとめ、
+## 送信とエラー処理はrun_request/arun_requestで共通にして、両者の挙動がずれないようにする
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import http_client
+import tool_cache
+
+@dataclass
+class ToolRequest:
+    """ツールの1回の呼び出しでo11y-toolに送るリクエストと、その結果の返し方"""
+    # tool_cacheのツール名とキャッシュキー
+    tool: str
+    cache_key: str
+    # o11y-toolのエンドポイントのパス
+    path: str
+    params: dict | None
+    # レスポンスのJSONからLLMに返す文字列を作る
+    format_result: Callable[[Any], str]
+    # 失敗した場合にエラーの前に付けるメッセージ
+    failure: str
+
+    def failed(self, error: Exception) -> str:
+        print(f"{self.failure}. Error: {repr(error)}")
+        return f"{self.failure}. Error: {repr(error)}"
+
+def run_request(request: ToolRequest | str, load_json) -> str:
+    """
+    requestをtool_cache経由で実行し、整形した結果を返す。load_jsonは (値, キャッシュしてよいか) を返す関数。
+    requestが文字列の場合(クエリの検証エラーなど、送らずに返すもの)はそのまま返す
+    """
+    if isinstance(request, str):
+        return request
+    try:
+        result_json = tool_cache.cache.fetch(request.tool, request.cache_key, lambda: load_json(request.path, request.params))
+        return request.format_result(result_json)
+    except http_client.REQUEST_ERRORS as e:
+        return request.failed(e)
+
+async def arun_request(request: ToolRequest | str, aload_json) -> str:
+    """run_requestの非同期版。aload_jsonは (値, キャッシュしてよいか) を返すコルーチン関数"""
+    if isinstance(request, str):
+        return request
+    try:
+        result_json = await tool_cache.cache.afetch(request.tool, request.cache_key, lambda: aload_json(request.path, request.params))
+        return request.format_result(result_json)
+    except http_client.REQUEST_ERRORS as e:
+        return request.failed(e)
+
+def async_variant(sync_tool):
+    """
+    @toolで定義した同期ツールに、同じ引数を取る非同期実装を紐付けるデコレータ。
+    ainvoke時はこちらが使われ、ToolNodeが1ターン内の複数のツール呼び出しを並列に実行できるようになる
+    """
+
+    def decorator(coroutine):
+        sync_tool.coroutine = coroutine
+        return coroutine
+
+    return decorator
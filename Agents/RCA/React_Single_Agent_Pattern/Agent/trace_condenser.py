@@ -0,0 +1,206 @@
+## run_tempo_query_traceの結果(OTLP形式のトレースJSON)をLLM向けに要約する
+## レスポンス全体をdictに展開せず、ijsonでスパンを1つずつ読み取りながら必要な項目だけを保持し、
+## 以下を出力する
+## - クリティカルパス(ルートから、最後に終わる子スパンを辿った経路)
+## - 処理時間の長いスパン上位N件
+## - エラーのスパンとステータスメッセージ
+## - サービスごとのレイテンシ内訳
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+
+import ijson
+
+TRACE_SLOWEST_SPANS = int(os.getenv("TRACE_SLOWEST_SPANS", "10"))
+TRACE_MAX_ERROR_SPANS = int(os.getenv("TRACE_MAX_ERROR_SPANS", "10"))
+TRACE_MAX_CRITICAL_PATH = 20
+
+_RESOURCE_SPANS = "trace.resourceSpans.item"
+_RESOURCE_ATTRIBUTE = _RESOURCE_SPANS + ".resource.attributes.item"
+# OTLPのバージョンによってscopeSpans / instrumentationLibrarySpansのどちらかになる
+_SPAN_PREFIXES = (
+    _RESOURCE_SPANS + ".scopeSpans.item.spans.item",
+    _RESOURCE_SPANS + ".instrumentationLibrarySpans.item.spans.item",
+)
+_ERROR_STATUS_CODES = {"STATUS_CODE_ERROR", 2}
+
+@dataclass
+class Span:
+    span_id: str
+    parent_id: str
+    name: str
+    service: str
+    start: int
+    end: int
+    status_message: str = ""
+    is_error: bool = False
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end - self.start) / 1_000_000
+
+def _attribute_value(attribute: dict):
+    value = attribute.get("value") or {}
+    for v in value.values():
+        return v
+    return None
+
+def _to_span(raw: dict, service: str) -> Span:
+    status = raw.get("status") or {}
+    message = status.get("message", "")
+    # エラーの詳細はstatus.messageではなくexceptionイベントに入っていることが多い
+    for event in raw.get("events") or []:
+        if event.get("name") == "exception":
+            for attribute in event.get("attributes") or []:
+                if attribute.get("key") == "exception.message" and not message:
+                    message = str(_attribute_value(attribute))
+    return Span(
+        span_id=raw.get("spanId", ""),
+        parent_id=raw.get("parentSpanId", ""),
+        name=raw.get("name", ""),
+        service=service,
+        start=int(raw.get("startTimeUnixNano", 0)),
+        end=int(raw.get("endTimeUnixNano", 0)),
+        status_message=message,
+        is_error=status.get("code") in _ERROR_STATUS_CODES,
+    )
+
+class _TraceReader:
+    """ijsonのイベントを受け取り、スパン単位でSpanに変換していく"""
+
+    def __init__(self):
+        self.spans = []
+        self.missing_message = None
+        self._service = "unknown"
+        self._builder = None
+        self._builder_prefix = None
+
+    def feed(self, prefix: str, event: str, value):
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if prefix == self._builder_prefix and event == "end_map":
+                self._finish(self._builder.value)
+                self._builder = None
+            return
+
+        if prefix == _RESOURCE_SPANS and event == "start_map":
+            self._service = "unknown"
+        elif event == "start_map" and (prefix == _RESOURCE_ATTRIBUTE or prefix in _SPAN_PREFIXES):
+            self._builder = ijson.ObjectBuilder()
+            self._builder_prefix = prefix
+            self._builder.event(event, value)
+        elif prefix == "trace.result":
+            # o11y-toolはトレースが存在しない場合 {"trace": {"result": "..."}} を返す
+            self.missing_message = value
+
+    def _finish(self, obj: dict):
+        if self._builder_prefix == _RESOURCE_ATTRIBUTE:
+            if obj.get("key") == "service.name":
+                self._service = str(_attribute_value(obj))
+        else:
+            self.spans.append(_to_span(obj, self._service))
+
+def _critical_path(roots: list[Span], children: dict) -> list[Span]:
+    path = []
+    span = max(roots, key=lambda s: s.end - s.start)
+    while span is not None and len(path) < TRACE_MAX_CRITICAL_PATH:
+        path.append(span)
+        # 最後に終わった子スパンが親の完了を律速しているとみなす
+        kids = children.get(span.span_id)
+        span = max(kids, key=lambda s: s.end) if kids else None
+    return path
+
+def _self_time_ms(span: Span, children: dict) -> float:
+    child_total = sum(child.duration_ms for child in children.get(span.span_id, []))
+    return max(span.duration_ms - child_total, 0.0)
+
+def render(trace_id: str, spans: list[Span]) -> str:
+    if not spans:
+        return "No spans found in the trace."
+
+    by_id = {span.span_id: span for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        if span.parent_id and span.parent_id in by_id:
+            children[span.parent_id].append(span)
+        else:
+            roots.append(span)
+
+    trace_start = min(span.start for span in spans)
+    trace_end = max(span.end for span in spans)
+    errors = [span for span in spans if span.is_error]
+    services = sorted({span.service for span in spans})
+
+    def describe(span: Span) -> str:
+        offset = (span.start - trace_start) / 1_000_000
+        return f"[{span.service}] {span.name} {span.duration_ms:.1f}ms (starts at +{offset:.1f}ms)"
+
+    lines = [
+        f"trace_id: {trace_id}, spans: {len(spans)}, services: {len(services)} ({', '.join(services)}), "
+        f"duration: {(trace_end - trace_start) / 1_000_000:.1f}ms, error spans: {len(errors)}",
+        "### Critical Path",
+    ]
+    for depth, span in enumerate(_critical_path(roots, children)):
+        lines.append(f"{'  ' * depth}- {describe(span)}, self {_self_time_ms(span, children):.1f}ms")
+
+    lines.append(f"### Slowest {TRACE_SLOWEST_SPANS} Spans")
+    for span in sorted(spans, key=lambda s: s.end - s.start, reverse=True)[:TRACE_SLOWEST_SPANS]:
+        lines.append(f"- {describe(span)}")
+
+    if errors:
+        lines.append("### Error Spans")
+        for span in sorted(errors, key=lambda s: s.start)[:TRACE_MAX_ERROR_SPANS]:
+            lines.append(f"- {describe(span)}: {span.status_message or '(no status message)'}")
+        if len(errors) > TRACE_MAX_ERROR_SPANS:
+            lines.append(f"... {len(errors) - TRACE_MAX_ERROR_SPANS} more error spans omitted")
+
+    lines.append("### Latency by Service (self time = span time excluding child spans)")
+    breakdown = defaultdict(lambda: [0, 0.0, 0.0, 0])
+    for span in spans:
+        stats = breakdown[span.service]
+        stats[0] += 1
+        stats[1] += span.duration_ms
+        stats[2] += _self_time_ms(span, children)
+        stats[3] += int(span.is_error)
+    for service, (count, total, self_time, error_count) in sorted(breakdown.items(), key=lambda item: -item[1][2]):
+        lines.append(f"- {service}: {count} spans, self {self_time:.1f}ms, total {total:.1f}ms, errors {error_count}")
+
+    return "\n".join(lines)
+
+def condense_trace(trace_id: str, stream) -> str:
+    """read()を持つストリーム(レスポンスボディ)からトレースを逐次読み取り、要約テキストを返す"""
+    reader = _TraceReader()
+    for prefix, event, value in ijson.parse(stream):
+        reader.feed(prefix, event, value)
+    if reader.missing_message is not None:
+        return str(reader.missing_message)
+    return render(trace_id, reader.spans)
+
+async def acondense_trace(trace_id: str, stream) -> str:
+    """condense_traceの非同期版。streamはasyncのread()を持つオブジェクト"""
+    reader = _TraceReader()
+    async for prefix, event, value in ijson.parse_async(stream):
+        reader.feed(prefix, event, value)
+    if reader.missing_message is not None:
+        return str(reader.missing_message)
+    return render(trace_id, reader.spans)
+
+class AsyncByteReader:
+    """httpxのaiter_bytes()をijson.parse_asyncが読めるasync read()に変換する"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = b""
+
+    async def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
@@ -1,13 +1,58 @@
 ## GrafanaのWebhookアラートを受け取るサーバ
 import http.server
-import socketserver
 import json
+import os
+import threading
+import time
 import urllib.parse
 from datetime import datetime
 
 ## ローカルモジュールのimport
+import alert_rule_cache
+import catalogue
+import checkpoint_store
 import deep_agent
+import http_client
+import job_store
 import preprocessing
+import worker_pool
+
+# キューが満杯の時にGrafanaへ再送を促すまでの秒数
+RETRY_AFTER_SECONDS = int(os.getenv("RCA_RETRY_AFTER_SECONDS", "30"))
+
+def run_job(job: dict):
+    """ワーカースレッド上で1件の分析ジョブを実行し、結果をジョブに記録する"""
+    job_store.store.start(job["job_id"])
+    try:
+        alert_info = preprocessing.extract_alert_info(job["alert"])
+        result = deep_agent.start_alert_cause_analysis(alert_info, raw_alert=job["alert"])
+    except Exception as e:
+        job_store.store.fail(job["job_id"], repr(e))
+        raise
+    job_store.store.complete(job["job_id"], result)
+    print(f"★Alert Analysis Result (job {job['job_id']}):\n {json.dumps(result, indent=2, ensure_ascii=False)}")
+
+pool = worker_pool.AlertWorkerPool(run_job)
+# 同じアラートのジョブを並行するWebhookのリクエストから二重に作らないためのロック
+_submit_lock = threading.Lock()
+
+def submit_job(alert: dict, thread_id: str = None) -> tuple[str | None, bool]:
+    """
+    アラートの分析ジョブを作ってキューに積み、(ジョブID, 既存のジョブに集約したか) を返す。
+    同じ発火(スレッドID)のジョブが待機中・実行中の場合は新しく作らずにそのIDを返す
+    (再送されたアラートで2つのワーカーが同じチェックポイントのスレッドを同時に進めないため)。
+    キューが満杯の場合はジョブを取り消してNoneを返す
+    """
+    thread_id = thread_id or checkpoint_store.thread_id_for(alert.get("labels", {}), alert.get("startsAt", ""))
+    with _submit_lock:
+        existing = job_store.store.find_unfinished(thread_id)
+        if existing is not None:
+            return existing["job_id"], True
+        job_id = job_store.store.create(alert, thread_id)
+    if pool.submit({"job_id": job_id, "alert": alert}):
+        return job_id, False
+    job_store.store.delete(job_id)
+    return None, False
 
 class WebhookHandler(http.server.BaseHTTPRequestHandler):
 
@@ -28,11 +73,24 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            response = {"status": "healthy"}
+            response = {"status": "healthy", "agent": deep_agent.status(), "queue": pool.stats(), "jobs": job_store.store.stats(), "http": http_client.latency_stats.as_dict()}
             self.wfile.write(json.dumps(response).encode())
+        elif self.path.startswith('/jobs/'):
+            self.handle_job_status(urllib.parse.urlparse(self.path).path[len('/jobs/'):])
         else:
             self.send_error(404, "Not Found")
 
+    def handle_job_status(self, job_id: str):
+        job = job_store.store.get(job_id)
+        if job is None:
+            self.send_error(404, "Job Not Found")
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        job.pop("alert")
+        self.wfile.write(json.dumps(job, ensure_ascii=False).encode())
+
     def handle_webhook(self):
         try:
             # ヘッダー情報を取得
@@ -40,6 +98,9 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             content_length = int(self.headers.get('Content-Length', 0))
 
             print(f"\n=== Webhook受信 ({datetime.now()}) ===")
+            jobs = []
+            rejected = 0
+            coalesced = 0
             # print(f"[DEBUG] Headers: {json.dumps(headers, indent=2, ensure_ascii=False)}")
 
             # POSTデータを読み取り
@@ -56,12 +117,19 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
                         # print(f"[DEBUG] JSON Data: {json.dumps(data, indent=2, ensure_ascii=False)}")
                         for alert in data.get("alerts", []):
                             print(f"status: {alert.get('status')}, labels: {alert.get('labels')}, annotations: {alert.get('annotations')}")
-                            try:
-                                alert_info = preprocessing.extract_alert_info(alert)
-                                result = deep_agent.start_alert_cause_analysis(alert_info)
-                                print(f"★Alert Analysis Result:\n {json.dumps(result, indent=2, ensure_ascii=False)}")
-                            except Exception as e:
-                                print(f"Alert分析中にエラーが発生しました: {e}")
+                            if alert.get("status") == "resolved":
+                                print("resolvedの通知のため分析をスキップします")
+                                continue
+                            # 分析はワーカープールに任せ、Webhookにはジョブを返して即座に応答する
+                            job_id, duplicate = submit_job(alert)
+                            if job_id is None:
+                                rejected += 1
+                                print(f"キューが満杯のためアラートを受け付けられませんでした: {alert.get('labels')}")
+                                continue
+                            if duplicate:
+                                coalesced += 1
+                                print(f"[jobs] 同じアラートの分析ジョブ {job_id} が既に存在するため集約します")
+                            jobs.append({"job_id": job_id, "status_url": f"/jobs/{job_id}"})
                     except json.JSONDecodeError:
                         print(f"JSON解析エラー - Raw Data: {post_data.decode('utf-8')}")
 
@@ -71,11 +139,21 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
             else:
                 print("No POST data received")
 
-            # 成功レスポンスを返す
-            self.send_response(200)
+            # キューが溢れた場合は503を返し、Grafana側で再送してもらう(バックプレッシャー)
+            if rejected > 0:
+                self.send_response(503)
+                self.send_header('Content-type', 'application/json')
+                self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+                self.end_headers()
+                response = {"status": "busy", "jobs": jobs, "rejected": rejected, "coalesced": coalesced, "queue": pool.stats()}
+                self.wfile.write(json.dumps(response).encode())
+                return
+
+            # 受け付けたジョブを返す(結果は/jobs/<id>で取得する)
+            self.send_response(202)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            response = {"status": "received"}
+            response = {"status": "accepted", "jobs": jobs, "coalesced": coalesced, "queue": pool.stats()}
             self.wfile.write(json.dumps(response).encode())
 
         except Exception as e:
@@ -86,18 +164,63 @@ class WebhookHandler(http.server.BaseHTTPRequestHandler):
         """ログメッセージをカスタマイズ（不要なログを抑制）"""
         pass
 
+def resume_unfinished_jobs():
+    """
+    前回の起動中に終わらなかったジョブをキューに積み直す。調査はチェックポイントの続きから再開される。
+    再開の上限回数に達した調査・既に完了していた調査は、ジョブをその結果で終わらせる
+    """
+    resumable = {record["thread_id"]: record for record in checkpoint_store.store.interrupted()}
+    requeued = {}
+    for job in job_store.store.unfinished():
+        resumable.pop(job["thread_id"], None)
+        if job["thread_id"] in requeued:
+            # 同じ調査のジョブは1つだけ再開する(同じスレッドを2つのワーカーで同時に進めないため)
+            job_store.store.fail(job["job_id"], f"duplicate of job {requeued[job['thread_id']]}")
+            continue
+        record = checkpoint_store.store.get(job["thread_id"])
+        if record is not None and record["status"] == checkpoint_store.COMPLETED:
+            job_store.store.complete(job["job_id"], record["result"])
+            continue
+        if record is not None and record["status"] == checkpoint_store.FAILED:
+            job_store.store.fail(job["job_id"], record["error"])
+            continue
+        if pool.submit({"job_id": job["job_id"], "alert": job["alert"]}):
+            requeued[job["thread_id"]] = job["job_id"]
+            print(f"[jobs] Resuming job {job['job_id']}: {job['alert'].get('labels')}")
+        else:
+            job_store.store.fail(job["job_id"], "queue is full")
+    # ジョブを持たない中断された調査(ジョブの導入前に始まったもの)は新しいジョブとして再開する
+    for record in resumable.values():
+        job_id, _ = submit_job(record["alert"], record["thread_id"])
+        if job_id is not None:
+            print(f"[checkpoint] Resuming interrupted investigation {record['thread_id']} as job {job_id}: {record['alert'].get('labels')}")
+        else:
+            print(f"[checkpoint] Queue is full. Investigation {record['thread_id']} will be resumed when the alert is sent again.")
+
 def run_server(port=8089):
     """サーバを起動"""
-    with socketserver.TCPServer(("", port), WebhookHandler) as httpd:
-        print(f"Webhookサーバを起動中...")
+    started = time.perf_counter()
+    pool.start()
+    # Langfuseの認証確認・モデルの作成はWebhookの受信を止めないよう裏で行う
+    deep_agent.start_background_init()
+    # ラベル一覧・メトリクス一覧を起動時に先読みし、以降は裏で定期更新する
+    catalogue.start_background_refresh()
+    # アラートルールの定義も起動時に先読みし、アラートごとのGrafana APIの呼び出しを省く
+    alert_rule_cache.start_background_prefetch()
+    resume_unfinished_jobs()
+    # リクエストごとにスレッドを割り当て、分析中でも/healthや/jobsに応答できるようにする
+    with http.server.ThreadingHTTPServer(("", port), WebhookHandler) as httpd:
+        print(f"Webhookサーバを起動中... (起動時間: {time.perf_counter() - started + deep_agent.startup_timings['import_seconds']:.2f}s)")
         print(f"エンドポイント: http://localhost:{port}/webhook")
         print(f"ヘルスチェック: http://localhost:{port}/health")
+        print(f"ジョブの状態: http://localhost:{port}/jobs/<job_id>")
         print(f"停止するには Ctrl+C を押してください")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nサーバを停止中...")
             httpd.shutdown()
+            pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     run_server(8089)
\ No newline at end of file
@@ -0,0 +1,99 @@
+## メトリクス名・ラベル名のローカル検索インデックス
+## アラートのラベル・アノテーション・ルールのクエリに関連する名前だけを選び出し、
+## システムプロンプトに全件を貼り付けなくて済むようにする
+import math
+import re
+from collections import defaultdict
+
+# 単語の区切り(記号)とcamelCaseの境界
+_SPLIT_PATTERN = re.compile(r"[^A-Za-z0-9]+")
+_CAMEL_PATTERN = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_:][A-Za-z0-9_:]*")
+
+# アラート文中に頻出するが、関連度の判定には役に立たない単語
+_STOPWORDS = {
+    "alertname", "labels", "annotations", "query", "log", "message", "summary", "description",
+    "the", "and", "for", "is", "of", "to", "in", "on", "by", "sum", "rate", "irate", "avg", "max", "min",
+    "count", "over", "time", "without", "http", "https", "n", "a",
+}
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for word in _SPLIT_PATTERN.split(text):
+        for part in _CAMEL_PATTERN.split(word):
+            part = part.lower()
+            if len(part) >= 2 and part not in _STOPWORDS:
+                tokens.append(part)
+    return tokens
+
+def trigrams(token: str) -> set[str]:
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class NameIndex:
+    """
+    名前(メトリクス名・ラベル名)のトークン転置インデックスとトライグラム転置インデックス。
+    完全一致したトークンはIDFで重み付けし、表記揺れ(latency/latencies等)はトライグラムの一致率で拾う。
+    """
+
+    def __init__(self, names: list[str]):
+        self.names = list(names)
+        self._name_ids = {name: i for i, name in enumerate(self.names)}
+        self._token_postings = defaultdict(set)
+        self._trigram_postings = defaultdict(set)
+        self._vocabulary_trigrams = {}
+
+        for i, name in enumerate(self.names):
+            for token in set(tokenize(name)):
+                self._token_postings[token].add(i)
+
+        for token in self._token_postings:
+            grams = trigrams(token)
+            self._vocabulary_trigrams[token] = grams
+            for gram in grams:
+                self._trigram_postings[gram].add(token)
+
+        total = max(len(self.names), 1)
+        self._idf = {token: math.log(1 + total / len(ids)) for token, ids in self._token_postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._name_ids
+
+    def search(self, text: str, top_n: int = 50) -> list[str]:
+        scores = defaultdict(float)
+
+        # クエリ中にそのまま出てくるメトリクス名は最優先
+        for identifier in set(_IDENTIFIER_PATTERN.findall(text)):
+            if identifier in self._name_ids:
+                scores[self._name_ids[identifier]] += 100.0
+
+        for token in set(tokenize(text)):
+            for vocab_token, similarity in self._similar_tokens(token):
+                weight = self._idf[vocab_token] * similarity
+                for i in self._token_postings[vocab_token]:
+                    scores[i] += weight
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], len(self.names[item[0]])))
+        return [self.names[i] for i, _ in ranked[:top_n]]
+
+    def _similar_tokens(self, token: str):
+        if token in self._token_postings:
+            yield token, 1.0
+        # 短い単語はトライグラムでの曖昧一致をしない(誤検出が多いため)
+        if len(token) < 4:
+            return
+
+        grams = trigrams(token)
+        candidates = defaultdict(int)
+        for gram in grams:
+            for vocab_token in self._trigram_postings.get(gram, ()):
+                candidates[vocab_token] += 1
+        for vocab_token, shared in candidates.items():
+            if vocab_token == token:
+                continue
+            similarity = shared / len(grams | self._vocabulary_trigrams[vocab_token])
+            if similarity >= 0.5:
+                yield vocab_token, similarity * 0.5
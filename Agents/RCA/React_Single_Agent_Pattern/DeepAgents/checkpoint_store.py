@@ -0,0 +1,159 @@
+## 調査の永続化(チェックポイント)
+## これまで調査はWebhookの処理の中でメモリ上だけで進んでいたため、途中でPodが再起動するとそのアラートは分析されないままだった。
+## - LangGraphのチェックポインタ(SQLite)でグラフの各ステップの状態をローカルディスクに保存する
+##   (完了したツール呼び出しの結果もStateに含まれるため、再開時に取り直したり考え直したりしない)
+## - investigationsテーブルに調査ごとの状態(running/completed/failed)と元のアラートを記録し、
+##   起動時にrunningのまま残っている調査(=中断された調査)を再開する
+## - 完了した調査はチェックポイントを削除し、結果だけをRCA_CHECKPOINT_RETENTION_HOURSの間残す
+## RCA_CHECKPOINT_DBはPodの再起動後も残るボリュームに置くこと
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import aiosqlite
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+RCA_CHECKPOINT_DB = os.getenv("RCA_CHECKPOINT_DB", "rca_checkpoints.sqlite")
+RCA_CHECKPOINT_RETENTION_HOURS = int(os.getenv("RCA_CHECKPOINT_RETENTION_HOURS", "24"))
+# 再開しても毎回落ちる調査(Podを巻き込んで落とすものなど)を無限に再開しないための上限
+RCA_CHECKPOINT_MAX_ATTEMPTS = int(os.getenv("RCA_CHECKPOINT_MAX_ATTEMPTS", "3"))
+
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+def thread_id_for(labels: dict, starts_at: str) -> str:
+    """
+    調査のスレッドID。同じアラートの同じ発火(startsAt)は同じIDになるため、
+    再起動後に再送されたアラートも中断した調査の続きとして扱える
+    """
+    key = labels.get("alertname", "") + "|" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "|" + (starts_at or "")
+    return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+class InvestigationStore:
+
+    def __init__(self, path: str = RCA_CHECKPOINT_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        # 接続は最初に使う時に作る(ベンチマークなど、永続化を使わない場合にファイルを作らないため)
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        """self._lockを取得した状態で呼ぶこと"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # チェックポインタと同じファイルを別の接続から読み書きするため、WALにしてロックの競合を減らす
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS investigations (
+                    thread_id TEXT PRIMARY KEY,
+                    alert TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _row(self, row) -> dict | None:
+        if row is None:
+            return None
+        thread_id, alert, status, attempts, result, error, created_at, updated_at = row
+        return {
+            "thread_id": thread_id,
+            "alert": json.loads(alert),
+            "status": status,
+            "attempts": attempts,
+            "result": result,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+    def get(self, thread_id: str) -> dict | None:
+        with self._lock:
+            row = self._db().execute("SELECT * FROM investigations WHERE thread_id = ?", (thread_id,)).fetchone()
+        return self._row(row)
+
+    def start(self, thread_id: str, alert: dict):
+        """調査の開始(または再開)を記録する"""
+        now = time.time()
+        with self._lock:
+            self._db().execute(
+                """
+                INSERT INTO investigations (thread_id, alert, status, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, 1, ?, ?)
+                ON CONFLICT(thread_id) DO UPDATE SET status = excluded.status, attempts = attempts + 1, error = NULL, updated_at = excluded.updated_at
+                """,
+                (thread_id, json.dumps(alert, ensure_ascii=False, default=str), RUNNING, now, now),
+            )
+            self._db().commit()
+
+    def complete(self, thread_id: str, result: str):
+        self._update(thread_id, COMPLETED, result=result)
+        self.prune()
+
+    def fail(self, thread_id: str, error: str):
+        self._update(thread_id, FAILED, error=error)
+
+    def _update(self, thread_id: str, status: str, result: str = None, error: str = None):
+        with self._lock:
+            self._db().execute(
+                "UPDATE investigations SET status = ?, result = ?, error = ?, updated_at = ? WHERE thread_id = ?",
+                (status, result, error, time.time(), thread_id),
+            )
+            self._db().commit()
+
+    def interrupted(self) -> list[dict]:
+        """
+        前回のプロセスで実行中のまま終わった調査を返す。再開の上限回数に達したものはfailedにして返さない。
+        起動時(まだ調査を始める前)に呼ぶこと
+        """
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM investigations WHERE status = ? ORDER BY created_at", (RUNNING,)).fetchall()
+        records = []
+        for record in map(self._row, rows):
+            if record["attempts"] >= RCA_CHECKPOINT_MAX_ATTEMPTS:
+                print(f"[checkpoint] Investigation {record['thread_id']} was interrupted {record['attempts']} times. Giving up.")
+                self.fail(record["thread_id"], "interrupted too many times")
+                continue
+            records.append(record)
+        return records
+
+    def prune(self):
+        """保持期間を過ぎた完了・失敗済みの調査を削除する"""
+        cutoff = time.time() - RCA_CHECKPOINT_RETENTION_HOURS * 3600
+        with self._lock:
+            self._db().execute("DELETE FROM investigations WHERE status != ? AND updated_at < ?", (RUNNING, cutoff))
+            self._db().commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM investigations GROUP BY status").fetchall()
+        return {"path": self.path, **{status: count for status, count in rows}}
+
+store = InvestigationStore()
+
+def open_saver():
+    """同期のグラフ(DeepAgents)用のチェックポインタ"""
+    return SqliteSaver(sqlite3.connect(RCA_CHECKPOINT_DB, check_same_thread=False))
+
+async def open_async_saver():
+    """
+    非同期のグラフ(Agent)用のチェックポインタ。
+    aiosqliteの接続は作成したイベントループでしか使えないため、エージェントを実行するイベントループの上で呼ぶこと
+    """
+    saver = AsyncSqliteSaver(await aiosqlite.connect(RCA_CHECKPOINT_DB))
+    await saver.setup()
+    return saver
@@ -1,34 +1,127 @@
+## 起動時の初期化は遅延させる
+## これまではimport時にLangfuseの認証確認(ネットワーク呼び出し)・チャットモデル・CallbackHandlerの作成を行っていたため、
+## Langfuseが遅い・繋がらないとWebhookサーバの起動とヘルスチェックが止まっていた。
+## - モデル・チェックポインタは最初に使う時に作る(start_background_initで起動直後に裏で作っておく)
+## - Langfuseの認証確認は裏で行い、LANGFUSE_AUTH_TIMEOUT_SECONDSで打ち切る。
+##   キーが未設定・LANGFUSE_TRACING_ENABLED=false・認証の失敗/タイムアウトの場合はトレースを無効にして調査を続ける
+import time
+_import_started = time.perf_counter()
+
 from dotenv import load_dotenv
 import os
-import time
+import threading
+from dataclasses import asdict
+from datetime import timezone
 from deepagents import create_deep_agent
 from langfuse import get_client
 from langfuse.langchain import CallbackHandler
 from langchain.chat_models import init_chat_model
 
+import catalogue
+import checkpoint_store
+import http_client
 import loki
 import prometheus
+import query_window
+import sinks
+import subagents
 import tempo
 
 load_dotenv('.env')
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "./service-account-key.json"
-os.environ["LANGFUSE_SECRET_KEY"]
-os.environ["LANGFUSE_PUBLIC_KEY"]
-os.environ["LANGFUSE_BASE_URL"]
 
-# Initialize Langfuse client
-langfuse = get_client()
+RCA_MODEL = os.getenv("RCA_MODEL", "gemini-2.5-flash")
+LANGFUSE_AUTH_TIMEOUT_SECONDS = float(os.getenv("LANGFUSE_AUTH_TIMEOUT_SECONDS", "5"))
+
+# トレースの状態
+TRACING_PENDING = "pending"
+TRACING_ENABLED = "enabled"
+TRACING_DISABLED = "disabled"
+
+_init_lock = threading.Lock()
+_model = None
+_checkpointer = None
+_tracing = TRACING_PENDING
+_tracing_check_started = False
+_tracing_checked = threading.Event()
+startup_timings = {}
+
+def _check_tracing():
+  """Langfuseの設定と認証を確認し、トレースを使うかどうかを決める"""
+  global _tracing
+  started = time.perf_counter()
+  missing = [key for key in ("LANGFUSE_SECRET_KEY", "LANGFUSE_PUBLIC_KEY", "LANGFUSE_BASE_URL") if not os.getenv(key)]
+  if os.getenv("LANGFUSE_TRACING_ENABLED", "true").lower() == "false":
+    _tracing, reason = TRACING_DISABLED, "LANGFUSE_TRACING_ENABLED=false"
+  elif missing:
+    _tracing, reason = TRACING_DISABLED, f"{', '.join(missing)} not set"
+  else:
+    # auth_checkはブロッキングのネットワーク呼び出しのため、別スレッドで実行して待つ時間を制限する
+    result = {}
+    def auth_check():
+      try:
+        result["ok"] = get_client().auth_check()
+      except Exception as e:
+        result["error"] = repr(e)
+    checker = threading.Thread(target=auth_check, name="langfuse-auth-check", daemon=True)
+    checker.start()
+    checker.join(LANGFUSE_AUTH_TIMEOUT_SECONDS)
+    if result.get("ok"):
+      _tracing, reason = TRACING_ENABLED, "authenticated"
+    elif checker.is_alive():
+      _tracing, reason = TRACING_DISABLED, f"auth check timed out after {LANGFUSE_AUTH_TIMEOUT_SECONDS}s"
+    else:
+      _tracing, reason = TRACING_DISABLED, f"authentication failed: {result.get('error', 'invalid credentials')}. Please check your credentials and host"
+  startup_timings["tracing_check_seconds"] = round(time.perf_counter() - started, 3)
+  _tracing_checked.set()
+  print(f"[startup] Langfuse tracing {_tracing} ({reason}, {startup_timings['tracing_check_seconds']}s)")
 
-# Verify connection
-if langfuse.auth_check():
-    print("Langfuse client is authenticated and ready!")
-else:
-    print("Authentication failed. Please check your credentials and host.")
+def _start_tracing_check():
+  global _tracing_check_started
+  with _init_lock:
+    if _tracing_check_started:
+      return
+    _tracing_check_started = True
+  threading.Thread(target=_check_tracing, name="langfuse-check", daemon=True).start()
 
-# Initialize Langfuse CallbackHandler for LangChain (tracing)
-langfuse_handler = CallbackHandler()
+def get_callbacks() -> list:
+  """
+  調査に渡すLangChainのコールバック。認証確認が終わっていなければ(最大でLANGFUSE_AUTH_TIMEOUT_SECONDS)待ち、
+  トレースが無効ならCallbackHandlerを作らない
+  """
+  _start_tracing_check()
+  _tracing_checked.wait(LANGFUSE_AUTH_TIMEOUT_SECONDS + 1)
+  return [CallbackHandler()] if _tracing == TRACING_ENABLED else []
 
-model = init_chat_model(model="gemini-2.5-flash")
+def get_model():
+  global _model
+  with _init_lock:
+    if _model is None:
+      started = time.perf_counter()
+      _model = init_chat_model(model=RCA_MODEL)
+      startup_timings["model_init_seconds"] = round(time.perf_counter() - started, 3)
+      print(f"[startup] Chat model {RCA_MODEL} initialized ({startup_timings['model_init_seconds']}s)")
+    return _model
+
+def get_checkpointer():
+  # 調査の途中経過はSQLiteに保存し、Podが再起動しても続きから再開できるようにする
+  global _checkpointer
+  with _init_lock:
+    if _checkpointer is None:
+      _checkpointer = checkpoint_store.open_saver()
+    return _checkpointer
+
+def _background_init():
+  _start_tracing_check()
+  get_model()
+  get_checkpointer()
+
+def start_background_init():
+  """Webhookサーバの起動を待たせないよう、トレースの確認・モデルとチェックポインタの作成を裏で行う"""
+  threading.Thread(target=_background_init, name="deep-agent-init", daemon=True).start()
+
+def status() -> dict:
+  return {"tracing": _tracing, "model_ready": _model is not None, "startup": startup_timings}
 
 def get_system_prompt(alert_message: str, alert_occurred_time: str) -> str:
 
@@ -37,18 +130,9 @@ def get_system_prompt(alert_message: str, alert_occurred_time: str) -> str:
 You are a Root Cause Analysis (RCA) agent specialized in analyzing alerts from Grafana and investigating their causes using tools below.
 You have access to the following tools:
 1. run_loki_logql: Use this to execute LogQL queries to retrieve logs from Grafana Loki.
-    - NG LogQL example:
-        - `{{{{otelTraceID="c58ff9edaead7b757a3ae3411005945f"}}}}` # Missing curly braces around the selector
-        - `{{{{job="varlogs"}}}} |= "error" | limit 10` # there is no 'limit' clause in LogQL
-        - `{{{{namespace="monitoring", service_name="clickhouse"}}}} | tail` # there is no 'tail' clause in LogQL
-        - `{{{{app="nginx"}}}} | sort` # there is no 'sort' clause in LogQL
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} | sort @timestamp desc | limit 10` # there is no 'limit' or 'sort' clause in LogQL
-        - `{{{{}}}} |~ "be8af83da40279d7f9cfb2bb256009fb"` # labels(selector) are required in LogQL queries
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} | count_over_time([5m])` # wrong `count_over_time` usage
-        - `count_over_time({{{{namespace="monitoring"}}}}[1h]) by (pod)` # by clause is not supported in `count_over_time`
-        - `{{{{service_name=~".*"}}}} |~ "d49cfc23a353cd76f4c8244c373b2b01"` # When using the =~ operator, you cannot specify only ".*" without any other characters. If you want to specify everything without characters, please specify ".+" instead.
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} |~ "error|warn|fail" [1h]` # Wrong usage of range selector (e.g., [1h]); requires `count_over_time` or other functions
-        - `{{{{pod="langfuse-clickhouse-shard0-0"}}}} [30m]` # Wrong usage of range selector (e.g., [30m]); requires `count_over_time` or other functions
+    - By default it covers the time around the alert (from 1 hour before it started until 15 minutes after). Use `start`/`end` (e.g. `alert-6h`, `now-30m` or RFC3339) to look at other periods, and `direction`/`limit` to control which log lines are returned.
+    - The query is validated locally before it is sent to Loki. If it is invalid, the tool returns the error and usually a suggested fix; apply it and retry.
+    - Common mistakes: there is no `| limit`, `| sort` or `| tail` stage in LogQL; a selector must not be empty (`{{{{}}}}`) or match everything (use `=~".+"`, not `=~".*"`); a range such as `[5m]` is only valid inside functions like `count_over_time(...)`.
     - OK LogQL example:
         - `{{{{service_name=~".+"}}}} |= "c58ff9edaead7b757a3ae3411005945f"`
         - `{{{{job=~".*varlogs.*"}}}} |= "error"`
@@ -56,11 +140,15 @@ You have access to the following tools:
 2. get_loki_label_values: Use this to get the values that a specific label has from Grafana Loki.
 3. get_list_of_streams: Use this to get the list of log streams in Grafana Loki.
 4. run_prometheus_promql: Use this to execute PromQL queries to retrieve metrics from Prometheus.
+    - Like run_loki_logql, it covers the time around the alert by default. Use `start`/`end` to look at other periods.
+    - The query is validated locally and its metric and label names are checked against Prometheus before it is sent. If it is invalid, the tool returns the error with similar names or a suggested fix.
 5. get_prometheus_label_values: Use this to get the values that a specific label has from Prometheus.
 6. get_all_prometheus_labels: Use this to get all labels that exist in Prometheus.
 7. get_labels_and_values_for_metric: Use this to get the labels and their values for a specific metric from Prometheus.
 8. run_tempo_query_trace: Use this to execute a trace query against Grafana Tempo.
     -  The format of the trace ID is a 32-character hexadecimal string (e.g., "4bf92f3577b34da6a3ce929d0e0e4736", "98100898d812021273ec14bd273e4dda"). If you find a trace ID in the logs, get detailed trace information using this tool with the trace ID.
+9. search_loki_labels: Use this to search Loki label names related to keywords. The Loki Labels List below may only contain the labels relevant to the alert.
+10. search_prometheus_metrics: Use this to search Prometheus metric names related to keywords. The Metric List below may only contain the metrics relevant to the alert.
 
 ## Available Information
 #### Alert Message
@@ -68,25 +156,88 @@ You have access to the following tools:
 #### Alert Occurred Time
 {alert_occurred_time}
 #### Loki Labels List
-{loki.get_all_loki_labels()}
+{catalogue.get_relevant_loki_labels_text(alert_message)}
 #### Metric List
-{prometheus.get_all_metrics()}
+{catalogue.get_relevant_metrics_text(alert_message)}
 """
 
     return system_prompt
 
-tools = [loki.run_loki_logql, loki.get_loki_label_values, loki.get_list_of_streams, prometheus.run_prometheus_promql, prometheus.get_prometheus_label_values, prometheus.get_all_prometheus_labels, prometheus.get_labels_and_values_for_metric, tempo.run_tempo_query_trace]
+tools = [loki.run_loki_logql, loki.get_loki_label_values, loki.get_list_of_streams, loki.search_loki_labels, prometheus.run_prometheus_promql, prometheus.get_prometheus_label_values, prometheus.get_all_prometheus_labels, prometheus.get_labels_and_values_for_metric, prometheus.search_prometheus_metrics, tempo.run_tempo_query_trace]
 
-def start_alert_cause_analysis(alert_info: dict):
+def start_alert_cause_analysis(alert_info: dict, raw_alert: dict = None) -> str:
+  # 同じアラートの同じ発火は同じスレッドIDになる。完了済みなら保存した結果を返し、中断されていれば続きから再開する
+  thread_id = checkpoint_store.thread_id_for(alert_info.labels, alert_info.starts_at)
+  record = checkpoint_store.store.get(thread_id)
+  if record is not None and record["status"] == checkpoint_store.COMPLETED:
+    print(f"[checkpoint] Investigation {thread_id} has already been completed. Returning the saved result.")
+    return record["result"]
+  checkpoint_store.store.start(thread_id, raw_alert or asdict(alert_info))
 
   alert_message = f"AlertName: {alert_info.labels.get('alertname')}\nLabels: {alert_info.labels}\nAnnotations: {alert_info.annotations}\nQuery: {alert_info.query}\nLog Message: {alert_info.log_message}"
-  alert_occurred_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-
-  deep_agent = create_deep_agent(
-    model=model,
-    tools=tools,
-    system_prompt=get_system_prompt(alert_message, alert_occurred_time)
-  )
-  deep_agent.invoke({
+  # ツールのクエリ対象期間はアラートの発生時刻を基準にする
+  started_at = query_window.parse_alert_time(alert_info.starts_at)
+  query_window.set_alert_started_at(started_at)
+  if started_at is not None:
+    alert_occurred_time = f"{started_at.astimezone().strftime('%Y-%m-%d %H:%M:%S')} ({started_at.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')})"
+  else:
+    alert_occurred_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
+  if subagents.RCA_DEEP_AGENT_MODE == "flat":
+    deep_agent = create_deep_agent(
+      model=get_model(),
+      tools=tools,
+      system_prompt=get_system_prompt(alert_message, alert_occurred_time),
+      checkpointer=get_checkpointer(),
+    )
+  else:
+    # プランナーはツールを直接持たず、ログ・メトリクス・トレースのサブエージェントを並列に呼び出して結果をまとめる
+    deep_agent = create_deep_agent(
+      model=get_model(),
+      tools=[],
+      system_prompt=subagents.get_planner_prompt(alert_message, alert_occurred_time),
+      subagents=subagents.build_subagents(alert_message, alert_occurred_time),
+      checkpointer=get_checkpointer(),
+    )
+  config = {"configurable": {"thread_id": thread_id}, "callbacks": get_callbacks()}
+  inputs = {
       "messages": [{"role": "user", "content": "analyze what is alert cause."}],
-  }, config={"callbacks": [langfuse_handler]})
\ No newline at end of file
+  }
+  # 調査の途中経過(モデルの考察・ツール呼び出し・ツール結果)を完了を待たずにシンクへ流す
+  stream = sinks.InvestigationStream(thread_id, alert_info.labels.get("alertname", ""))
+  stream.started(alert_message)
+  snapshot = deep_agent.get_state(config)
+  # o11y-toolのエンドポイントごとのレイテンシを調査ごとに集計する(ツールを実行するスレッドにもcontextvarがコピーされる)
+  latency_stats = http_client.start_investigation()
+  try:
+    if snapshot.values.get("messages") and not snapshot.next:
+      # 最後まで進んだが、完了を記録する前に中断されていた
+      result = snapshot.values
+    else:
+      if snapshot.values.get("messages"):
+        # 入力を渡さず、チェックポイントの続きから実行する(完了済みのツール呼び出しは再実行されない)
+        print(f"[checkpoint] Resuming investigation {thread_id} ({len(snapshot.values['messages'])} messages, next: {snapshot.next})")
+        inputs = None
+        # チェックポイントまでのメッセージは前回の実行でシンクに流しているため、再開後に流し直さない
+        stream.mark_published(snapshot.values["messages"])
+      # "updates"で各ステップの差分をシンクに流し、"values"の最後の値を最終Stateとして使う(invokeの戻り値と同じ)
+      for mode, chunk in deep_agent.stream(inputs, config=config, stream_mode=["updates", "values"]):
+        if mode == "values":
+          result = chunk
+        else:
+          stream.update(chunk)
+  except Exception as e:
+    checkpoint_store.store.fail(thread_id, repr(e))
+    stream.failed(repr(e))
+    raise
+  finally:
+    print(f"[http_client] investigation latency: {latency_stats.as_dict()}")
+
+  answer = result["messages"][-1].content
+  checkpoint_store.store.complete(thread_id, answer)
+  stream.finished(result["messages"][-1].text)
+  # 完了した調査のチェックポイントは不要なので削除する(結果はinvestigationsテーブルに残る)
+  get_checkpointer().delete_thread(thread_id)
+  return answer
+startup_timings["import_seconds"] = round(time.perf_counter() - _import_started, 3)
+print(f"[startup] deep_agent imported in {startup_timings['import_seconds']}s")
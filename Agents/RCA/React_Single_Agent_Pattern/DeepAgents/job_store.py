@@ -0,0 +1,141 @@
+## 分析ジョブの記録
+## Webhookで受け取ったアラートごとにジョブIDを払い出し、状態(queued/running/completed/failed)と分析結果をSQLiteに保存する。
+## Webhookの接続を分析の完了まで保持せず、GET /jobs/<id> で結果を取得できるようにする。
+## 再起動時は終わっていないジョブをキューに積み直す(調査自体はチェックポイントの続きから再開される)
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+RCA_JOB_DB = os.getenv("RCA_JOB_DB", "rca_jobs.sqlite")
+RCA_JOB_RETENTION_HOURS = int(os.getenv("RCA_JOB_RETENTION_HOURS", "168"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+class JobStore:
+
+    def __init__(self, path: str = RCA_JOB_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        """self._lockを取得した状態で呼ぶこと"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    thread_id TEXT NOT NULL,
+                    alert_name TEXT,
+                    alert TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_thread_id ON jobs (thread_id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _row(self, row) -> dict | None:
+        if row is None:
+            return None
+        job_id, thread_id, alert_name, alert, status, result, error, created_at, started_at, finished_at = row
+        return {
+            "job_id": job_id,
+            "thread_id": thread_id,
+            "alert_name": alert_name,
+            "alert": json.loads(alert),
+            "status": status,
+            "result": result,
+            "error": error,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+
+    def create(self, alert: dict, thread_id: str) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO jobs (job_id, thread_id, alert_name, alert, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, thread_id, alert.get("labels", {}).get("alertname"), json.dumps(alert, ensure_ascii=False, default=str), QUEUED, time.time()),
+            )
+            self._db().commit()
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._db().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row(row)
+
+    def find_unfinished(self, thread_id: str) -> dict | None:
+        """同じ調査(スレッドID)のqueued/runningのジョブ"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT * FROM jobs WHERE thread_id = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                (thread_id, QUEUED, RUNNING),
+            ).fetchone()
+        return self._row(row)
+
+    def delete(self, job_id: str):
+        """キューに積めなかったジョブを取り消す"""
+        with self._lock:
+            self._db().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._db().commit()
+
+    def start(self, job_id: str):
+        with self._lock:
+            self._db().execute("UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ?", (RUNNING, time.time(), job_id))
+            self._db().commit()
+
+    def complete(self, job_id: str, result):
+        if not isinstance(result, str):
+            result = json.dumps(result, ensure_ascii=False, default=str)
+        self._finish(job_id, COMPLETED, result=result)
+        self.prune()
+
+    def fail(self, job_id: str, error: str):
+        self._finish(job_id, FAILED, error=error)
+
+    def _finish(self, job_id: str, status: str, result: str = None, error: str = None):
+        with self._lock:
+            self._db().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                (status, result, error, time.time(), job_id),
+            )
+            self._db().commit()
+
+    def unfinished(self) -> list[dict]:
+        """前回のプロセスで終わらなかった(queued/runningのまま残った)ジョブ。起動時に呼ぶこと"""
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def prune(self):
+        """保持期間を過ぎた完了・失敗済みのジョブを削除する"""
+        cutoff = time.time() - RCA_JOB_RETENTION_HOURS * 3600
+        with self._lock:
+            self._db().execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?", (COMPLETED, FAILED, cutoff))
+            self._db().commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {"path": self.path, **{status: count for status, count in rows}}
+
+store = JobStore()
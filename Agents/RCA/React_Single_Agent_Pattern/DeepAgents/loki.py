@@ -1,23 +1,28 @@
 import requests
 from typing import Annotated
 
-LOKI_WRAPPER_ENDPOINT = "http://o11y-tool:8070/o11y/loki/api/v1"
+import catalogue
+import http_client
+import log_compactor
+import logql_validator
+import query_window
 
-def get_all_loki_labels() -> str:
-  try:
-    result = requests.post(f"{LOKI_WRAPPER_ENDPOINT}/labels", timeout=10)
-    result_json = result.json()
-    all_labels_exist = ", ".join(result_json) # Listで返ってくるので、文字列に変換
-    print(f"List of labels: {all_labels_exist}")
-  except requests.exceptions.RequestException as e:
-    print(f"Failed to get labels from Loki. Error: {repr(e)}")
-    all_labels_exist = f"Failed to get labels from Loki. Error: {repr(e)}"
+LOKI_WRAPPER_ENDPOINT = "http://o11y-tool:8070/o11y/loki/api/v1"
+SEARCH_RESULT_LIMIT = 30
 
-  return all_labels_exist
+def fetch_all_loki_labels() -> list:
+  # 取得に失敗した場合は例外をそのまま投げる(catalogue側で古い値を使い続けるため)
+  result = http_client.post(f"{LOKI_WRAPPER_ENDPOINT}/labels")
+  result.raise_for_status()
+  return result.json()
 
 def run_loki_logql(
-  query: Annotated[str, "The LogQL query to excute against Grafana Loki."]
-  # TODO: デフォルトでは1時間前までのログを対象とする。もしそれより前のログが必要な場合はstart引数も追加（バックエンドのloki.go側でUNIX TIMESTAMPに変換する必要あり）
+  query: Annotated[str, "The LogQL query to excute against Grafana Loki."],
+  start: Annotated[str, "Start of the time range: RFC3339, Unix seconds, or relative to the alert start or now (e.g. 'alert-1h', 'now-30m'). Defaults to 1 hour before the alert started."] = "",
+  end: Annotated[str, "End of the time range, in the same formats as start. Defaults to 15 minutes after the alert started (or now)."] = "",
+  step: Annotated[str, "Resolution of metric queries such as count_over_time (e.g. '1m'). Chosen automatically if omitted."] = "",
+  direction: Annotated[str, "Order of log lines: 'backward' (newest first) or 'forward' (oldest first)."] = "backward",
+  limit: Annotated[int, "Maximum number of log lines to return (1-1000)."] = query_window.LOKI_DEFAULT_LIMIT,
 ) -> str:
   """
   Use this to excute LogQL query against Grafana Loki.
@@ -31,20 +36,42 @@ def run_loki_logql(
     - {service_name="alloy"} | limit 10
     - {service_name="alloy"} | count_over_time(1s)
 
+  By default the query covers the time around the alert (from 1 hour before it started until 15 minutes after).
+  Use start/end to look at other periods, e.g. start='alert-6h' to see when an error first appeared.
+
   Args:
-      query: LogQL query to excute for Grafana Loki.(Do not include "limit" in the query, as LogQL does not have a "limit" clause.)
+      query: LogQL query to excute for Grafana Loki.(Do not include "limit" in the query, as LogQL does not have a "limit" clause. Use the limit argument instead.)
+      start: Start of the time range.
+      end: End of the time range.
+      step: Resolution of metric queries.
+      direction: Order of log lines.
+      limit: Maximum number of log lines to return.
   Returns:
       The result of the LogQL queries.
   """
 
-  params = {
-    'query': query
-  }
+  # 明らかに不正なクエリはLokiに送らず、その場でエラーと修正案を返す
+  issues = logql_validator.validate(query)
+  if issues:
+    return logql_validator.format_issues(query, issues)
+
+  # アラートの発生時刻を基準に期間を決め、stepは1系列あたりの点数が上限に収まるように決める
+  try:
+    window = query_window.resolve(start, end, step)
+    params = {
+      'query': query,
+      **window.loki_params(query_window.loki_direction(direction), query_window.loki_limit(limit)),
+    }
+  except ValueError as e:
+    return f"Invalid time range for LogQL: {query}. Error: {e}"
 
   try:
-    result = requests.post(f"{LOKI_WRAPPER_ENDPOINT}/query_range", params=params, timeout=10)
-    print(f"[run_loki_logql] LogQL: {query}, Result: {result.json()}")
-    result_str = f"""#### LogQL\n`{query}`\n\n#### Result\n{result.json()}"""
+    result = http_client.post(f"{LOKI_WRAPPER_ENDPOINT}/query_range", params=params)
+    result_json = result.json()
+    # 生のレスポンスではなく、重複排除・トークン予算内に圧縮した結果をLLMに渡す
+    compacted = log_compactor.compact_loki_result(result_json)
+    print(f"[run_loki_logql] LogQL: {query}, Time range: {window.describe()}, Result: {len(str(result_json))} chars -> {len(compacted)} chars")
+    result_str = f"""#### LogQL\n`{query}`\n\n#### Time range\n{window.describe()}\n\n#### Result\n{compacted}"""
     return result_str
   except requests.exceptions.RequestException as e:
     print(f"Failed to execute LogQL. Error: {repr(e)}")
@@ -69,7 +96,7 @@ def get_loki_label_values(
   }
 
   try:
-    result = requests.post(f"{LOKI_WRAPPER_ENDPOINT}/label_values", params=params, timeout=10)
+    result = http_client.post(f"{LOKI_WRAPPER_ENDPOINT}/label_values", params=params)
     result_json = result.json()
     values_label_has = f"""#### Loki Label\n`{label}`\n\n#### Values of label\n{", ".join(result_json)}"""
     print(f"the values that the label has: {values_label_has}")
@@ -96,11 +123,32 @@ def get_list_of_streams(
   }
 
   try:
-    result = requests.post(f"{LOKI_WRAPPER_ENDPOINT}/streams_selector_has", params=params, timeout=10)
+    result = http_client.post(f"{LOKI_WRAPPER_ENDPOINT}/streams_selector_has", params=params)
     result_json = result.json()
     print(f"the streams that the label selector has: {result_json}")
     result_str = f"""#### Label Selector\n`{selector}`\n\n#### Streams\n{result_json}"""
     return result_str
   except requests.exceptions.RequestException as e:
     print(f"Failed to get the streams of label selector [{selector}] from Loki. Error: {repr(e)}")
-    return f"Failed to get the streams of label selector [{selector}] from Loki. Error: {repr(e)}"
\ No newline at end of file
+    return f"Failed to get the streams of label selector [{selector}] from Loki. Error: {repr(e)}"
+
+def search_loki_labels(
+  keyword: Annotated[str, "Keywords to search for in Loki label names (e.g., 'namespace', 'pod', 'trace')."]
+) -> str:
+  """
+  Use this to search label names in Grafana Loki that are related to the keywords.
+  The system prompt lists only the labels relevant to the alert, so use this to find other labels.
+
+  Args:
+    keyword: Keywords to search for in label names.
+  Returns:
+    The label names related to the keywords.
+  """
+
+  labels = catalogue.loki_labels.search(keyword, top_n=SEARCH_RESULT_LIMIT)
+  if not labels:
+    # トークンで一致しない場合は部分一致で探す
+    labels = [label for label in catalogue.loki_labels.get() if keyword.lower() in label.lower()][:SEARCH_RESULT_LIMIT]
+  if not labels:
+    return f"No labels matched the keywords: {keyword}"
+  return f"""#### Loki labels related to `{keyword}`\n{", ".join(labels)}"""
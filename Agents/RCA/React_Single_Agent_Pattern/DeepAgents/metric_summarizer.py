@@ -0,0 +1,171 @@
+## メトリクスのrange query結果(matrix)をLLMに渡す前に数値の要約に変換する
+## 生の[timestamp, value]の羅列の代わりに、系列ごとに以下を出力する
+## - min / max / mean / p95 / 最新値 / 傾き
+## - スパイク(外れ値)とステップ変化(レベルの急変)の時刻
+## - ダウンサンプリングしたスパークライン
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+# 出力する系列数の上限(超えた分は最大値の大きい順に残す)
+METRIC_SUMMARY_MAX_SERIES = int(os.getenv("METRIC_SUMMARY_MAX_SERIES", "20"))
+SPARKLINE_WIDTH = 24
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+# robust z-score(中央値とMADから計算)がこれを超える点をスパイクとみなす
+SPIKE_Z_THRESHOLD = 3.5
+MAX_EVENTS = 3
+
+def _format_time(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def _format_number(value: float) -> str:
+    return f"{value:.4g}"
+
+def _format_labels(labels: dict) -> str:
+    return "{" + ", ".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+def to_arrays(entries: list) -> tuple[np.ndarray, np.ndarray]:
+    timestamps = np.fromiter((float(e["timestamp"]) for e in entries), dtype=np.float64, count=len(entries))
+    # Prometheusの値は文字列("NaN", "+Inf"を含む)で返ってくる
+    values = np.fromiter((float(e["value"]) for e in entries), dtype=np.float64, count=len(entries))
+    return timestamps, values
+
+def sparkline(values: np.ndarray, width: int = SPARKLINE_WIDTH) -> str:
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return ""
+    # 幅に合わせてバケットごとの平均にダウンサンプリングする
+    buckets = np.array_split(np.where(np.isfinite(values), values, np.nan), min(width, values.size))
+    means = np.array([np.nanmean(b) if np.isfinite(b).any() else np.nan for b in buckets])
+    low, high = finite.min(), finite.max()
+    if high == low:
+        return SPARKLINE_CHARS[0] * means.size
+    levels = np.clip(((means - low) / (high - low) * (len(SPARKLINE_CHARS) - 1)).round(), 0, len(SPARKLINE_CHARS) - 1)
+    return "".join(" " if np.isnan(level) else SPARKLINE_CHARS[int(level)] for level in levels)
+
+def detect_spikes(timestamps: np.ndarray, values: np.ndarray) -> list[str]:
+    # 移動中央値からの乖離で判定し、ステップ変化後の点がスパイク扱いにならないようにする
+    window = max(5, values.size // 20) | 1
+    if values.size < window:
+        return []
+    padded = np.pad(values, window // 2, mode="edge")
+    baseline = np.median(np.lib.stride_tricks.sliding_window_view(padded, window), axis=1)
+    residual = values - baseline
+    centered = residual - np.median(residual)
+    mad = np.median(np.abs(centered))
+    if mad > 0:
+        scale = mad / 0.6745
+    else:
+        # 平坦な系列に外れ値が数点だけある場合(エラー数・再起動数・upなど)はMADが0になるため、平均絶対偏差で代用する
+        scale = np.mean(np.abs(centered)) * 1.2533
+    if scale == 0:
+        return []
+    z = centered / scale
+    # 統計的に外れているだけでなく、値の振れ幅に対しても十分大きいものだけを残す(ノイズ対策)
+    candidates = np.flatnonzero((np.abs(z) > SPIKE_Z_THRESHOLD) & (np.abs(residual) > 0.1 * np.ptp(values)))
+    top = candidates[np.argsort(-np.abs(z[candidates]))][:MAX_EVENTS]
+    return [f"{_format_time(timestamps[i])}={_format_number(values[i])} (z={z[i]:+.1f})" for i in sorted(top)]
+
+def detect_step_changes(timestamps: np.ndarray, values: np.ndarray) -> list[str]:
+    n = values.size
+    window = max(3, n // 10)
+    if n < window * 2:
+        return []
+
+    # 各点の前後windowの平均の差を累積和でまとめて計算する
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    index = np.arange(window, n - window + 1)
+    mean_delta = (cumsum[index + window] - 2 * cumsum[index] + cumsum[index - window]) / window
+
+    # 差分の標準偏差はスパイク1つで大きくなり、同じ系列のステップ変化を隠してしまうため、差分の絶対値の中央値から推定する
+    noise = np.median(np.abs(np.diff(values))) / 0.6745 or 1e-12
+    # 変化量の下限もスパイクで広がらないよう、外れ値を除いた値の幅を基準にする
+    low, high = np.percentile(values, [5, 95])
+    value_range = high - low
+
+    def is_significant(delta):
+        return (np.abs(delta) > 3 * noise) & (np.abs(delta) > 0.2 * value_range)
+
+    # 平均の差はスパイク1つでも前後2回のステップ変化に見えるため、平均の差で絞った候補を前後の中央値の差で確かめる
+    candidates = np.flatnonzero(is_significant(mean_delta))
+    before = np.array([np.median(values[index[i] - window:index[i]]) for i in candidates])
+    after = np.array([np.median(values[index[i]:index[i] + window]) for i in candidates])
+    confirmed = is_significant(after - before)
+    significant = candidates[confirmed]
+    if significant.size == 0:
+        return []
+    medians = {i: (b, a) for i, b, a in zip(significant, before[confirmed], after[confirmed])}
+
+    # 近接した候補はまとめて、変化量が最大の点だけを残す
+    events = []
+    for i in significant[np.argsort(-np.abs(mean_delta[significant]))]:
+        if all(abs(i - j) >= window for j in events):
+            events.append(i)
+        if len(events) >= MAX_EVENTS:
+            break
+    return [
+        f"{_format_time(timestamps[index[i]])} median {_format_number(medians[i][0])} -> {_format_number(medians[i][1])}"
+        for i in sorted(events)
+    ]
+
+def summarize_series(labels: dict, entries: list) -> str:
+    if not entries:
+        return f"{_format_labels(labels)}: no data points"
+
+    timestamps, values = to_arrays(entries)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return f"{_format_labels(labels)}: {values.size} points, all NaN/Inf"
+    t, v = timestamps[finite], values[finite]
+
+    step = int(np.median(np.diff(t))) if t.size > 1 else 0
+    # 傾きは1分あたりの変化量(最小二乗法)
+    slope = np.polyfit((t - t[0]) / 60, v, 1)[0] if t.size > 1 and t[-1] > t[0] else 0.0
+    if abs(slope) < 1e-12 * max(abs(v).max(), 1.0):
+        slope = 0.0
+
+    lines = [
+        f"{_format_labels(labels)}: n={values.size} ({_format_time(timestamps[0])} ~ {_format_time(timestamps[-1])}, step {step}s)",
+        f"  min={_format_number(v.min())} max={_format_number(v.max())} mean={_format_number(v.mean())} "
+        f"p95={_format_number(np.percentile(v, 95))} last={_format_number(v[-1])} slope={slope:+.4g}/min",
+    ]
+    spikes = detect_spikes(t, v)
+    if spikes:
+        lines.append(f"  spikes: {', '.join(spikes)}")
+    steps = detect_step_changes(t, v)
+    if steps:
+        lines.append(f"  step changes: {', '.join(steps)}")
+    lines.append(f"  sparkline: {sparkline(values)}")
+    return "\n".join(lines)
+
+def summarize_matrix(series_list: list, max_series: int = METRIC_SUMMARY_MAX_SERIES) -> str:
+    """o11y-toolが返すmatrix結果([{labels, entries}, ...])を系列ごとの要約テキストに変換する"""
+
+    def peak(series) -> float:
+        try:
+            _, values = to_arrays(series.get("entries", []))
+        except (KeyError, ValueError):
+            return float("-inf")
+        finite = values[np.isfinite(values)]
+        return finite.max() if finite.size else float("-inf")
+
+    selected = series_list
+    if len(series_list) > max_series:
+        selected = sorted(series_list, key=peak, reverse=True)[:max_series]
+
+    summaries = [summarize_series(s.get("labels", {}), s.get("entries", [])) for s in selected]
+    if len(series_list) > len(selected):
+        summaries.append(
+            f"... {len(series_list) - len(selected)} more series with lower peak values were omitted. "
+            "Aggregate (e.g., sum by / topk) or filter the query to see them."
+        )
+    return "\n".join(summaries)
+
+def summarize_metric_result(result_json) -> str:
+    """o11y-toolのPrometheusラッパーが返すJSON(list)を要約テキストに変換する"""
+    if not isinstance(result_json, list) or not result_json or result_json[0].get("data_type") != "metric":
+        # データなし・エラーの場合はそのまま返す
+        return str(result_json)
+    series_list = result_json[1:]
+    return f"data_type: metric, series: {len(series_list)}\n{summarize_matrix(series_list)}"
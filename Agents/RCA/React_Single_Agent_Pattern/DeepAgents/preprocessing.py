@@ -3,6 +3,7 @@ import requests
 from dotenv import load_dotenv
 import os
 
+import alert_rule_cache
 import deep_agent
 
 load_dotenv('.env')
@@ -15,6 +16,8 @@ class AlertData:
     annotations: dict
     query: str
     log_message: str = ""
+    # アラートの発生時刻(GrafanaのstartsAt, RFC3339)。ツールのクエリ対象期間の基準になる
+    starts_at: str = ""
 
 def get_query_in_alert_from_grafana(generator_url: str) -> str:
     # print(f"[DEBUG] Original generatorURL: {generator_url}")
@@ -26,36 +29,17 @@ def get_query_in_alert_from_grafana(generator_url: str) -> str:
     try:
         alert_uid = generator_url.split("/")[-2]
         # print(f"[DEBUG] Extracted alert_uid: {alert_uid}")
-        SPECIFIC_ALERT_RULE_ENDPOINT = "http://grafana:3000/api/v1/provisioning/alert-rules/" + alert_uid
-        # print(f"[DEBUG] Constructed API Endpoint: {SPECIFIC_ALERT_RULE_ENDPOINT}")
     except IndexError as e:
         print("Invalid generatorURL format")
         raise e
 
     try:
-        headers = {
-            "Authorization": f"Bearer {grafana_api_key}",
-        }
-
-        response = requests.get(SPECIFIC_ALERT_RULE_ENDPOINT, headers=headers, timeout=5)
-        # print(f"[DEBUG] Response Status Code: {response.status_code}")
-        # print(f"[DEBUG] Response Body (first 500 chars): {response.text[:500]}")
-
-        response.raise_for_status()
-
-        # レスポンスが空でないか確認
-        if not response.text:
-            print("[Warning] Empty response from Grafana API")
-            return ""
-
-        try:
-            response_json = response.json()
-            # print(f"[DEBUG] Parsed JSON Response: {json.dumps(response_json, indent=2)}")
-        except ValueError as e:
-            print(f"[Warning] Failed to parse JSON response: {e}")
+        # ルール定義はUIDごとにキャッシュし、TTL切れの場合のみGrafanaに再検証する
+        rule = alert_rule_cache.cache.get(alert_uid)
+        if rule is None:
             return ""
 
-        queries = ", ".join([d["model"]["expr"] for d in response_json["data"] if "expr" in d["model"]])
+        queries = alert_rule_cache.extract_queries(rule)
         # print(f"[DEBUG] Extracted Queries: {queries}")
         return queries
     except requests.RequestException as e:
@@ -76,6 +60,7 @@ def extract_alert_info(alert_data: dict) -> str:
         annotations=annotations,
         query=query,
         log_message=log_message,
+        starts_at=alert_data.get("startsAt", ""),
     )
     # print(f"Extracted Alert Info: {alert_info}")
     return alert_info
\ No newline at end of file
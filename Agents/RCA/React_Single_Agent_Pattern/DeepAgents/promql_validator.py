@@ -0,0 +1,395 @@
+## PromQLのローカル検証
+## モデルが書いたPromQLをPrometheusに送る前に字句解析し、構文の誤り(括弧の対応、関数の引数の範囲指定漏れ、
+## 関数呼び出しへの範囲指定、Grafanaのテンプレート変数など)をその場で指摘する。
+## さらに参照しているメトリクス名・ラベル名をカタログ(catalogue.py)と突き合わせ、存在しない名前には近い名前を提案する。
+## 存在しないメトリクスへのクエリはエラーにならず空の結果が返るため、モデルが別のクエリを何度も試す原因になっていた。
+## PromQLの完全なパーサではない(ここで検出できなかった誤りはPrometheus側でエラーになる)
+import difflib
+import re
+from dataclasses import dataclass
+
+import catalogue
+import catalogue_index
+
+AGGREGATIONS = {
+    "sum", "min", "max", "avg", "group", "stddev", "stdvar", "count", "count_values",
+    "bottomk", "topk", "quantile", "limitk", "limit_ratio",
+}
+# 範囲ベクトル(metric[5m])を引数に取る関数
+RANGE_FUNCTIONS = {
+    "rate", "irate", "increase", "delta", "idelta", "deriv", "predict_linear", "changes", "resets",
+    "holt_winters", "double_exponential_smoothing", "avg_over_time", "min_over_time", "max_over_time",
+    "sum_over_time", "count_over_time", "quantile_over_time", "stddev_over_time", "stdvar_over_time",
+    "last_over_time", "present_over_time", "absent_over_time", "mad_over_time",
+}
+FUNCTIONS = RANGE_FUNCTIONS | {
+    "abs", "absent", "ceil", "clamp", "clamp_max", "clamp_min", "day_of_month", "day_of_week", "day_of_year",
+    "days_in_month", "exp", "floor", "histogram_avg", "histogram_count", "histogram_fraction", "histogram_quantile",
+    "histogram_stddev", "histogram_stdvar", "histogram_sum", "hour", "label_join", "label_replace", "ln", "log2",
+    "log10", "minute", "month", "round", "scalar", "sgn", "sort", "sort_desc", "sort_by_label", "sort_by_label_desc",
+    "sqrt", "time", "timestamp", "vector", "year", "info", "start", "end", "pi", "deg", "rad",
+    "acos", "acosh", "asin", "asinh", "atan", "atanh", "cos", "cosh", "sin", "sinh", "tan", "tanh",
+}
+GROUPING_KEYWORDS = {"by", "without", "on", "ignoring", "group_left", "group_right"}
+KEYWORDS = GROUPING_KEYWORDS | {"and", "or", "unless", "bool", "offset", "atan2", "inf", "nan"}
+MATCHER_OPERATORS = {"=", "!=", "=~", "!~"}
+DEFAULT_RANGE = "5m"
+# 存在しない名前をこの類似度以上の名前に置き換えた修正案を出す
+FIX_SIMILARITY = 0.85
+
+_DURATION_PATTERN = re.compile(r"^(\d+(ms|s|m|h|d|w|y))+$|^\d+(\.\d+)?$")
+_GRAFANA_VARIABLE_PATTERN = re.compile(r"\$\{?__(rate_interval|interval|range)(_ms|_s)?\}?|\[\[[^\]]*\]\]|\$\{?\w+\}?")
+_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)
+    | (?P<number>0[xX][0-9a-fA-F]+|\d+(\.\d+)?([eE][+-]?\d+)?[A-Za-z]*|\.\d+)
+    | (?P<ident>[A-Za-z_:][A-Za-z0-9_:]*)
+    | (?P<op>==|!=|=~|!~|>=|<=|[-+*/%^=<>])
+    | (?P<punct>[{}()\[\],:@])
+    """,
+    re.VERBOSE,
+)
+
+@dataclass
+class Token:
+    kind: str
+    text: str
+    start: int
+    end: int
+
+@dataclass
+class Issue:
+    message: str
+    # 修正後のクエリ(自動で直せない場合はNone)
+    fix: str | None = None
+
+class _LexError(Exception):
+
+    def __init__(self, message: str, fix: str | None = None):
+        super().__init__(message)
+        self.fix = fix
+
+def tokenize(query: str) -> list[Token]:
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = _TOKEN_PATTERN.match(query, position)
+        if match is None:
+            if query[position] in "$[":
+                # Grafanaのダッシュボードからコピーしたクエリのテンプレート変数
+                fix = _GRAFANA_VARIABLE_PATTERN.sub(DEFAULT_RANGE, query)
+                raise _LexError(
+                    f"Grafana template variables such as `$__rate_interval` are not available here (at position {position}). "
+                    f"Use a literal duration such as `{DEFAULT_RANGE}` or a literal label value.",
+                    fix if fix != query else None,
+                )
+            if query[position] in "\"'`":
+                raise _LexError(f"Unterminated string literal starting at position {position}: {query[position:position + 20]}")
+            raise _LexError(f"Unexpected character {query[position]!r} at position {position}.")
+        if match.lastgroup != "space":
+            tokens.append(Token(match.lastgroup, match.group(), match.start(), match.end()))
+        position = match.end()
+    return tokens
+
+def _unquote(text: str) -> str:
+    if text.startswith("`"):
+        return text[1:-1]
+    return re.sub(r"\\(.)", r"\1", text[1:-1])
+
+def _matches_empty(operator: str, value: str) -> bool:
+    if operator == "=":
+        return value == ""
+    if operator == "!=":
+        return value != ""
+    try:
+        matched = re.fullmatch(value, "") is not None
+    except re.error:
+        return False
+    return matched if operator == "=~" else not matched
+
+def _splice(query: str, start: int, end: int, replacement: str) -> str:
+    return (query[:start] + replacement + query[end:]).strip()
+
+def similar_names(name: str, index: "catalogue_index.NameIndex", n: int = 3) -> list[str]:
+    """カタログの中からnameに近い名前を返す。検索インデックスで候補を絞ってから文字列の類似度で並べる"""
+    candidates = index.search(name, top_n=30)
+    close = difflib.get_close_matches(name, candidates, n=n, cutoff=0.6)
+    if not close and len(index) <= 2000:
+        # 名前が少なければ全件から探す(ラベル名など)
+        close = difflib.get_close_matches(name, index.names, n=n, cutoff=0.6)
+    return close or candidates[:n]
+
+def _did_you_mean(names: list[str]) -> str:
+    if not names:
+        return ""
+    return " Did you mean: " + ", ".join(f"`{name}`" for name in names) + "?"
+
+class _Checker:
+
+    def __init__(self, query: str, tokens: list[Token]):
+        self.query = query
+        self.tokens = tokens
+        self.issues = []
+        # 各トークンが含まれる括弧の開きトークンのインデックス
+        self.enclosing = [None] * len(tokens)
+        # 開き括弧のインデックス -> 対応する閉じ括弧のインデックス
+        self.closing = {}
+        # (トークンのインデックス, 名前)
+        self.metric_names = []
+        self.label_names = []
+        # label_replace等で新しく作られるラベル名(文字列リテラル)
+        self.string_values = set()
+
+    def run(self) -> list[Issue]:
+        if not self._check_brackets():
+            return self.issues
+        self._walk()
+        if self.issues:
+            # 構文の誤りがあれば、名前の確認より先にそれを直させる
+            return self.issues
+        self._check_metric_names()
+        self._check_label_names()
+        return self.issues
+
+    def _check_brackets(self) -> bool:
+        pairs = {")": "(", "]": "[", "}": "{"}
+        stack = []
+        for i, token in enumerate(self.tokens):
+            self.enclosing[i] = stack[-1] if stack else None
+            if token.text in "([{" and token.kind == "punct":
+                stack.append(i)
+            elif token.text in pairs and token.kind == "punct":
+                if not stack or self.tokens[stack[-1]].text != pairs[token.text]:
+                    self.issues.append(Issue(f"Unbalanced `{token.text}` at position {token.start}."))
+                    return False
+                self.closing[stack.pop()] = i
+        if stack:
+            token = self.tokens[stack[-1]]
+            self.issues.append(Issue(f"`{token.text}` at position {token.start} is never closed."))
+            return False
+        return True
+
+    def _text(self, i: int) -> str:
+        return self.tokens[i].text if 0 <= i < len(self.tokens) else ""
+
+    def _in(self, i: int, bracket: str) -> bool:
+        parent = self.enclosing[i]
+        return parent is not None and self.tokens[parent].text == bracket
+
+    def _walk(self):
+        skip = set()
+        for i, token in enumerate(self.tokens):
+            if i in skip:
+                continue
+            if token.kind == "string":
+                self.string_values.add(_unquote(token.text))
+            elif token.text == "{":
+                self._check_selector(i)
+            elif token.text == "[":
+                self._check_range(i)
+            elif token.kind == "ident" and not self._in(i, "["):
+                skip |= self._check_identifier(i)
+
+    def _check_identifier(self, i: int) -> set:
+        """識別子の種類(キーワード・関数・ラベル名・メトリクス名)を判別する。読み飛ばすトークンのインデックスを返す"""
+        token = self.tokens[i]
+        name = token.text
+        lower = name.lower()
+        following = self._text(i + 1)
+
+        if self._in(i, "{"):
+            # セレクタ内のラベル名は_check_selectorで確認する
+            return set()
+        if lower in GROUPING_KEYWORDS:
+            if following != "(":
+                return set()
+            close = self.closing[i + 1]
+            labels = set(range(i + 2, close))
+            for j in labels:
+                if self.tokens[j].kind == "ident":
+                    self.label_names.append((j, self.tokens[j].text))
+            return labels
+        if lower in KEYWORDS:
+            return set()
+        if following == "(" or (name in AGGREGATIONS and following.lower() in ("by", "without")):
+            self._check_call(i)
+            return set()
+        if self._text(i - 1) == "@":
+            return set()
+        self.metric_names.append((i, name))
+        return set()
+
+    def _check_call(self, i: int):
+        name = self.tokens[i].text
+        if name not in FUNCTIONS and name not in AGGREGATIONS:
+            close = difflib.get_close_matches(name, sorted(FUNCTIONS | AGGREGATIONS), n=3, cutoff=0.6)
+            self.issues.append(Issue(f"Unknown function `{name}`.{_did_you_mean(close)}"))
+            return
+        if name not in RANGE_FUNCTIONS:
+            return
+        open_index = i + 1
+        close_index = self.closing[open_index]
+        if any(self.tokens[j].text == "[" and self.enclosing[j] == open_index for j in range(open_index + 1, close_index)):
+            return
+        # 引数が単純なセレクタ1つだけなら、範囲を付け足す修正案を出す
+        fix = None
+        arguments = self.tokens[open_index + 1:close_index]
+        if arguments and arguments[0].kind in ("ident", "punct") and not any(t.text in (",", "(") for t in arguments):
+            position = self.tokens[close_index].start
+            fix = _splice(self.query, position, position, f"[{DEFAULT_RANGE}]")
+        self.issues.append(Issue(
+            f"`{name}` expects a range vector, e.g. `{name}(metric[{DEFAULT_RANGE}])`, but no range was given.",
+            fix,
+        ))
+
+    def _check_selector(self, i: int):
+        close = self.closing[i]
+        has_metric_name = self.tokens[i - 1].kind == "ident" if i > 0 else False
+        matchers = []
+        j = i + 1
+        while j < close:
+            token = self.tokens[j]
+            if token.text == ",":
+                j += 1
+                continue
+            if token.kind == "string" and self._text(j + 1) in (",", "}"):
+                # Prometheus 3の`{"metric.name"}`形式
+                has_metric_name = True
+                j += 1
+                continue
+            operator = self._text(j + 1)
+            if token.kind != "ident" or operator not in MATCHER_OPERATORS:
+                self.issues.append(Issue(
+                    f"Invalid label matcher near `{self.query[token.start:self.tokens[min(j + 2, close)].end]}`. "
+                    f"Use `label=\"value\"`, `label!=\"value\"`, `label=~\"regex\"` or `label!~\"regex\"`."
+                ))
+                return
+            value = self.tokens[j + 2] if j + 2 < close else None
+            if value is None or value.kind != "string":
+                fix = None
+                if value is not None and value.kind in ("ident", "number"):
+                    fix = _splice(self.query, value.start, value.end, f'"{value.text}"')
+                self.issues.append(Issue(f"The value of label matcher `{token.text}{operator}` must be a quoted string.", fix))
+                return
+            if token.text == "__name__":
+                if operator == "=":
+                    self.metric_names.append((j + 2, _unquote(value.text)))
+            else:
+                self.label_names.append((j, token.text))
+            matchers.append((operator, _unquote(value.text), value))
+            j += 3
+
+        if has_metric_name:
+            return
+        if not any(not _matches_empty(operator, value) for operator, value, _ in matchers):
+            fix = None
+            for operator, value, token in matchers:
+                if operator == "=~" and value == ".*":
+                    fix = _splice(self.query, token.start, token.end, '".+"')
+                    break
+            self.issues.append(Issue(
+                "A vector selector needs a metric name or at least one label matcher that does not match the empty string "
+                "(e.g. use `=~\".+\"` instead of `=~\".*\"`).",
+                fix,
+            ))
+
+    def _check_range(self, i: int):
+        close = self.closing[i]
+        inner = self.query[self.tokens[i].end:self.tokens[close].start].strip()
+        parts = inner.split(":")
+        is_subquery = len(parts) == 2
+        durations = [part.strip() for part in parts if part.strip()]
+        if len(parts) > 2 or not durations or not all(_DURATION_PATTERN.match(d) for d in durations):
+            self.issues.append(Issue(f"Invalid range `[{inner}]`. Use a duration such as `[{DEFAULT_RANGE}]` (or `[{DEFAULT_RANGE}:1m]` for a subquery)."))
+            return
+
+        previous = self._text(i - 1)
+        if not is_subquery and previous in (")", "]"):
+            fix = _splice(self.query, self.tokens[i].start, self.tokens[close].end, f"[{inner}:]")
+            self.issues.append(Issue(
+                f"A range `[{inner}]` can only follow a metric selector. To apply it to an expression, use subquery syntax `[{inner}:]`.",
+                fix,
+            ))
+            return
+        if self.enclosing[i] is None:
+            # query_rangeでは範囲ベクトルをそのまま返せない
+            selector = self.query[:self.tokens[close].end].strip()
+            function = "rate" if re.search(r"_(total|count|sum|bucket)\b", selector) else "avg_over_time"
+            fix = None
+            if self.tokens[0].kind == "ident" and close == len(self.tokens) - 1:
+                fix = f"{function}({selector})"
+            self.issues.append(Issue(
+                f"A range vector `{selector}` cannot be graphed as it is. Wrap it in a function such as `{function}(...)`.",
+                fix,
+            ))
+
+    def _check_metric_names(self):
+        # 検証はイベントループ上で実行されるため、カタログの取得は待たない。取得できていない場合は確認しない
+        known = catalogue.metrics.peek_index()
+        if not known:
+            return
+        for i, name in self.metric_names:
+            if name in known:
+                continue
+            suggestions = similar_names(name, known)
+            self.issues.append(Issue(
+                f"Unknown metric `{name}` (not found among the {len(known)} metrics in Prometheus).{_did_you_mean(suggestions)} "
+                f"Use `search_prometheus_metrics` to find metric names.",
+                self._rename_fix(i, name, suggestions),
+            ))
+
+    def _check_label_names(self):
+        known = catalogue.prometheus_labels.peek_index()
+        if not known:
+            return
+        reported = set()
+        for i, name in self.label_names:
+            if name in reported or name in self.string_values or name in known:
+                continue
+            reported.add(name)
+            suggestions = similar_names(name, known)
+            self.issues.append(Issue(
+                f"Unknown label `{name}` (no series in Prometheus has this label).{_did_you_mean(suggestions)} "
+                f"Use `get_labels_and_values_for_metric` to see the labels of a metric.",
+                self._rename_fix(i, name, suggestions),
+            ))
+
+    def _rename_fix(self, i: int, name: str, suggestions: list[str]) -> str | None:
+        if not suggestions or difflib.SequenceMatcher(None, name, suggestions[0]).ratio() < FIX_SIMILARITY:
+            return None
+        token = self.tokens[i]
+        replacement = f'"{suggestions[0]}"' if token.kind == "string" else suggestions[0]
+        return _splice(self.query, token.start, token.end, replacement)
+
+def validate(query: str) -> list[Issue]:
+    """PromQLを検証し、見つかった問題のリストを返す(問題がなければ空)"""
+    query = query.strip()
+    if not query:
+        return [Issue("The query is empty.")]
+    try:
+        tokens = tokenize(query)
+    except _LexError as e:
+        return [Issue(str(e), e.fix)]
+    return _Checker(query, tokens).run()
+
+def suggest_fix(query: str, max_rounds: int = 5) -> str | None:
+    """自動修正を繰り返し適用し、検証を通るクエリになればそれを返す"""
+    current = query.strip()
+    for _ in range(max_rounds):
+        issues = validate(current)
+        if not issues:
+            return current if current != query.strip() else None
+        fixes = [issue.fix for issue in issues if issue.fix]
+        if not fixes:
+            return None
+        current = fixes[0]
+    return None
+
+def format_issues(query: str, issues: list[Issue]) -> str:
+    lines = [f"Invalid PromQL (not sent to Prometheus): `{query}`"]
+    lines += [f"- {issue.message}" for issue in issues]
+    fixed = suggest_fix(query)
+    if fixed:
+        lines.append(f"Suggested fix: `{fixed}`")
+    return "\n".join(lines)
@@ -0,0 +1,132 @@
+## ログ・メトリクス・トレースの調査を担当するサブエージェント
+## これまでは1つのエージェントに全てのツールを渡し、1ステップずつ順番に調査していたため、
+## 調査時間は各データソースの調査時間の合計になり、プロンプトにはLokiのラベル一覧とメトリクス一覧の両方が載っていた。
+## - データソースごとのサブエージェントに、そのデータソースのツールとカタログ(ラベル一覧・メトリクス一覧)だけを渡す
+## - プランナー(メインのエージェント)は1ターンで複数のtaskツールを呼び、サブエージェントを並列に実行して結果をまとめる
+##   (1ターン内の複数のツール呼び出しはToolNodeが並列に実行するため、調査時間は最も遅いサブエージェントの時間に近づく)
+## RCA_DEEP_AGENT_MODE=flat で従来の1エージェントの構成に戻せる
+import os
+
+import catalogue
+import loki
+import prometheus
+import tempo
+
+RCA_DEEP_AGENT_MODE = os.getenv("RCA_DEEP_AGENT_MODE", "subagents")
+
+LOGS_SUBAGENT = "logs-investigator"
+METRICS_SUBAGENT = "metrics-investigator"
+TRACES_SUBAGENT = "traces-investigator"
+
+LOGS_TOOLS = [loki.run_loki_logql, loki.get_loki_label_values, loki.get_list_of_streams, loki.search_loki_labels]
+METRICS_TOOLS = [prometheus.run_prometheus_promql, prometheus.get_prometheus_label_values, prometheus.get_all_prometheus_labels, prometheus.get_labels_and_values_for_metric, prometheus.search_prometheus_metrics]
+TRACES_TOOLS = [tempo.run_tempo_query_trace]
+
+# サブエージェント共通の指示。調査結果はプランナーがそのまままとめられる形で返させる
+_REPORT_FORMAT = """
+## Report
+Return only a concise report to the planner:
+- Findings: what you found, with the exact queries and the key values, error messages, timestamps or trace IDs.
+- Assessment: whether this data source points to a cause of the alert, and how confident you are.
+- Leads: identifiers worth following up in other data sources (e.g. trace IDs, pod or service names, time of the first anomaly).
+If nothing relevant was found, say so explicitly instead of guessing.
+"""
+
+def _alert_section(alert_message: str, alert_occurred_time: str) -> str:
+    return f"""
+## Alert
+#### Alert Message
+{alert_message}
+#### Alert Occurred Time
+{alert_occurred_time}
+"""
+
+def logs_subagent(alert_message: str, alert_occurred_time: str) -> dict:
+    system_prompt = f"""
+## Role
+You investigate the logs in Grafana Loki for the task given by the planner of a Root Cause Analysis (RCA).
+You have access to the following tools:
+1. run_loki_logql: Use this to execute LogQL queries to retrieve logs from Grafana Loki.
+    - By default it covers the time around the alert (from 1 hour before it started until 15 minutes after). Use `start`/`end` (e.g. `alert-6h`, `now-30m` or RFC3339) to look at other periods, and `direction`/`limit` to control which log lines are returned.
+    - The query is validated locally before it is sent to Loki. If it is invalid, the tool returns the error and usually a suggested fix; apply it and retry.
+    - Common mistakes: there is no `| limit`, `| sort` or `| tail` stage in LogQL; a selector must not be empty (`{{}}`) or match everything (use `=~".+"`, not `=~".*"`); a range such as `[5m]` is only valid inside functions like `count_over_time(...)`.
+    - OK LogQL example:
+        - `{{service_name=~".+"}} |= "c58ff9edaead7b757a3ae3411005945f"`
+        - `{{job=~".*varlogs.*"}} |= "error"`
+        - `count_over_time({{namespace="monitoring", service_name=~"clickhouse.*"}}[5m])`
+2. get_loki_label_values: Use this to get the values that a specific label has from Grafana Loki.
+3. get_list_of_streams: Use this to get the list of log streams in Grafana Loki.
+4. search_loki_labels: Use this to search Loki label names related to keywords. The Loki Labels List below may only contain the labels relevant to the alert.
+{_alert_section(alert_message, alert_occurred_time)}
+#### Loki Labels List
+{catalogue.get_relevant_loki_labels_text(alert_message)}
+{_REPORT_FORMAT}"""
+    return {
+        "name": LOGS_SUBAGENT,
+        "description": "Investigates logs in Grafana Loki (errors, exceptions, restarts, trace IDs in log lines). Give it a specific question about the logs.",
+        "system_prompt": system_prompt,
+        "tools": LOGS_TOOLS,
+    }
+
+def metrics_subagent(alert_message: str, alert_occurred_time: str) -> dict:
+    system_prompt = f"""
+## Role
+You investigate the metrics in Prometheus for the task given by the planner of a Root Cause Analysis (RCA).
+You have access to the following tools:
+1. run_prometheus_promql: Use this to execute PromQL queries to retrieve metrics from Prometheus.
+    - By default it covers the time around the alert (from 1 hour before it started until 15 minutes after). Use `start`/`end` (e.g. `alert-24h`, `now-30m` or RFC3339) to look at other periods, e.g. to compare with the usual values.
+    - The query is validated locally and its metric and label names are checked against Prometheus before it is sent. If it is invalid, the tool returns the error with similar names or a suggested fix.
+2. get_prometheus_label_values: Use this to get the values that a specific label has from Prometheus.
+3. get_all_prometheus_labels: Use this to get all labels that exist in Prometheus.
+4. get_labels_and_values_for_metric: Use this to get the labels and their values for a specific metric from Prometheus.
+5. search_prometheus_metrics: Use this to search Prometheus metric names related to keywords. The Metric List below may only contain the metrics relevant to the alert.
+{_alert_section(alert_message, alert_occurred_time)}
+#### Metric List
+{catalogue.get_relevant_metrics_text(alert_message)}
+{_REPORT_FORMAT}"""
+    return {
+        "name": METRICS_SUBAGENT,
+        "description": "Investigates metrics in Prometheus (resource usage, error rates, latency, saturation and how they changed around the alert). Give it a specific question about the metrics.",
+        "system_prompt": system_prompt,
+        "tools": METRICS_TOOLS,
+    }
+
+def traces_subagent(alert_message: str, alert_occurred_time: str) -> dict:
+    system_prompt = f"""
+## Role
+You investigate traces in Grafana Tempo for the task given by the planner of a Root Cause Analysis (RCA).
+You have access to the following tools:
+1. run_tempo_query_trace: Use this to execute a trace query against Grafana Tempo.
+    - The format of the trace ID is a 32-character hexadecimal string (e.g., "4bf92f3577b34da6a3ce929d0e0e4736", "98100898d812021273ec14bd273e4dda").
+    - Find the failing or slow spans in the trace and which service they belong to.
+{_alert_section(alert_message, alert_occurred_time)}
+{_REPORT_FORMAT}"""
+    return {
+        "name": TRACES_SUBAGENT,
+        "description": "Investigates traces in Grafana Tempo by trace ID (failing or slow spans and the services involved). Only useful when you have a trace ID, e.g. from the alert or the logs.",
+        "system_prompt": system_prompt,
+        "tools": TRACES_TOOLS,
+    }
+
+def build_subagents(alert_message: str, alert_occurred_time: str) -> list[dict]:
+    return [
+        logs_subagent(alert_message, alert_occurred_time),
+        metrics_subagent(alert_message, alert_occurred_time),
+        traces_subagent(alert_message, alert_occurred_time),
+    ]
+
+def get_planner_prompt(alert_message: str, alert_occurred_time: str) -> str:
+    return f"""
+## Role
+You are the planner of a Root Cause Analysis (RCA) for alerts from Grafana.
+You do not query the data sources yourself. Delegate the investigation to the sub-agents with the `task` tool:
+- {LOGS_SUBAGENT}: logs in Grafana Loki.
+- {METRICS_SUBAGENT}: metrics in Prometheus.
+- {TRACES_SUBAGENT}: traces in Grafana Tempo (needs a trace ID).
+
+## How to investigate
+1. Call `task` for {LOGS_SUBAGENT} and {METRICS_SUBAGENT} in the same turn, so that they run in parallel. Also include {TRACES_SUBAGENT} in that turn if the alert already contains a trace ID.
+   Give each one a specific, self-contained question (the sub-agents do not see this conversation).
+2. Merge their reports. If a report gives a lead for another data source (e.g. a trace ID in the logs, or the time a metric started to change), dispatch follow-up tasks, again in parallel where possible.
+3. Stop when the findings explain the alert, and write the final report: the root cause, the evidence from each data source, and the recommended actions.
+{_alert_section(alert_message, alert_occurred_time)}"""
@@ -1,6 +1,8 @@
 import requests
 from typing import Annotated
 
+import http_client
+
 TEMPO_WRAPPER_ENDPOINT = "http://o11y-tool:8070/o11y/tempo/api"
 
 def run_tempo_query_trace(
@@ -20,7 +22,7 @@ def run_tempo_query_trace(
   }
 
   try:
-    result = requests.post(f"{TEMPO_WRAPPER_ENDPOINT}/query_trace", params=params, timeout=10)
+    result = http_client.post(f"{TEMPO_WRAPPER_ENDPOINT}/query_trace", params=params)
     result_str = f"""#### TraceID\n`{trace_id}`\n\n#### Result\n{result.json()}"""
     return result_str
   except requests.exceptions.RequestException as e:
@@ -0,0 +1,85 @@
+## Webhookで受け取ったアラートを非同期に分析するための有界ワーカープール
+import os
+import queue
+import threading
+from datetime import datetime
+
+# 同時に実行する分析(LLM調査)の数と、待機できるアラート数の上限
+RCA_MAX_WORKERS = int(os.getenv("RCA_MAX_WORKERS", "2"))
+RCA_QUEUE_SIZE = int(os.getenv("RCA_QUEUE_SIZE", "50"))
+
+class AlertWorkerPool:
+    """
+    アラートをキューに積み、固定数のワーカースレッドで順次処理する。
+    キューが満杯の場合はsubmitがFalseを返すので、呼び出し側でバックプレッシャー(503)を返す。
+    """
+
+    def __init__(self, handler, max_workers: int = RCA_MAX_WORKERS, queue_size: int = RCA_QUEUE_SIZE):
+        self._handler = handler
+        self._max_workers = max(1, max_workers)
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._workers = []
+        self._active = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self):
+        for i in range(self._max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"rca-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        print(f"ワーカープールを起動しました (workers: {self._max_workers}, queue size: {self._queue.maxsize})")
+
+    def submit(self, alert: dict) -> bool:
+        try:
+            self._queue.put_nowait(alert)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "active_workers": self._active,
+                "max_workers": self._max_workers,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "saturated": self._queue.full(),
+            }
+
+    def shutdown(self, wait: bool = True):
+        # 各ワーカーに終了用の番兵(None)を送る
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _worker_loop(self):
+        while True:
+            alert = self._queue.get()
+            if alert is None:
+                self._queue.task_done()
+                break
+
+            with self._lock:
+                self._active += 1
+            try:
+                self._handler(alert)
+                with self._lock:
+                    self._processed += 1
+            except Exception as e:
+                print(f"[{datetime.now()}] Alert分析中にエラーが発生しました: {e}")
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    self._active -= 1
+                self._queue.task_done()
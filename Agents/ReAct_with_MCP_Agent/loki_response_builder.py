@@ -0,0 +1,142 @@
+## query_rangeのレスポンスの組み立て
+## これまではLokiの応答の全エントリを辞書のリストにして、そのままMCP(stdio)で返していたため、
+## limitを省略したクエリや長い期間のクエリでは、組み立て・シリアライズ・転送に時間がかかり、LLMのコンテキストも圧迫していた。
+## - 返すエントリ数(QUERY_RANGE_MAX_ENTRIES)とバイト数(QUERY_RANGE_MAX_BYTES)に上限を設け、上限に達した時点で組み立てを止める
+## - 同じストリームの同じログ行は1件にまとめ、繰り返し回数を付ける
+## - メトリクス(matrix)は[timestamp, value]の辞書ではなく、数値の配列で返す
+## - 上限で打ち切った場合は truncated と続きを取得するためのカーソル(next_cursor)を返す
+import base64
+import hashlib
+import json
+import math
+import os
+from typing import Optional, List, Dict, Any
+
+QUERY_RANGE_MAX_ENTRIES = int(os.getenv("QUERY_RANGE_MAX_ENTRIES", "200"))
+QUERY_RANGE_MAX_BYTES = int(os.getenv("QUERY_RANGE_MAX_BYTES", "32000"))
+# 1行のログの最大文字数(スタックトレースなどの巨大な行で予算を使い切らないため)
+LOG_LINE_MAX_CHARS = int(os.getenv("LOG_LINE_MAX_CHARS", "1000"))
+# 先頭のメタデータ(カーソルを含む)とJSONの区切りのために予算から確保しておくバイト数
+HEADER_RESERVE_BYTES = 640
+
+NO_DATA_MESSAGE = "データが見つかりませんでした。検索条件を変更してお試しください。(存在しないlabelを指定している可能性があります。labelを確認してください。)"
+
+class CursorError(ValueError):
+    pass
+
+def _query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()[:12]
+
+def _entry_hash(labels: Dict[str, str], line: str) -> str:
+    return hashlib.sha256((json.dumps(labels, sort_keys=True) + "\n" + line).encode()).hexdigest()[:12]
+
+def encode_cursor(query: str, start_ns: int, end_ns: int, step: Optional[str], direction: str, skip: List[str] = None, offset: int = 0) -> str:
+    """続きを取得するためのカーソル。同じクエリにだけ使えるよう、クエリのハッシュを含める"""
+    payload = {"q": _query_hash(query), "s": start_ns, "e": end_ns, "st": step, "d": direction, "x": skip or [], "o": offset}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode()
+
+def decode_cursor(cursor: str, query: str) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, json.JSONDecodeError):
+        raise CursorError("invalid cursor: pass next_cursor from the previous query_range result as is")
+    if payload.get("q") != _query_hash(query):
+        raise CursorError("the cursor belongs to a different query: call query_range with the same query as the previous call")
+    return payload
+
+def _size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+
+def _trim_line(line: str) -> str:
+    if len(line) <= LOG_LINE_MAX_CHARS:
+        return line
+    return line[:LOG_LINE_MAX_CHARS] + f"...[{len(line) - LOG_LINE_MAX_CHARS} chars truncated]"
+
+def _number(value: str):
+    # NaN・Infは素のJSONで表せないためNoneにする
+    number = float(value)
+    return number if math.isfinite(number) else None
+
+def build_streams(raw_result: list, query: str, start_ns: int, end_ns: int, step: Optional[str], direction: str, limit: int, skip: List[str] = (),
+                  max_entries: int = QUERY_RANGE_MAX_ENTRIES, max_bytes: int = QUERY_RANGE_MAX_BYTES) -> List[Dict[str, Any]]:
+    """
+    ログ(streams)の結果を組み立てる。全ストリームのエントリを時刻順(directionの向き)に並べ、上限に達するまで詰める。
+    skipには前のページで返した境界の時刻のエントリ(のハッシュ)が入っており、重複して返さない
+    """
+    entries = []
+    for index, log_result in enumerate(raw_result):
+        for timestamp, line in log_result.get('values', []):
+            entries.append((int(timestamp), index, line))
+    entries.sort(key=lambda entry: entry[0], reverse=(direction == "backward"))
+    skip = set(skip)
+
+    streams = {}
+    emitted = {}
+    used_bytes = HEADER_RESERVE_BYTES
+    returned = 0
+    deduplicated = 0
+    last_timestamp = None
+    boundary = []
+    truncated = False
+    for timestamp, index, line in entries:
+        labels = raw_result[index].get('stream', {})
+        digest = _entry_hash(labels, line)
+        if digest in skip:
+            continue
+        key = (index, line)
+        if key in emitted:
+            emitted[key]["repeats"] = emitted[key].get("repeats", 1) + 1
+            deduplicated += 1
+        else:
+            entry = {"timestamp": str(timestamp), "value": _trim_line(line)}
+            cost = _size(entry) + (0 if index in streams else _size(labels) + 32)
+            if returned >= max_entries or used_bytes + cost > max_bytes:
+                truncated = True
+                break
+            streams.setdefault(index, {"labels": labels, "entries": []})["entries"].append(entry)
+            emitted[key] = entry
+            used_bytes += cost
+            returned += 1
+        # 続きは最後に処理したエントリの時刻から取得する。同じ時刻のエントリは次のページで除外する
+        if timestamp != last_timestamp:
+            last_timestamp, boundary = timestamp, []
+        boundary.append(digest)
+
+    # Lokiがlimitまで返した場合は、打ち切っていなくても続きがある可能性がある
+    has_more = truncated or len(entries) >= limit
+    header = {"data_type": "log", "returned_entries": returned, "deduplicated_entries": deduplicated, "truncated": has_more}
+    if has_more and last_timestamp is not None:
+        if direction == "backward":
+            cursor = encode_cursor(query, start_ns, last_timestamp + 1, step, direction, boundary)
+        else:
+            cursor = encode_cursor(query, last_timestamp, end_ns, step, direction, boundary)
+        header["next_cursor"] = cursor
+        header["note"] = "More log entries are available. Call query_range again with the same query and cursor=next_cursor only if you need them."
+    return [header, *streams.values()]
+
+def build_matrix(raw_result: list, query: str, start_ns: int, end_ns: int, step: Optional[str], direction: str, offset: int = 0,
+                 max_bytes: int = QUERY_RANGE_MAX_BYTES) -> List[Dict[str, Any]]:
+    """メトリクス(matrix)の結果を系列ごとの数値の配列で組み立てる。予算を超えた系列は次のページで返す"""
+    series = []
+    used_bytes = HEADER_RESERVE_BYTES
+    next_offset = None
+    for index, metric_result in enumerate(raw_result[offset:], start=offset):
+        values = metric_result.get('values', [])
+        item = {
+            "labels": metric_result.get('metric', {}),
+            "timestamps": [int(float(timestamp)) for timestamp, _ in values],
+            "values": [_number(value) for _, value in values],
+        }
+        cost = _size(item)
+        # 1系列だけで予算を超える場合も、その系列は返す(返せるものがなくなるため)
+        if series and used_bytes + cost > max_bytes:
+            next_offset = index
+            break
+        series.append(item)
+        used_bytes += cost
+
+    header = {"data_type": "metric", "returned_series": len(series), "total_series": len(raw_result), "truncated": next_offset is not None}
+    if next_offset is not None:
+        header["next_cursor"] = encode_cursor(query, start_ns, end_ns, step, direction, offset=next_offset)
+        header["note"] = "More series are available. Call query_range again with the same query and cursor=next_cursor only if you need them, or aggregate the query (e.g. sum by (...))."
+    return [header, *series]
@@ -1,11 +1,16 @@
 import json
 import logging
-from urllib.parse import urlencode
+import os
+import re
+import time
+from datetime import datetime, timezone
 from typing import Optional, List, Dict, Any, Union
 
-import requests
+import httpx
 from mcp.server.fastmcp import FastMCP
 
+import loki_response_builder
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,109 +19,150 @@ mcp = FastMCP("Loki")
 
 # Lokiのエンドポイント（環境に応じて変更）
 LOKI_ENDPOINT = "http://192.168.0.176:31100/loki/api/v1"
+LOKI_HEADERS = {'X-Scope-OrgID': 'homelab'}
+
+# Lokiへのリクエストのタイムアウト(秒)と接続プールの大きさ
+LOKI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LOKI_CONNECT_TIMEOUT_SECONDS", "5"))
+LOKI_READ_TIMEOUT_SECONDS = float(os.getenv("LOKI_READ_TIMEOUT_SECONDS", "30"))
+LOKI_MAX_CONNECTIONS = int(os.getenv("LOKI_MAX_CONNECTIONS", "20"))
+LOKI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LOKI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+LOKI_DIRECTIONS = ("backward", "forward")
+# query_rangeでLokiから取得するエントリ数。limitを省略した場合もQUERY_RANGE_DEFAULT_LIMITで制限する
+QUERY_RANGE_DEFAULT_LIMIT = int(os.getenv("QUERY_RANGE_DEFAULT_LIMIT", "100"))
+QUERY_RANGE_MAX_LIMIT = int(os.getenv("QUERY_RANGE_MAX_LIMIT", "1000"))
+# start/endを省略した場合の期間(Lokiのデフォルトと同じ1時間)
+QUERY_RANGE_DEFAULT_SINCE_SECONDS = 3600
+_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+_RELATIVE_TIME_PATTERN = re.compile(r"^now(?:\s*-\s*((?:\d+(?:\.\d+)?(?:ms|s|m|h|d|w))+))?$")
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w)")
+
+# ツールはFastMCPのイベントループ上で非同期に実行されるため、ブロッキングのrequestsではなく
+# 接続を使い回すhttpx.AsyncClientでLokiにリクエストする(同時に呼ばれたツールがイベントループ上で直列化しない)。
+# クライアントはイベントループに紐づくため、最初のツール呼び出しの時に作る
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=LOKI_ENDPOINT,
+            headers=LOKI_HEADERS,
+            timeout=httpx.Timeout(LOKI_READ_TIMEOUT_SECONDS, connect=LOKI_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=LOKI_MAX_CONNECTIONS, max_keepalive_connections=LOKI_MAX_KEEPALIVE_CONNECTIONS),
+        )
+    return _client
+
+async def _get_json(path: str, params: Optional[Dict[str, str]] = None, description: str = "response") -> Dict[str, Any]:
+    response = await _get_client().get(path, params=params)
+
+    if response.status_code != 200:
+        logger.error(f"Loki request failed: path={path}, status={response.status_code}, body={response.text}")
+        raise Exception(f"failed to get {description} from loki: {response.status_code}")
+
+    try:
+        return response.json()
+    except json.JSONDecodeError as e:
+        logger.error(f"failed to unmarshal response json: {e}")
+        raise Exception("failed to unmarshal response json")
+
+def _to_unix_ns(value: str, now_ns: int) -> int:
+    """
+    start/endの指定をナノ秒のUNIX時刻にする(続きを取得するカーソルに絶対時刻が必要なため)。
+    RFC3339・UNIX時刻(秒・ミリ秒・マイクロ秒・ナノ秒)・"now"/"now-1h"のような相対指定を受け付ける
+    """
+    value = value.strip()
+    relative = _RELATIVE_TIME_PATTERN.match(value)
+    if relative:
+        offset = sum(float(number) * _UNIT_SECONDS[unit] for number, unit in _DURATION_PATTERN.findall(relative.group(1) or ""))
+        return now_ns - int(offset * 1e9)
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        number = float(value)
+        # 桁数から単位を判断する
+        for limit, scale in ((1e11, 1e9), (1e14, 1e6), (1e17, 1e3)):
+            if number < limit:
+                return int(number * scale)
+        return int(value.split(".")[0])
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"invalid time '{value}': use RFC3339 (e.g. 2025-06-01T12:00:00Z), a Unix timestamp, or 'now-<duration>' (e.g. now-1h)")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp()) * 10**9 + parsed.microsecond * 1000
 
 @mcp.tool()
-def query_range(
+async def query_range(
     query: str,
-    limit: Optional[int] = None
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    step: Optional[str] = None,
+    direction: str = "backward",
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
 ) -> List[Dict[str, Any]]:
     """
     Query Loki for log or metric data within a time range.
     
     Args:
         query: LogQL query string
-        limit: Maximum number of entries to return. Default: 100
+        start: Start of the time range: RFC3339 (e.g. 2025-06-01T12:00:00Z), Unix timestamp, or relative to now (e.g. now-1h). Default: 1 hour before end
+        end: End of the time range, in the same formats as start. Default: now
+        step: Resolution of metric queries (e.g. 30s, 5m). Default: chosen by Loki
+        direction: Order of log entries: "backward" (newest first) or "forward" (oldest first). Default: backward
+        limit: Maximum number of entries to fetch from Loki. Default: 100, max: 1000
+        cursor: next_cursor from a previous result of the same query, to get the entries (or series) that did not fit. Overrides start, end, step and direction
     
     Returns:
-        List containing query results with metadata and entries, or error message if no data found
+        List containing query results with metadata and entries, or error message if no data found.
+        The first item is metadata. If it has "truncated": true, the output was capped and "next_cursor" can be passed as cursor to get the rest.
+        Repeated identical log lines are returned once with a "repeats" count. Metric series are returned as "timestamps" (Unix seconds) and "values" arrays.
     """
     try:
         # Lokiへのクエリパラメータを構築
-        query_params = {'query': query}
-        
-        if limit:
-            query_params['limit'] = str(limit)
-
-        logger.info(f"LogQL Request: logql={query}")
+        skip = []
+        offset = 0
+        if cursor:
+            # 続きの取得では、前回の結果の境界から同じクエリを実行する
+            page = loki_response_builder.decode_cursor(cursor, query)
+            start_ns, end_ns, step, direction, skip, offset = page["s"], page["e"], page["st"], page["d"], page["x"], page["o"]
+        else:
+            if direction not in LOKI_DIRECTIONS:
+                raise ValueError(f"invalid direction '{direction}': use 'backward' or 'forward'")
+            now_ns = time.time_ns()
+            end_ns = _to_unix_ns(end, now_ns) if end else now_ns
+            start_ns = _to_unix_ns(start, now_ns) if start else end_ns - QUERY_RANGE_DEFAULT_SINCE_SECONDS * 10**9
+        limit = max(1, min(limit or QUERY_RANGE_DEFAULT_LIMIT, QUERY_RANGE_MAX_LIMIT))
+        query_params = {
+            'query': query,
+            'direction': direction,
+            'start': str(start_ns),
+            'end': str(end_ns),
+            # 前のページで返した境界のエントリは除外するため、その分だけ多く取得する
+            'limit': str(limit + len(skip)),
+        }
+        if step:
+            query_params['step'] = step
+
+        logger.info(f"LogQL Request: logql={query}, start={start_ns}, end={end_ns}, step={step}, direction={direction}, limit={limit}, cursor={bool(cursor)}")
 
         # Lokiエンドポイントへのリクエスト
-        full_url = f"{LOKI_ENDPOINT}/query_range?{urlencode(query_params)}"
-
-        headers = {'X-Scope-OrgID': 'homelab'}
-
-        response = requests.get(full_url, headers=headers)
-        
-        if response.status_code != 200:
-            logger.error(f"Loki request failed: status={response.status_code}, body={response.text}")
-            raise Exception(f"failed to get query range response from loki: {response.status_code}")
+        loki_response = await _get_json("/query_range", query_params, "query range response")
         
-        # デバッグ用（生の応答をログ出力）
-        # logger.info(f"raw response from loki: status={response.status_code}, body={response.text}")
-        
-        # JSON応答の解析
-        try:
-            loki_response = response.json()
-        except json.JSONDecodeError as e:
-            logger.error(f"failed to unmarshal response json: {e}")
-            raise Exception("failed to unmarshal response json")
-        
-        # 結果の処理
-        result = []
+        # 結果の処理(上限に達した時点で組み立てを止め、続きはカーソルで取得させる)
         data = loki_response.get('data', {})
         result_type = data.get('resultType', '')
         raw_result = data.get('result', [])
-        
+
+        if not raw_result:
+            return [{"data": loki_response_builder.NO_DATA_MESSAGE}]
         if result_type == "streams":
-            if len(raw_result) > 0:
-                result.append({"data_type": "log"})
-                
-                for log_result in raw_result:
-                    stream = log_result.get('stream', {})
-                    values = log_result.get('values', [])
-                    
-                    entries = []
-                    for value in values:
-                        entries.append({
-                            "timestamp": value[0],
-                            "value": value[1]
-                        })
-                    
-                    item = {
-                        "labels": stream,
-                        "entries": entries
-                    }
-                    result.append(item)
-            else:
-                result.append({"data": "データが見つかりませんでした。検索条件を変更してお試しください。(存在しないlabelを指定している可能性があります。labelを確認してください。)"})
-                
-        elif result_type == "matrix":
-            if len(raw_result) > 0:
-                result.append({"data_type": "metric"})
-                
-                for metric_result in raw_result:
-                    metric = metric_result.get('metric', {})
-                    values = metric_result.get('values', [])
-                    
-                    entries = []
-                    for value in values:
-                        entries.append({
-                            "timestamp": value[0],
-                            "value": value[1]
-                        })
-                    
-                    item = {
-                        "labels": metric,
-                        "entries": entries
-                    }
-                    result.append(item)
-            else:
-                result.append({"data": "データが見つかりませんでした。検索条件を変更してお試しください。(存在しないlabelを指定している可能性があります。labelを確認してください。)"})
-        
-        # logger.info(f"result: {result}")  # デバッグ用
-        
-        return result
-        
-    except requests.RequestException as e:
+            return loki_response_builder.build_streams(raw_result, query, start_ns, end_ns, step, direction, limit + len(skip), skip)
+        if result_type == "matrix":
+            return loki_response_builder.build_matrix(raw_result, query, start_ns, end_ns, step, direction, offset)
+        return []
+
+    except httpx.HTTPError as e:
         logger.error(f"failed to get query range response from loki: {e}")
         raise Exception(f"failed to get query range response from loki: {str(e)}")
     except Exception as e:
@@ -124,38 +170,21 @@ def query_range(
         raise Exception(f"internal server error: {str(e)}")
 
 @mcp.tool()
-def get_all_labels() -> List[str]:
+async def get_all_labels() -> List[str]:
     """
     Get all available label names from Loki.
     
     Returns:
         List of all available label names
     """
-    try:        
-        full_url = f"{LOKI_ENDPOINT}/labels"
-
-        headers = {'X-Scope-OrgID': 'homelab'}
-
-        response = requests.get(full_url, headers=headers)
-        
-        if response.status_code != 200:
-            logger.error(f"Loki labels query failed: status={response.status_code}, body={response.text}")
-            raise Exception(f"failed to get labels from loki: {response.status_code}")
-        
-        # デバッグ用（生の応答をログ出力）
-        logger.info(f"raw response from loki: status={response.status_code}, body={response.text}")
-        
-        try:
-            loki_response = response.json()
-        except json.JSONDecodeError as e:
-            logger.error(f"failed to unmarshal response json: {e}")
-            raise Exception("failed to unmarshal response json")
+    try:
+        loki_response = await _get_json("/labels", description="labels")
         
         labels = loki_response.get('data', [])
         
         return labels
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"failed to get labels from loki: {e}")
         raise Exception(f"failed to get labels from loki: {str(e)}")
     except Exception as e:
@@ -163,7 +192,7 @@ def get_all_labels() -> List[str]:
         raise Exception(f"internal server error: {str(e)}")
 
 @mcp.tool()
-def get_label_values(label: str) -> List[str]:
+async def get_label_values(label: str) -> List[str]:
     """
     Get all possible values for a specific label from Loki.
     
@@ -176,30 +205,13 @@ def get_label_values(label: str) -> List[str]:
     try:
         logger.info(f"Get Label Values Request: label={label}")
 
-        full_url = f"{LOKI_ENDPOINT}/label/{label}/values"
-
-        headers = {'X-Scope-OrgID': 'homelab'}
-
-        response = requests.get(full_url, headers=headers)
-        
-        if response.status_code != 200:
-            logger.error(f"Loki label values query failed: status={response.status_code}, body={response.text}")
-            raise Exception(f"failed to get label values from loki: {response.status_code}")
-        
-        # デバッグ用（生の応答をログ出力）
-        logger.info(f"raw response from loki: status={response.status_code}, body={response.text}")
-        
-        try:
-            loki_response = response.json()
-        except json.JSONDecodeError as e:
-            logger.error(f"failed to unmarshal response json: {e}")
-            raise Exception("failed to unmarshal response json")
+        loki_response = await _get_json(f"/label/{label}/values", description="label values")
         
         values = loki_response.get('data', [])
         
         return values
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"failed to get label values from loki: {e}")
         raise Exception(f"failed to get label values from loki: {str(e)}")
     except Exception as e: